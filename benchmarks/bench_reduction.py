@@ -0,0 +1,279 @@
+"""Benchmark the reduction path with synthetic Pilatus2M frames.
+
+Frames of 1475x1679 pixels are generated with a power-law background and a
+peak at q0 = 0.012 1/A in q^3.5 I(q), written as TIFF files, and taken through
+the stages of the reducer: integration, peak fitting, ``reduce_run`` (when
+SciAnalysis can be set up on this machine), ``flatten_dict`` and
+``publish_reduced_documents`` into local stand-ins for Tiled and Kafka.
+
+The report gives frames per second, latency percentiles of every stage and
+the peak RSS, and is compared against a stored baseline::
+
+    python benchmarks/bench_reduction.py --frames 50
+    python benchmarks/bench_reduction.py --update-baseline
+
+The script exits with status 1 if any figure regressed by more than the tolerance.
+"""
+import argparse
+import json
+import logging
+import os
+import pickle
+import resource
+import struct
+import sys
+import tempfile
+import time as ttime
+
+import msgpack
+import msgpack_numpy
+import numpy as np
+
+from cms_agents.documents import LOG_FORMAT, flatten_dict, publish_reduced_documents
+from cms_agents.fitting import fit_q2I_peaks
+from cms_agents.integration import IntegrationPlan, q_map
+from cms_agents.metrics import StageMetrics, StageTimer
+from cms_agents.readiness import tiff_header_readable
+from cms_agents.sinks import DocumentSinks, kafka_sink, tiled_sink
+
+logger = logging.getLogger("benchmarks.bench_reduction")
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# calibration of the reducer, see cms_agents/scianalysis_agent.py
+GEOMETRY = dict(
+    wavelength_A=0.9184,
+    width=1475,
+    height=1679,
+    pixel_size_um=172.0,
+    beam_position=(754, 1075),
+    distance_m=5.03,
+)
+FIT_ARGS = dict(qn_power=3.5, trim_range=[0.005, 0.03], fit_range=[0.007, 0.019], q0=0.0120, sigma=0.0008)
+
+# Pilatus2M: 3 x 8 modules of 487 x 195 pixels, separated by gaps of 7 and 17 pixels
+MODULE_SHAPE = (195, 487)
+MODULE_GAPS = (17, 7)
+
+
+def pilatus_mask():
+    mask = np.ones((GEOMETRY["height"], GEOMETRY["width"]), dtype=np.uint8)
+    for axis in (0, 1):
+        step = MODULE_SHAPE[axis] + MODULE_GAPS[axis]
+        for start in range(MODULE_SHAPE[axis], mask.shape[axis], step):
+            index = [slice(None), slice(None)]
+            index[axis] = slice(start, start + MODULE_GAPS[axis])
+            mask[tuple(index)] = 0
+    return mask
+
+
+def synthetic_frame(q, rng, q0=0.012, sigma=0.0008, qn_power=3.5):
+    """Poisson counts with q^n I(q) a Gaussian peak at ``q0`` on a flat background."""
+    prefactor = rng.uniform(1.5e-5, 2.5e-5)
+    q2I = 1e-5 + prefactor * np.exp(-np.square(q - rng.normal(q0, 2e-4)) / (2 * sigma**2))
+    expected = np.minimum(q2I / np.power(np.maximum(q, 1e-4), qn_power), 1e6)
+    return rng.poisson(expected).astype(np.int32)
+
+
+def write_tiff(path, image):
+    """Write an int32 frame as an uncompressed single-strip TIFF, the way the Pilatus does."""
+    height, width = image.shape
+    data = np.ascontiguousarray(image, dtype="<i4").tobytes()
+    SHORT, LONG = 3, 4
+    entries = [
+        (256, LONG, 1, width),  # ImageWidth
+        (257, LONG, 1, height),  # ImageLength
+        (258, SHORT, 1, 32),  # BitsPerSample
+        (259, SHORT, 1, 1),  # Compression, none
+        (262, SHORT, 1, 1),  # PhotometricInterpretation, black is zero
+        (273, LONG, 1, 0),  # StripOffsets, filled in below
+        (277, SHORT, 1, 1),  # SamplesPerPixel
+        (278, LONG, 1, height),  # RowsPerStrip
+        (279, LONG, 1, len(data)),  # StripByteCounts
+        (339, SHORT, 1, 2),  # SampleFormat, signed integer
+    ]
+    data_offset = 8 + 2 + 12 * len(entries) + 4
+    ifd = struct.pack("<H", len(entries))
+    for tag, kind, count, value in entries:
+        value = data_offset if tag == 273 else value
+        packed = struct.pack("<HH", value, 0) if kind == SHORT else struct.pack("<I", value)
+        ifd += struct.pack("<HHI", tag, kind, count) + packed
+    ifd += struct.pack("<I", 0)
+    with open(path, "wb") as f:
+        f.write(b"II" + struct.pack("<HI", 42, 8) + ifd + data)
+
+
+def read_tiff(path, shape):
+    """Read back a frame written by ``write_tiff``, its pixels are the last bytes of the file."""
+    with open(path, "rb") as f:
+        f.seek(-4 * shape[0] * shape[1], os.SEEK_END)
+        return np.frombuffer(f.read(), dtype="<i4").reshape(shape)
+
+
+class LocalTiled:
+    """Stand-in for the sandbox Tiled client, serializes every inserted document."""
+
+    def __init__(self):
+        self.v1 = self
+        self.inserted = 0
+
+    def insert(self, name, doc):
+        pickle.dumps((name, doc))
+        self.inserted += 1
+
+
+class LocalPublisher:
+    """Stand-in for a bluesky_kafka Publisher, msgpack encodes every document."""
+
+    def __init__(self):
+        self.published = 0
+
+    def __call__(self, name, doc):
+        msgpack.packb((name, doc), default=msgpack_numpy.encode)
+        self.published += 1
+
+    def flush(self):
+        pass
+
+
+def load_reducer():
+    """The reducer module, or None if SciAnalysis cannot be set up here."""
+    try:
+        from cms_agents import scianalysis_agent
+    except Exception as ex:
+        logger.warning("reduce_run is not benchmarked, the SciAnalysis setup failed: %r", ex)
+        return None
+    return scianalysis_agent
+
+
+def run_benchmark(num_frames, workdir, seed=0):
+    rng = np.random.default_rng(seed)
+    q = q_map(**GEOMETRY)
+    plan = IntegrationPlan.load_or_build(GEOMETRY, pilatus_mask())
+    reducer = load_reducer()
+    metrics = StageMetrics()
+    tiled, publisher = LocalTiled(), LocalPublisher()
+    sinks = DocumentSinks(tiled_sink(tiled, metrics=metrics), kafka_sink(publisher, metrics=metrics))
+
+    starts = []
+    for i in range(num_frames):
+        start = dict(
+            uid=f"synthetic-{i}",
+            scan_id=i,
+            experiment_alias_directory=workdir + os.sep,
+            filename=f"synthetic_x{i * 0.1:.3f}_yy0.000_th0.120_T150.000C_10.00s_{i}",
+        )
+        path = reducer.raw_tiff_path(start) if reducer else os.path.join(workdir, f"{start['filename']}_saxs.tiff")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_tiff(path, synthetic_frame(q, rng))
+        assert tiff_header_readable(path)
+        starts.append((start, path))
+    logger.info("wrote %d synthetic frames to %s", num_frames, workdir)
+
+    curves = []
+    elapsed = 0.0
+    for start, path in starts:
+        image = read_tiff(path, q.shape)
+        timer = StageTimer()
+        q_bins, intensity, _ = plan.integrate(image, error=True)
+        timer.mark("integrate")
+        (fit,) = fit_q2I_peaks(q_bins, intensity, **FIT_ARGS)
+        timer.mark("fit_q2I")
+        if reducer is not None:
+            reduced, metadata = reducer.reduce_run(reducer.StartDocumentRun(start), timer=timer)
+            timer.mark("reduce_run")
+        else:
+            reduced = {
+                "circular_average_q2I_fit": {k: v["value"] if isinstance(v, dict) else v for k, v in fit.items()}
+            }
+            metadata = {"raw_start": start}
+        reduced = flatten_dict(reduced, sep="__")
+        timer.mark("flatten_dict")
+        publish_reduced_documents(reduced, metadata, sinks)
+        timer.mark("publish")
+        metrics.observe_timer(timer)
+        elapsed += timer.total()
+        curves.append(intensity)
+    sinks.close()
+
+    start = ttime.monotonic()
+    fit_q2I_peaks(q_bins, np.stack(curves), **FIT_ARGS)
+    batch_fit = ttime.monotonic() - start
+
+    summary = metrics.summary()["stages"]
+    return dict(
+        frames=num_frames,
+        reduce_run=reducer is not None,
+        frames_per_second=num_frames / elapsed,
+        batch_fit_curves_per_second=num_frames / batch_fit,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        stages={stage: {k: stats[k] for k in ("p50", "p95", "p99", "max")} for stage, stats in summary.items()},
+        documents=dict(tiled=tiled.inserted, kafka=publisher.published),
+    )
+
+
+def compare(report, baseline, tolerance):
+    """Descriptions of every figure of ``report`` more than ``tolerance`` worse than ``baseline``."""
+    regressions = []
+    for key in ("frames_per_second", "batch_fit_curves_per_second"):
+        if key in baseline and report[key] < baseline[key] * (1 - tolerance):
+            regressions.append(f"{key}: {report[key]:.2f}, baseline {baseline[key]:.2f}")
+    if "peak_rss_mb" in baseline and report["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(f"peak_rss_mb: {report['peak_rss_mb']:.0f}, baseline {baseline['peak_rss_mb']:.0f}")
+    for stage, stats in report["stages"].items():
+        for percentile in ("p50", "p95"):
+            reference = baseline.get("stages", {}).get(stage, {}).get(percentile)
+            if reference and stats[percentile] > reference * (1 + tolerance):
+                regressions.append(
+                    f"{stage} {percentile}: {stats[percentile] * 1e3:.2f} ms, baseline {reference * 1e3:.2f} ms"
+                )
+    return regressions
+
+
+def print_report(report):
+    print(f"{report['frames']} frames, reduce_run {'included' if report['reduce_run'] else 'skipped'}")
+    print(f"frames per second: {report['frames_per_second']:.2f}")
+    print(f"batch fit curves per second: {report['batch_fit_curves_per_second']:.0f}")
+    print(f"peak RSS: {report['peak_rss_mb']:.0f} MB")
+    print(f"{'stage':<24}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<24}" + "".join(f"{stats[k] * 1e3:>10.2f}" for k in ("p50", "p95", "p99", "max")))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", default=20, type=int, help="number of synthetic frames")
+    parser.add_argument("--workdir", default=None, help="directory for the frames, by default a temporary one")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline report to compare against")
+    parser.add_argument("--tolerance", default=0.25, type=float, help="allowed relative regression")
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--output", default=None, help="also write the report as JSON to this path")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level="INFO", format=LOG_FORMAT)
+    with tempfile.TemporaryDirectory() as tmp:
+        report = run_benchmark(args.frames, args.workdir or tmp)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"stored baseline {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, store one with --update-baseline")
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(report, json.load(f), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""Acquisition on a dense grid, for the low-dimensional bounds of the CMS agents.
+
+For up to three independent variables, e.g. a sample position in mm, the
+acquisition function is evaluated on every point of a grid over the bounds in
+one batched pass, and then on a finer grid around the best few cells. This is
+deterministic, and for the number of points measured in a beamtime faster
+than the multi-start gradient optimization of ``optimize_acqf``.
+
+A batch of q points is selected greedily: after each point, the model is
+conditioned on its posterior mean there, and the next point is selected on
+this fantasy model, so the batch spreads out instead of repeating the best point.
+"""
+import torch
+
+
+class GridAcquisition:
+    """Optimize an acquisition function on a grid over the bounds, kept between asks.
+
+    Parameters
+    ----------
+    bounds : torch.Tensor
+        A `2 x d` tensor of lower and upper bounds, with d at most ``MAX_DIM``.
+    max_points : int, optional
+        Size of the grid, split evenly between the dimensions, by default 4096.
+    top_cells : int, optional
+        Number of best grid points refined, by default 4.
+    refine_points : int, optional
+        Points per dimension of the finer grid spanning the cells around each refined point, by default 9.
+    """
+
+    MAX_DIM = 3
+
+    def __init__(self, bounds, max_points: int = 4096, top_cells: int = 4, refine_points: int = 9):
+        self.bounds = torch.as_tensor(bounds, dtype=torch.float64).view(2, -1)
+        dim = self.bounds.shape[-1]
+        if dim > self.MAX_DIM:
+            raise ValueError(f"Grid acquisition supports at most {self.MAX_DIM} dimensions, got {dim}.")
+        self.points_per_dim = max(2, int(round(max_points ** (1 / dim))))
+        self.top_cells = top_cells
+        self.refine_points = refine_points
+        self.spacing = (self.bounds[1] - self.bounds[0]) / (self.points_per_dim - 1)
+        self.grid = self._grid(self.bounds, self.points_per_dim)
+
+    @staticmethod
+    def _grid(bounds, points_per_dim):
+        axes = [torch.linspace(low, high, points_per_dim, dtype=bounds.dtype) for low, high in bounds.T.tolist()]
+        return torch.stack(torch.meshgrid(*axes, indexing="ij"), dim=-1).reshape(-1, len(axes))
+
+    @staticmethod
+    def evaluate(acqf, x):
+        """Acquisition values of the points ``x`` of shape (m, d), in one batched pass."""
+        x = x.to(acqf.model.train_inputs[0])
+        with torch.no_grad():
+            return acqf(x.unsqueeze(-2))
+
+    def _local_grids(self, centers):
+        grids = []
+        for center in centers:
+            low = torch.maximum(center - self.spacing, self.bounds[0])
+            high = torch.minimum(center + self.spacing, self.bounds[1])
+            grids.append(self._grid(torch.stack([low, high]), self.refine_points))
+        return torch.cat(grids)
+
+    def best(self, acqf):
+        """
+        Best point of the grid, refined on finer grids around the best cells.
+
+        Returns
+        -------
+        candidate : torch.Tensor
+            Point of shape (d,).
+        value : torch.Tensor
+            Acquisition value at the point.
+        """
+        values = self.evaluate(acqf, self.grid).double()
+        top = values.topk(min(self.top_cells, len(values))).indices
+        local = self._local_grids(self.grid[top])
+        points = torch.cat([self.grid[top], local])
+        values = torch.cat([values[top], self.evaluate(acqf, local).double()])
+        i = int(values.argmax())
+        return points[i], values[i]
+
+    def select(self, model, partial_acqf, q: int = 1):
+        """
+        Select ``q`` points by greedy fantasization.
+
+        Parameters
+        ----------
+        model : botorch.models.model.Model
+            Surrogate model, it is not modified.
+        partial_acqf : callable
+            Builds the acquisition function from a model.
+        q : int, optional
+            Number of points, by default 1.
+
+        Returns
+        -------
+        candidates : torch.Tensor
+            Points of shape (q, d).
+        values : torch.Tensor
+            Acquisition value of each point when it was selected, shape (q,).
+        """
+        candidates, values = [], []
+        for i in range(q):
+            candidate, value = self.best(partial_acqf(model))
+            candidates.append(candidate)
+            values.append(value)
+            if i < q - 1:
+                x = candidate.unsqueeze(0).to(model.train_inputs[0])
+                with torch.no_grad():
+                    believed = model.posterior(x).mean
+                model = model.condition_on_observations(x, believed)
+        return torch.stack(candidates), torch.stack(values)
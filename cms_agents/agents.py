@@ -1,20 +1,38 @@
+import itertools
+import logging
+import time as ttime
 import uuid
 from abc import ABC
-from typing import List, Sequence, Tuple, Union
+from typing import List, Optional, Sequence, Tuple, Union
 
 import nslsii.kafka_utils
 import numpy as np
-import tiled
+import torch
 from bluesky_adaptive.agents.base import Agent, AgentConsumer
 from bluesky_adaptive.agents.botorch import SingleTaskGPAgentBase
 from bluesky_adaptive.agents.simple import SequentialAgentBase
 from bluesky_kafka import Publisher
 from bluesky_queueserver_api.zmq import REManagerAPI
+from botorch import fit_gpytorch_mll
+from botorch.optim import optimize_acqf
 from numpy.typing import ArrayLike
 
+from cms_agents.acquisition import GridAcquisition
+from cms_agents.columns import ColumnCache, DataKeyIndex, EventPayloads, iter_history
+from cms_agents.snapshots import pack_arrays, read_snapshot, unpack_arrays, write_snapshot
+from cms_agents.surrogate import IncrementalGP
+from cms_agents.tiled_access import RunCache, get_client_from_uri
+
+logger = logging.getLogger(__name__)
+
 
 class CMSBaseAgent(Agent, ABC):
     """Base agent to interface with output of SciAnalysis stored in sandbox databroker
+
+    The independent and target variables are taken from the reduced event documents seen on Kafka,
+    and only read from the sandbox when they are missing there. Events of a long-lived reduced run,
+    see cms_agents.documents.ReducedRunStream, are told one by one as they arrive.
+
     Parameters
     ----------
     independent_key : str
@@ -25,12 +43,58 @@ class CMSBaseAgent(Agent, ABC):
         Name of the target (dependent) variable in the Bluesky documents. For instance, if you were optimizing the
         value of an particular region of interest, you might set this to 'ROI1'.
         This parameter is registered to the REST server, and can be changed dynamically.
+    extra_keys : Sequence[str], optional
+        Names of other columns read along with the independent and target variables, such as 'variance'.
+        They are available from ``read_columns``.
+    snapshot_path : str, optional
+        File the agent state is saved to every ``snapshot_every`` tells and on stop, see cms_agents.snapshots.
+        On its first start the agent restores the state from this file, and is then told about the runs
+        started since the snapshot, and the new events of the reduced runs still open at the snapshot,
+        before it starts consuming Kafka. By default no snapshots are kept.
+    snapshot_key : str, optional
+        Campaign the snapshot belongs to, e.g. the proposal and cycle. A snapshot of another campaign is
+        not restored. By default None.
+    snapshot_every : int, optional
+        Number of tells between snapshots, by default 10.
+    warm_start : dict, optional
+        Keyword arguments of ``tell_history``, e.g. ``dict(since=time.time() - 86400)``. Without a snapshot
+        to restore, the agent is told about these past runs on its first start. By default None.
     """
 
-    def __init__(self, *args, independent_key: str, target_key: str, **kwargs):
+    # runs started this long before a snapshot may have been reduced after it
+    snapshot_catch_up_margin = 600.0
+
+    def __init__(
+        self,
+        *args,
+        independent_key: str,
+        target_key: str,
+        extra_keys: Sequence[str] = (),
+        snapshot_path: Optional[str] = None,
+        snapshot_key: Optional[str] = None,
+        snapshot_every: int = 10,
+        warm_start: Optional[dict] = None,
+        **kwargs,
+    ):
         self._independent_key = independent_key
         self._target_key = target_key
+        self.extra_keys = list(extra_keys)
+        self.snapshot_path = snapshot_path
+        self.snapshot_key = snapshot_key
+        self.snapshot_every = snapshot_every
+        self._tells_since_snapshot = 0
+        self._warm_start = warm_start
+        self._started = False
+        # events written before the agent run is started, see start
+        self._pending_events = []
+        # number of events told of each open reduced run, see _tell_stream_events
+        self._stream_rows = {}
+        self.column_cache = ColumnCache()
+        self.data_key_index = DataKeyIndex()
+        self.event_payloads = EventPayloads()
         super().__init__(*args, **kwargs)
+        # trigger_condition and unpack_run share each run node looked up in the catalog
+        self.exp_catalog = RunCache(self.exp_catalog)
 
     def measurement_plan(self, point: ArrayLike) -> Tuple[str, List, dict]:
         """Default measurement plan is a count on the pilatus, for a given num
@@ -50,8 +114,254 @@ class CMSBaseAgent(Agent, ABC):
         """
         return "count", [["pilatus2M"]], dict(num=point)
 
+    def trigger_condition(self, uid) -> bool:
+        """Tell on runs with both the independent and target keys, checked against the descriptor when seen."""
+        return self.data_key_index.has_keys(
+            uid,
+            [self.independent_key, self.target_key],
+            fallback=lambda: self.exp_catalog[uid].primary.data.keys(),
+        )
+
+    def _on_stop_router(self, name, doc):
+        self.data_key_index.on_document(name, doc)
+        self.column_cache.on_document(name, doc)
+        events = self.event_payloads.on_document(name, doc)
+        if events is not None:
+            run_start, rows = events
+            if self.event_payloads.start(run_start).get("reduced_stream"):
+                self._tell_stream_events(run_start, rows)
+            return
+        if name == "stop" and self.event_payloads.start(doc["run_start"]).get("reduced_stream"):
+            # every event of the run was told as it arrived
+            self._stream_rows.pop(doc["run_start"], None)
+            return
+        return super()._on_stop_router(name, doc)
+
+    def _write_event(self, stream, doc, uid=None):
+        if self._compose_run_bundle is None:
+            # written once the agent run is started, see start
+            self._pending_events.append((stream, doc, uid))
+            return None
+        return super()._write_event(stream, doc, uid=uid)
+
+    def _tell(self, uid):
+        if uid in self._stream_rows:
+            # a reduced run open at the snapshot, stopped now, only its events since the snapshot are new
+            self._tell_new_stream_rows(uid, stopped=True)
+            return
+        columns = self.event_payloads.columns(uid, [self.independent_key, self.target_key])
+        if columns is None:
+            # not seen on Kafka, or without the keys, read the run from Tiled
+            super()._tell(uid)
+            self._snapshot_if_due()
+            return
+        self._tell_columns(uid, columns)
+        self.event_payloads.discard(uid)
+
+    def _tell_columns(self, uid, columns, exp_uid=None):
+        logger.debug("Telling agent about new data from the event documents of %s.", uid)
+        doc = self.tell(columns[self.independent_key], columns[self.target_key])
+        doc["exp_uid"] = exp_uid or uid
+        self._write_event("tell", doc)
+        if uid not in self.tell_cache:
+            self.tell_cache.append(uid)
+        self._snapshot_if_due()
+
+    def _tell_stream_events(self, run_start, rows):
+        # the events are told as they arrive, their rows are not needed again
+        self.event_payloads.discard(run_start)
+        self._stream_rows[run_start] = self._stream_rows.get(run_start, 0) + len(rows)
+        keys = [self.independent_key, self.target_key]
+        rows = [row for row in rows if all(key in row for key in keys)]
+        if not rows:
+            return
+        logger.info("New events in reduced run %s, telling the agent about them", run_start)
+        for row in rows:
+            columns = {key: np.array([row[key]]) for key in keys}
+            # the reduced run is cached once, retelling it tells every event again
+            self._tell_columns(run_start, columns, exp_uid=row.get("raw_start_uid"))
+        if self.report_on_tell:
+            self.generate_report(**self.default_report_kwargs)
+        if self.ask_on_tell:
+            if self._direct_to_queue:
+                self.add_suggestions_to_queue(1)
+            else:
+                self.generate_suggestions_for_adjudicator(1)
+
+    def snapshot_state(self) -> Tuple[dict, dict]:
+        """State kept in snapshots, as JSON serializable metadata and arrays. Subclasses add to both."""
+        meta = dict(
+            agent_class=type(self).__name__,
+            campaign=self.snapshot_key,
+            independent_key=self.independent_key,
+            target_key=self.target_key,
+            tell_cache=list(self.tell_cache),
+            stream_rows=dict(self._stream_rows),
+        )
+        return meta, {}
+
+    def restore_state(self, meta: dict, arrays: dict):
+        """Restore the state returned by ``snapshot_state``."""
+        self.independent_key = meta["independent_key"]
+        self.target_key = meta["target_key"]
+        self.tell_cache = list(meta["tell_cache"])
+        self._stream_rows = dict(meta.get("stream_rows", {}))
+
+    def save_snapshot(self):
+        if self.snapshot_path is None:
+            return
+        meta, arrays = self.snapshot_state()
+        write_snapshot(self.snapshot_path, meta, arrays)
+        self._tells_since_snapshot = 0
+        logger.debug("Saved a snapshot of %d told runs to %s.", len(self.tell_cache), self.snapshot_path)
+
+    def _snapshot_if_due(self):
+        self._tells_since_snapshot += 1
+        if self._tells_since_snapshot >= self.snapshot_every:
+            self.save_snapshot()
+
+    def restore_snapshot(self) -> Optional[float]:
+        """Restore the state from the snapshot, returns the time it was written, or None if there is none."""
+        start = ttime.monotonic()
+        meta, arrays = read_snapshot(self.snapshot_path)
+        if meta is None:
+            return None
+        if meta["agent_class"] != type(self).__name__:
+            logger.warning("Ignoring the snapshot %s of a %s agent.", self.snapshot_path, meta["agent_class"])
+            return None
+        if meta.get("campaign") != self.snapshot_key:
+            logger.warning(
+                "Ignoring the snapshot %s of campaign %r, the agent is in campaign %r.",
+                self.snapshot_path,
+                meta.get("campaign"),
+                self.snapshot_key,
+            )
+            return None
+        self.restore_state(meta, arrays)
+        logger.info(
+            "Restored %d told runs from %s in %.3f s.",
+            len(self.tell_cache),
+            self.snapshot_path,
+            ttime.monotonic() - start,
+        )
+        return meta["written_at"]
+
+    def tell_history(
+        self, since=None, until=None, query=None, max_workers: int = 8, chunk_size: int = 256
+    ) -> int:
+        """
+        Tell the agent about past runs of the data catalog it was not told about, many runs at a time.
+
+        The independent, target and extra columns, e.g. 'variance', of the runs are read with
+        cms_agents.columns.iter_history, one request per run. A reduced run holding many events, see
+        cms_agents.documents.ReducedRunStream, is read in that one request. The observations of each
+        chunk of ``chunk_size`` runs are told in one ``tell_many`` call, and the uids of the runs are
+        recorded in one event of the 'tell_history' stream, so only one chunk is held in memory at a time.
+
+        Parameters
+        ----------
+        since, until : float, optional
+            Bounds of the start time of the runs, as Unix timestamps.
+        query : dict, optional
+            Required start document values, e.g. ``{"raw_start.experiment_alias_directory": path}``.
+        max_workers : int, optional
+            Number of runs read at once, by default 8.
+        chunk_size : int, optional
+            Number of runs told about at once, by default 256.
+
+        Returns
+        -------
+        count : int
+            Number of runs told about.
+        """
+        keys = [self.independent_key, self.target_key, *self.extra_keys]
+        chunks = iter_history(
+            self.exp_catalog.catalog,
+            self.read_columns,
+            keys,
+            since=since,
+            until=until,
+            query=query,
+            exclude=self.tell_cache,
+            max_workers=max_workers,
+            chunk_size=chunk_size,
+        )
+        count = 0
+        for uids, columns in chunks:
+            observations = len(columns[self.target_key])
+            logger.info("Telling the agent about %d observations from %d past runs.", observations, len(uids))
+            self.tell_many(columns[self.independent_key], columns[self.target_key])
+            self.tell_cache.extend(uids)
+            self._write_event(
+                "tell_history", dict(exp_uids=uids, observations=observations, cache_len=len(self.tell_cache))
+            )
+            count += len(uids)
+        if not count:
+            logger.info("No past runs to tell the agent about.")
+        return count
+
+    def _tell_new_stream_rows(self, uid, stopped=False):
+        """Tell the events added to an open reduced run since they were last told, read in one request."""
+        told = self._stream_rows.pop(uid)
+        run = self.exp_catalog[uid]
+        try:
+            columns = self.read_columns(run)
+        except KeyError as ex:
+            logger.warning("Ignoring key error in reading the reduced run %s:\n %s", uid, ex)
+            return
+        new = {key: value[told:] for key, value in columns.items()}
+        if not stopped and run.metadata.get("stop") is None:
+            self._stream_rows[uid] = told + len(new[self.target_key])
+        observations = len(new[self.target_key])
+        if not observations:
+            return
+        logger.info("Telling the agent about %d new events of reduced run %s.", observations, uid)
+        # one observation per event, as the events are told when they arrive on Kafka
+        self.tell_many(new[self.independent_key], new[self.target_key])
+        if uid not in self.tell_cache:
+            self.tell_cache.append(uid)
+        self._write_event(
+            "tell_history", dict(exp_uids=[uid], observations=observations, cache_len=len(self.tell_cache))
+        )
+        self._snapshot_if_due()
+
+    def catch_up(self, since: float):
+        """Tell the agent about the runs started since ``since`` and the new events of open reduced runs."""
+        logger.info("Catching up on the runs started since the snapshot.")
+        for uid in list(self._stream_rows):
+            self._tell_new_stream_rows(uid)
+        self.tell_history(since=since)
+        self.save_snapshot()
+
+    def start(self, *args, **kwargs):
+        first_start, self._started = not self._started, True
+        written_at = None
+        if first_start and self.snapshot_path is not None:
+            # only on the first start, close_and_restart may have cleared the state on purpose
+            written_at = self.restore_snapshot()
+        # before the Kafka consumer starts, so these tells never run concurrently with those of new runs
+        if written_at is not None:
+            self.catch_up(written_at - self.snapshot_catch_up_margin)
+        elif first_start and self._warm_start is not None:
+            self.tell_history(**self._warm_start)
+            self.save_snapshot()
+        super().start(*args, **kwargs)
+        # the events of the tells above go to the agent run started just now
+        pending, self._pending_events = self._pending_events, []
+        for stream, doc, uid in pending:
+            self._write_event(stream, doc, uid=uid)
+
+    def stop(self, *args, **kwargs):
+        self.save_snapshot()
+        return super().stop(*args, **kwargs)
+
+    def read_columns(self, run) -> dict:
+        """Independent, target and extra columns of a run, fetched in one request and cached by uid."""
+        return self.column_cache.read(run, [self.independent_key, self.target_key, *self.extra_keys])
+
     def unpack_run(self, run) -> Tuple[Union[float, ArrayLike], Union[float, ArrayLike]]:
-        return np.array(run.primary.data[self.independent_key]), np.array(run.primary.data[self.target_key])
+        columns = self.read_columns(run)
+        return columns[self.independent_key], columns[self.target_key]
 
     @property
     def independent_key(self):
@@ -98,15 +408,16 @@ class CMSBaseAgent(Agent, ABC):
             producer_config=kafka_config["runengine_producer_config"],
         )
 
+        # data and agent documents both live in the sandbox, share one client and its connection pool
+        sandbox_node = get_client_from_uri(
+            f"https://tiled.nsls2.bnl.gov/api/v1/node/metadata/{beamline_tla}/bluesky_sandbox"
+        )
+
         return dict(
             kafka_consumer=kafka_consumer,
             kafka_producer=kafka_producer,
-            tiled_data_node=tiled.client.from_uri(
-                f"https://tiled.nsls2.bnl.gov/api/v1/node/metadata/{beamline_tla}/bluesky_sandbox"
-            ),
-            tiled_agent_node=tiled.client.from_uri(
-                f"https://tiled.nsls2.bnl.gov/api/v1/node/metadata/{beamline_tla}/bluesky_sandbox"
-            ),
+            tiled_data_node=sandbox_node,
+            tiled_agent_node=sandbox_node,
             qserver=qs,
         )
 
@@ -145,15 +456,60 @@ class CMSSequentialAgent(CMSBaseAgent, SequentialAgentBase):
         _default_kwargs.update(kwargs)
         super().__init__(sequence=sequence, relative_bounds=relative_bounds, **_default_kwargs)
 
+    def snapshot_state(self) -> Tuple[dict, dict]:
+        meta, arrays = super().snapshot_state()
+        meta["ask_count"] = self.ask_count
+        arrays["independent"], arrays["independent_lengths"] = pack_arrays(self.independent_cache)
+        arrays["observable"], arrays["observable_lengths"] = pack_arrays(self.observable_cache)
+        return meta, arrays
+
+    def restore_state(self, meta: dict, arrays: dict):
+        super().restore_state(meta, arrays)
+        self.independent_cache = unpack_arrays(arrays["independent"], arrays["independent_lengths"])
+        self.observable_cache = unpack_arrays(arrays["observable"], arrays["observable_lengths"])
+        self.ask_count = meta["ask_count"]
+        # every ask took the next point of the sequence
+        self._position_generator = self._create_position_generator()
+        for _ in itertools.islice(self._position_generator, self.ask_count):
+            pass
+
 
 class CMSSingleTaskAgent(CMSBaseAgent, SingleTaskGPAgentBase):
-    def __init__(self, *, bounds: ArrayLike, **kwargs):
+    def __init__(
+        self,
+        *,
+        bounds: ArrayLike,
+        incremental: bool = False,
+        refit_every: int = 10,
+        mll_tolerance: float = 0.5,
+        grid_acquisition: bool = True,
+        grid_points: int = 4096,
+        **kwargs,
+    ):
         """Single Task GP based Bayesian Optimization
 
         Parameters
         ----------
         bounds : ArrayLike
             A `2 x d` tensor of lower and upper bounds for each column of independent vars
+        incremental : bool, optional
+            Keep the Cholesky factor of the GP between tells and extend it with each new observation,
+            and refit the hyperparameters only every ``refit_every`` tells or when the marginal likelihood
+            drifts, instead of on every report and ask. Reports and asks use a copy of the GP whose
+            prediction caches are extended for each new observation, see cms_agents.surrogate.
+            By default False.
+        refit_every : int, optional
+            In incremental mode, number of tells between hyperparameter fits, by default 10.
+        mll_tolerance : float, optional
+            In incremental mode, drop of the marginal log likelihood per observation since the last fit
+            that triggers an early fit, by default 0.5.
+        grid_acquisition : bool, optional
+            For bounds of at most three dimensions, optimize the acquisition function on a dense grid
+            refined around its best cells, and select batches by greedy fantasization, see
+            cms_agents.acquisition.GridAcquisition. Otherwise ``optimize_acqf`` is used, and batches are
+            reduced to one point. By default True.
+        grid_points : int, optional
+            Size of the acquisition grid, by default 4096.
 
         Examples
         --------
@@ -166,3 +522,114 @@ class CMSSingleTaskAgent(CMSBaseAgent, SingleTaskGPAgentBase):
         _default_kwargs = self.get_beamline_objects()
         _default_kwargs.update(kwargs)
         super().__init__(bounds=bounds, **_default_kwargs)
+        self.surrogate = None
+        if incremental:
+            self.surrogate = IncrementalGP(
+                self.surrogate_model, refit_every=refit_every, mll_tolerance=mll_tolerance
+            )
+        self.grid_acquisition = None
+        if grid_acquisition and self.bounds.shape[-1] <= GridAcquisition.MAX_DIM:
+            self.grid_acquisition = GridAcquisition(self.bounds.cpu(), max_points=grid_points)
+
+    def tell(self, x, y):
+        doc = super().tell(x, y)
+        if self.surrogate is not None:
+            self.surrogate.update()
+        return doc
+
+    def tell_many(self, xs, ys):
+        """Tell the model about every observation in one update, the rows of ``xs`` are the points."""
+        ys = np.ravel(ys)
+        return [self.tell(np.reshape(xs, (len(ys), -1)), ys)]
+
+    def fit(self):
+        """Fit the GP hyperparameters, in incremental mode only when due.
+
+        The fit starts from the current hyperparameters, so a refit after a few tells converges quickly.
+        """
+        if self.surrogate is None:
+            fit_gpytorch_mll(self.mll)
+        elif self.surrogate.refit_due():
+            logger.debug("Refitting the GP hyperparameters on %d observations.", len(self.surrogate))
+            fit_gpytorch_mll(self.mll)
+            self.surrogate.fitted()
+        self.surrogate_model.eval()
+
+    def _prediction_model(self):
+        if self.surrogate is None:
+            return self.surrogate_model
+        return self.surrogate.prediction_model()
+
+    def snapshot_state(self) -> Tuple[dict, dict]:
+        meta, arrays = super().snapshot_state()
+        if self.inputs is not None:
+            arrays["inputs"] = self.inputs.cpu().numpy()
+            arrays["targets"] = self.targets.cpu().numpy()
+        for key, value in self.surrogate_model.state_dict().items():
+            arrays[f"gp.{key}"] = value.detach().cpu().numpy()
+        return meta, arrays
+
+    def restore_state(self, meta: dict, arrays: dict):
+        super().restore_state(meta, arrays)
+        # loading the state dict transforms the training targets, set them afterwards as tell does
+        state = {key[3:]: torch.tensor(value) for key, value in arrays.items() if key.startswith("gp.")}
+        self.surrogate_model.load_state_dict(state)
+        if "inputs" in arrays:
+            self.inputs = torch.tensor(arrays["inputs"], device=self.device)
+            self.targets = torch.tensor(arrays["targets"], device=self.device)
+            self.surrogate_model.set_train_data(self.inputs, self.targets, strict=False)
+        self.surrogate_model.eval()
+        if self.surrogate is not None and self.inputs is not None:
+            # the hyperparameters were fit to these observations, or close to them
+            self.surrogate.fitted()
+
+    @staticmethod
+    def _acqf_state(acqf) -> dict:
+        return {
+            "STATEDICT-" + ":".join(key.split(".")): val.detach().cpu().numpy()
+            for key, val in acqf.state_dict().items()
+        }
+
+    def report(self):
+        """Fit GP if due, and construct acquisition function.
+        Document retains state dictionary.
+        """
+        self.fit()
+        acqf = self._partial_acqf(self._prediction_model())
+        return dict(latest_data=self.tell_cache[-1], cache_len=self.inputs.shape[0], **self._acqf_state(acqf))
+
+    def ask(self, batch_size=1):
+        """Fit GP if due, optimize acquisition function, and return next points.
+        Documents retain candidate, acquisition values, and state dictionary, one per point.
+        """
+        self.fit()
+        model = self._prediction_model()
+        if self.grid_acquisition is not None:
+            candidates, acq_values = self.grid_acquisition.select(model, self._partial_acqf, batch_size)
+            candidates = candidates.to(self.device)
+        else:
+            if batch_size > 1:
+                logger.warning(f"Batch size greater than 1 is not implemented. Reducing {batch_size} to 1.")
+                batch_size = 1
+            acqf = self._partial_acqf(model)
+            acqf.to(self.device)
+            candidates, acq_value = optimize_acqf(
+                acq_function=acqf,
+                bounds=self.bounds,
+                q=batch_size,
+                num_restarts=self.num_restarts,
+                raw_samples=self.raw_samples,
+            )
+            acq_values = acq_value.reshape(1)
+        state = self._acqf_state(self._partial_acqf(model))
+        docs = [
+            dict(
+                candidate=candidate.detach().cpu().numpy(),
+                acquisition_value=acq_value.detach().cpu().numpy(),
+                latest_data=self.tell_cache[-1],
+                cache_len=self.inputs.shape[0],
+                **state,
+            )
+            for candidate, acq_value in zip(torch.atleast_2d(candidates), acq_values)
+        ]
+        return docs, torch.atleast_2d(candidates).detach().cpu().numpy().tolist()
@@ -0,0 +1,336 @@
+"""Reduce runs already in Tiled, in parallel, without replaying them through Kafka.
+
+Runs are selected by scan id ranges, uids or metadata, resolved with a few bulk
+searches, and reduced by a pool of worker processes, in groups of runs whose
+circular_average_q2I_fit curves are fit together. Results are written in
+batches, either to the sandbox catalog as reduced runs or to a local Parquet or
+HDF5 table. The uid of every written run is appended to a journal, so an
+interrupted batch picks up where it stopped when it is started again::
+
+    cms-batch-reduce --scan-ids 1200-1350,1402 --output reduced.parquet
+    cms-batch-reduce --query sample_name=PS-b-PMMA --output sandbox
+"""
+import argparse
+import concurrent.futures
+import functools
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from tiled.queries import Key
+
+from cms_agents.documents import LOG_FORMAT, publish_reduced_documents
+from cms_agents.readiness import wait_for_file
+from cms_agents.tiled_access import RunCache, get_client
+
+logger = logging.getLogger("cms_agents.batch_reduce")
+
+
+def parse_scan_ids(text: str):
+    """
+    Parse scan ids such as "1200-1350,1402" into inclusive (first, last) ranges.
+    """
+    ranges = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        ranges.append((int(first), int(last or first)))
+    return ranges
+
+
+def parse_query(items):
+    """
+    Parse "key=value" strings into a dict of start document values, values are decoded as JSON if possible.
+    """
+    query = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        try:
+            query[key] = json.loads(value)
+        except ValueError:
+            query[key] = value
+    return query
+
+
+def find_runs(catalog, scan_ranges=(), uids=(), query=None) -> dict:
+    """
+    Resolve the selected runs with bulk searches.
+
+    Parameters
+    ----------
+    catalog : tiled.client.node.Node
+        Catalog of raw Bluesky runs.
+    scan_ranges : list of (int, int)
+        Inclusive scan id ranges.
+    uids : list of str
+        Run start uids.
+    query : dict, optional
+        Required start document values, applied to the runs selected by
+        ``scan_ranges`` or, if neither ``scan_ranges`` nor ``uids`` is given, to the whole catalog.
+
+    Returns
+    -------
+    starts : dict
+        Start documents keyed by uid, ordered by scan id.
+    """
+    searches = []
+    for first, last in scan_ranges:
+        searches.append(catalog.search(Key("start.scan_id") >= first).search(Key("start.scan_id") <= last))
+    if query and not scan_ranges and not uids:
+        searches.append(catalog)
+    for i, results in enumerate(searches):
+        for key, value in (query or {}).items():
+            results = results.search(Key(f"start.{key}") == value)
+        searches[i] = results
+
+    starts = {}
+    for results in searches:
+        for uid, run in results.items():
+            starts[uid] = run.metadata["start"]
+    if uids:
+        for uid, run in RunCache(catalog).prefetch(uids).items():
+            starts[uid] = run.metadata["start"]
+    missing = set(uids) - set(starts)
+    if missing:
+        logger.warning("%d uids not found: %s", len(missing), ", ".join(sorted(missing)))
+    return dict(sorted(starts.items(), key=lambda item: item[1].get("scan_id", 0)))
+
+
+class Journal:
+    """Append-only record of the uids whose results were written."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done.update(line.strip() for line in f if line.strip())
+
+    def record(self, uids):
+        with open(self.path, "a") as f:
+            f.writelines(f"{uid}\n" for uid in uids)
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(uids)
+
+
+class TableOutput:
+    """Write results as rows of a table, one row per run, one part per batch.
+
+    ``*.parquet`` paths are written as a directory of Parquet files, which
+    ``pandas.read_parquet`` reads back as one table. ``*.h5`` and ``*.hdf5`` paths
+    get one ``part_<n>`` table per batch. Both need pandas, and pyarrow or PyTables.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hdf5 = path.endswith((".h5", ".hdf5"))
+        if not self.hdf5:
+            os.makedirs(path, exist_ok=True)
+        self._parts = self._existing_parts()
+
+    def _existing_parts(self) -> int:
+        if self.hdf5:
+            if not os.path.exists(self.path):
+                return 0
+            import pandas as pd
+
+            with pd.HDFStore(self.path, mode="r") as store:
+                return len(store.keys())
+        return len([name for name in os.listdir(self.path) if name.endswith(".parquet")])
+
+    def write(self, results):
+        import pandas as pd
+
+        rows = []
+        for uid, reduced, metadata in results:
+            row = dict(raw_start_uid=uid, scan_id=metadata["raw_start"].get("scan_id"))
+            row.update(reduced)
+            rows.append(row)
+        frame = pd.DataFrame(rows)
+        if self.hdf5:
+            frame.to_hdf(self.path, key=f"part_{self._parts:05d}", mode="a", format="table")
+        else:
+            # write under a temporary name, so a partial part is never read back as a result
+            part = os.path.join(self.path, f"part-{self._parts:05d}.parquet")
+            frame.to_parquet(part + ".tmp")
+            os.replace(part + ".tmp", part)
+        self._parts += 1
+
+
+class SandboxOutput:
+    """Insert results into a Tiled catalog as reduced runs, one batch at a time."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def write(self, results):
+        for _, reduced, metadata in results:
+            publish_reduced_documents(reduced, metadata, self.client.v1.insert)
+
+
+def reduce_starts(start_docs, file_timeout=2.0):
+    """
+    Reduce a group of runs from their start documents, runs in the worker processes.
+
+    Every run of the campaign shares the detector geometry, and with it the integration
+    plan, so the q^n I(q) peaks of the group are fit in one batch, see reduce_runs.
+
+    Returns
+    -------
+    results : list of (uid, reduced, metadata)
+    failed : list of (uid, exception)
+    """
+    # imported here, setting up SciAnalysis is only needed, and only possible, where reductions run
+    from cms_agents.scianalysis_agent import StartDocumentRun, raw_tiff_path, reduce_runs
+
+    ready, failed = [], []
+    for start_doc in start_docs:
+        try:
+            # the files of past runs are complete, unless they are still being copied
+            wait_for_file(raw_tiff_path(start_doc), timeout=file_timeout)
+        except (OSError, TimeoutError) as ex:
+            failed.append((start_doc["uid"], ex))
+            continue
+        ready.append(start_doc)
+    results = []
+    for start_doc, result in zip(ready, reduce_runs([StartDocumentRun(start_doc) for start_doc in ready])):
+        if isinstance(result, Exception):
+            failed.append((start_doc["uid"], result))
+        else:
+            results.append((start_doc["uid"], *result))
+    return results, failed
+
+
+def batch_reduce(
+    starts, output, journal, num_workers=None, batch_size=64, group_size=16, reduce=reduce_starts
+):
+    """
+    Reduce runs in parallel and write the results in batches.
+
+    Parameters
+    ----------
+    starts : dict
+        Start documents keyed by uid, runs already in ``journal`` are skipped.
+    output : TableOutput or SandboxOutput
+    journal : Journal
+    num_workers : int, optional
+        Number of worker processes, by default one per core.
+    batch_size : int, optional
+        Number of results written at a time, by default 64.
+    group_size : int, optional
+        Number of runs reduced by one task, their peaks are fit together, by default 16.
+    reduce : callable, optional
+        Called with a list of start documents, returns (results, failed) as reduce_starts.
+
+    Returns
+    -------
+    written, failed : int
+    """
+    todo = [start for uid, start in starts.items() if uid not in journal.done]
+    logger.info("reducing %d runs, %d already done", len(todo), len(starts) - len(todo))
+    written = failed = 0
+    batch = []
+
+    def flush():
+        nonlocal written
+        if batch:
+            output.write(batch)
+            journal.record([uid for uid, _, _ in batch])
+            written += len(batch)
+            logger.info("wrote %d of %d runs", written, len(todo))
+            batch.clear()
+
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        groups = [todo[i : i + group_size] for i in range(0, len(todo), group_size)]
+        futures = {executor.submit(reduce, group): group for group in groups}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results, group_failed = future.result()
+            except Exception:
+                group = futures[future]
+                failed += len(group)
+                logger.exception("failed to reduce %d runs from run_start id %s", len(group), group[0]["uid"])
+                continue
+            for uid, ex in group_failed:
+                failed += 1
+                logger.error("failed to reduce run_start id %s: %s", uid, ex)
+            for result in results:
+                batch.append(result)
+                if len(batch) >= batch_size:
+                    flush()
+    flush()
+    return written, failed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+
+    parser.add_argument("--scan-ids", default="", help='scan id ranges, e.g. "1200-1350,1402"')
+    parser.add_argument("--uids", nargs="*", default=[], help="run start uids")
+    parser.add_argument("--uid-file", default=None, help="file with one run start uid per line")
+    parser.add_argument(
+        "--query",
+        nargs="*",
+        default=[],
+        help='required start document values, e.g. sample_name=PS-b-PMMA "exposure_time=10.0"',
+    )
+    parser.add_argument("--catalog", default="cms", help="Tiled profile of the raw runs")
+    parser.add_argument(
+        "--output",
+        required=True,
+        help='"sandbox" for the cms_bluesky_sandbox catalog, or a *.parquet or *.h5 path',
+    )
+    parser.add_argument("--journal", default=None, help="record of written runs, by default <output>.done")
+    parser.add_argument("--num-workers", default=None, type=int, help="worker processes, by default one per core")
+    parser.add_argument("--batch-size", default=64, type=int, help="results written at a time")
+    parser.add_argument("--group-size", default=16, type=int, help="runs whose peaks are fit together")
+    parser.add_argument(
+        "--file-timeout", default=2.0, type=float, help="seconds to wait for an incomplete detector file"
+    )
+    parser.add_argument("--log-level", default="INFO", help="logging level")
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=args.log_level.upper(), format=LOG_FORMAT)
+
+    uids = list(args.uids)
+    if args.uid_file:
+        with open(args.uid_file) as f:
+            uids.extend(line.strip() for line in f if line.strip())
+    scan_ranges = parse_scan_ids(args.scan_ids)
+    query = parse_query(args.query)
+    if not (scan_ranges or uids or query):
+        raise SystemExit("select runs with --scan-ids, --uids, --uid-file or --query")
+
+    starts = find_runs(get_client(args.catalog), scan_ranges, uids, query)
+    if args.output == "sandbox":
+        output = SandboxOutput(get_client("cms_bluesky_sandbox"))
+    else:
+        output = TableOutput(args.output)
+    journal = Journal(args.journal or f"{args.output}.done")
+
+    # set up SciAnalysis before the workers are forked, so each worker does not repeat it
+    import cms_agents.scianalysis_agent  # noqa: F401
+
+    written, failed = batch_reduce(
+        starts,
+        output,
+        journal,
+        num_workers=args.num_workers,
+        batch_size=args.batch_size,
+        group_size=args.group_size,
+        reduce=functools.partial(reduce_starts, file_timeout=args.file_timeout),
+    )
+    logger.info("wrote %d runs, %d failed", written, failed)
+
+
+if __name__ == "__main__":
+    main()
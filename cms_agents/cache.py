@@ -0,0 +1,102 @@
+"""Persistent cache of reduction results keyed by raw run and reduction configuration.
+
+Each entry is one pickle file whose name is a hash of the raw run uid and a
+fingerprint of everything the reduction depends on, so changing a protocol
+argument, a metadata pattern, the calibration or the mask starts a fresh set of
+entries without invalidating anything by hand. Least recently used entries are
+removed once the cache grows past its size limit.
+"""
+import hashlib
+import json
+import os
+import pickle
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cms_agents", "reductions")
+
+
+def config_fingerprint(*parts) -> str:
+    """Hash of JSON-like configuration, with anything not serializable hashed by its repr."""
+    text = json.dumps(parts, sort_keys=True, default=repr)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+class ReductionCache:
+    """Cache of (reduced, metadata) pairs on the local filesystem.
+
+    Parameters
+    ----------
+    config_hash : str
+        Fingerprint of the reduction configuration, see ``config_fingerprint``.
+    cache_dir : str, optional
+        Directory holding the entries, shared safely between processes.
+    max_bytes : int, optional
+        Size limit of the cache directory, by default 1 GB.
+    """
+
+    suffix = ".pkl"
+
+    def __init__(self, config_hash: str, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = 1 << 30):
+        self.config_hash = config_hash
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, uid: str) -> str:
+        key = hashlib.sha256(f"{uid}:{self.config_hash}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, uid: str):
+        """
+        Look up the reduction of a raw run.
+
+        Returns
+        -------
+        entry : Tuple[dict, dict] or None
+            The cached (reduced, metadata), or None on a miss.
+        """
+        path = self._path(uid)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError):
+            # treat unreadable entries as misses, they are overwritten by the next put
+            return None
+        # mark as recently used for eviction
+        os.utime(path)
+        return entry
+
+    def put(self, uid: str, reduced: dict, metadata: dict):
+        path = self._path(uid)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((reduced, metadata), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def size(self) -> int:
+        return sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(self.suffix):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, stat.st_mtime, stat.st_size
+
+    def evict(self):
+        """Remove least recently used entries until the cache is under ``max_bytes``."""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
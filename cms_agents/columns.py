@@ -0,0 +1,366 @@
+"""Cached reads of the primary stream columns of runs, for the agents.
+
+``ColumnCache.read`` fetches every requested column of a run in a single Tiled
+request, ``run.primary.data.read(variables=keys)``, which Tiled serves as one
+table, instead of one request per column. The columns are kept per uid. A run
+that has stopped cannot change, so it is never read again; for a run that is
+still open, e.g. a long-lived reduced run, the next read fetches only the rows
+added since the previous one, as a slice of each column. Whether a run has
+stopped is taken from its metadata or, since cached run nodes keep the metadata
+they were fetched with, from the stop document seen on Kafka, see
+``ColumnCache.on_document``.
+
+``iter_history`` and ``read_history`` collect these columns across every past run
+matching a search, to tell an agent about many of them at once.
+"""
+import collections
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from tiled.queries import Key
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnCache:
+    """LRU cache of primary stream columns keyed by run uid.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Number of runs kept, by default 128. As many stop documents are remembered.
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._runs = collections.OrderedDict()
+        self._stops = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def _get(self, uid):
+        with self._lock:
+            entry = self._runs.get(uid)
+            if entry is not None:
+                self._runs.move_to_end(uid)
+            return entry
+
+    def _put(self, uid, entry):
+        with self._lock:
+            self._runs[uid] = entry
+            self._runs.move_to_end(uid)
+            while len(self._runs) > self.maxsize:
+                self._runs.popitem(last=False)
+
+    def _read_all(self, data, keys):
+        self.requests += 1
+        dataset = data.read(variables=list(keys))
+        return {key: np.asarray(dataset[key]) for key in keys}
+
+    def _read_new_rows(self, data, columns, keys):
+        # only the rows past those already read are transferred, one sliced request per column
+        rows = len(columns[keys[0]])
+        self.requests += 1
+        first = np.asarray(data[keys[0]][rows:])
+        if not len(first):
+            return columns
+        # rows added after the first column was read are left to the next read
+        end = rows + len(first)
+        new = {keys[0]: first}
+        for key in keys[1:]:
+            self.requests += 1
+            new[key] = np.asarray(data[key][rows:end])
+        return {key: np.concatenate([columns[key], new[key]]) for key in keys}
+
+    def on_document(self, name, doc):
+        """Record which runs have stopped, subscribe this to the document stream."""
+        if name == "stop":
+            with self._lock:
+                self._stops[doc["run_start"]] = True
+                while len(self._stops) > self.maxsize:
+                    self._stops.popitem(last=False)
+
+    def read(self, run, keys) -> dict:
+        """
+        Columns ``keys`` of the primary stream of ``run``.
+
+        Parameters
+        ----------
+        run : BlueskyRun
+            Tiled run node, its uid is taken from the start document.
+        keys : Sequence[str]
+            Names of the columns.
+
+        Returns
+        -------
+        columns : dict
+            Arrays keyed by column name.
+
+        Raises
+        ------
+        KeyError
+            If a column is missing from the run.
+        """
+        keys = list(dict.fromkeys(keys))
+        uid = run.metadata["start"]["uid"]
+        with self._lock:
+            stopped = uid in self._stops
+        # taken before reading, the rows read after a stop are final
+        stopped = stopped or run.metadata.get("stop") is not None
+        entry = self._get(uid)
+        if entry is not None and all(key in entry["columns"] for key in keys):
+            if entry["stopped"]:
+                return {key: entry["columns"][key] for key in keys}
+            # refresh every cached column, so they stay the same length
+            columns = self._read_new_rows(run.primary.data, entry["columns"], list(entry["columns"]))
+        else:
+            # new columns are read together with those already cached, still in one request
+            cached_keys = list(entry["columns"]) if entry is not None else []
+            columns = self._read_all(run.primary.data, list(dict.fromkeys(cached_keys + keys)))
+        self._put(uid, dict(columns=columns, stopped=stopped))
+        return {key: columns[key] for key in keys}
+
+    def invalidate(self, uid=None):
+        """Forget one run, or every run if ``uid`` is None."""
+        with self._lock:
+            if uid is None:
+                self._runs.clear()
+            else:
+                self._runs.pop(uid, None)
+
+
+class DataKeyIndex:
+    """Data keys of the primary stream of recent runs, recorded from their descriptor documents.
+
+    Checking whether a run has the keys an agent needs is then a set lookup. For runs
+    whose descriptor was not seen, e.g. from before the agent started, the keys are
+    looked up with a fallback and recorded, unless none were found yet, e.g. for a run
+    whose descriptor is not written yet.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Number of runs kept, by default 1024.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, uid, keys):
+        with self._lock:
+            known = self._keys.setdefault(uid, set())
+            known.update(keys)
+            self._keys.move_to_end(uid)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+    def on_document(self, name, doc):
+        """Record the data keys of primary stream descriptors, subscribe this to the document stream."""
+        if name == "descriptor" and doc.get("name") == "primary":
+            self.record(doc["run_start"], doc["data_keys"])
+
+    def keys(self, uid, fallback=None):
+        """
+        Data keys of a run, from its descriptor or, if it was not seen, ``fallback()``.
+
+        Returns
+        -------
+        keys : set or None
+            None if the run is unknown and there is no fallback.
+        """
+        with self._lock:
+            keys = self._keys.get(uid)
+            if keys is not None:
+                return keys
+        if fallback is None:
+            return None
+        keys = set(fallback())
+        if keys:
+            self.record(uid, keys)
+        return keys
+
+    def has_keys(self, uid, keys, fallback=None) -> bool:
+        known = self.keys(uid, fallback)
+        return known is not None and all(key in known for key in keys)
+
+
+class EventPayloads:
+    """Data of the primary events of recent runs, collected from the documents seen on Kafka.
+
+    The reducer publishes the values the agents tell on inside its event documents,
+    so they can be used as they arrive instead of being read back from Tiled. The rows
+    of a run are dropped once it is told, see ``discard``, or once it has more than
+    ``max_rows`` events; its columns are then read from Tiled if needed again.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Number of runs kept, by default 256.
+    max_rows : int, optional
+        Number of event rows kept per run, by default 1024.
+    """
+
+    def __init__(self, maxsize: int = 256, max_rows: int = 1024):
+        self.maxsize = maxsize
+        self.max_rows = max_rows
+        self._starts = collections.OrderedDict()
+        self._descriptors = {}
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def on_document(self, name, doc):
+        """
+        Record a document, subscribe this to the document stream.
+
+        Returns
+        -------
+        rows : tuple or None
+            (run_start uid, list of event data dicts) for primary events and event pages, otherwise None.
+        """
+        with self._lock:
+            if name == "start":
+                self._starts[doc["uid"]] = doc
+                self._rows[doc["uid"]] = []
+                while len(self._starts) > self.maxsize:
+                    uid, _ = self._starts.popitem(last=False)
+                    self._rows.pop(uid, None)
+                    self._descriptors = {k: v for k, v in self._descriptors.items() if v != uid}
+            elif name == "descriptor" and doc.get("name") == "primary" and doc["run_start"] in self._starts:
+                self._descriptors[doc["uid"]] = doc["run_start"]
+            elif name in ("event", "event_page") and doc["descriptor"] in self._descriptors:
+                run_start = self._descriptors[doc["descriptor"]]
+                if name == "event":
+                    rows = [doc["data"]]
+                else:
+                    rows = [dict(zip(doc["data"], values)) for values in zip(*doc["data"].values())]
+                kept = self._rows.get(run_start)
+                if kept is not None:
+                    kept.extend(rows)
+                    if len(kept) > self.max_rows:
+                        self._rows[run_start] = None
+                return run_start, rows
+        return None
+
+    def start(self, uid) -> dict:
+        """Start document of a recent run, or an empty dict."""
+        with self._lock:
+            return self._starts.get(uid, {})
+
+    def columns(self, uid, keys):
+        """
+        Columns ``keys`` of the primary events seen for a run.
+
+        Returns
+        -------
+        columns : dict or None
+            Arrays keyed by column name, None if no event was seen or kept, or a key is missing from one.
+        """
+        with self._lock:
+            rows = list(self._rows.get(uid) or ())
+        if not rows or not all(key in row for row in rows for key in keys):
+            return None
+        return {key: np.array([row[key] for row in rows]) for key in keys}
+
+    def discard(self, uid):
+        """Drop the rows of a run, e.g. once they are told, the start document is kept."""
+        with self._lock:
+            if uid in self._rows:
+                self._rows[uid] = None
+
+
+def iter_history(
+    catalog, read, keys, since=None, until=None, query=None, exclude=(), max_workers=8, chunk_size=256
+):
+    """
+    Columns of the past runs of a catalog, concatenated across runs, in chunks of ``chunk_size`` runs.
+
+    The runs are found with one search, listed page by page, and read concurrently with
+    ``read(run)``, e.g. ``ColumnCache.read``, which fetches all columns of a run in one request.
+    Runs started by an agent, and runs whose columns cannot be read, are skipped. Only one chunk
+    of runs is listed and read at a time.
+
+    Parameters
+    ----------
+    catalog : tiled.client.node.Node
+        Catalog of reduced runs.
+    read : callable
+        Called as ``read(run)``, returns the columns of a run keyed by name.
+    keys : Sequence[str]
+        Names of the columns concatenated.
+    since, until : float, optional
+        Bounds of the start time of the runs, as Unix timestamps.
+    query : dict, optional
+        Required start document values, keyed by their path in the start document, e.g.
+        ``{"raw_start.experiment_alias_directory": path}``.
+    exclude : Collection[str], optional
+        Uids of runs to skip, e.g. those already told.
+    max_workers : int, optional
+        Number of runs read at once, by default 8.
+    chunk_size : int, optional
+        Number of runs listed per chunk, by default 256.
+
+    Yields
+    ------
+    uids : list
+        Uids of the runs read in the chunk, in the order of the catalog.
+    columns : dict
+        Arrays keyed by column name. Chunks without any run read are skipped.
+    """
+    results = catalog
+    if since is not None:
+        results = results.search(Key("start.time") >= since)
+    if until is not None:
+        results = results.search(Key("start.time") <= until)
+    for key, value in (query or {}).items():
+        results = results.search(Key(f"start.{key}") == value)
+    exclude = set(exclude)
+    runs = (
+        (uid, run)
+        for uid, run in results.items()
+        if uid not in exclude and "agent_name" not in run.metadata["start"]
+    )
+
+    def read_run(item):
+        uid, run = item
+        try:
+            return uid, read(run)
+        except Exception as ex:
+            logger.debug("Skipping run %s, its columns could not be read: %r", uid, ex)
+            return uid, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            chunk = list(itertools.islice(runs, chunk_size))
+            if not chunk:
+                return
+            read_runs = [(uid, columns) for uid, columns in executor.map(read_run, chunk) if columns is not None]
+            if not read_runs:
+                continue
+            columns = {
+                key: np.concatenate([np.atleast_1d(run_columns[key]) for _, run_columns in read_runs])
+                for key in keys
+            }
+            yield [uid for uid, _ in read_runs], columns
+
+
+def read_history(catalog, read, keys, since=None, until=None, query=None, exclude=(), max_workers=8):
+    """
+    Columns of the past runs of a catalog, concatenated across runs, see ``iter_history``.
+
+    Returns
+    -------
+    uids : list
+        Uids of the runs read, in the order of the catalog.
+    columns : dict
+        Arrays keyed by column name, empty if no run was read.
+    """
+    chunks = list(iter_history(catalog, read, keys, since, until, query, exclude, max_workers))
+    if not chunks:
+        return [], {}
+    uids = [uid for chunk_uids, _ in chunks for uid in chunk_uids]
+    return uids, {key: np.concatenate([columns[key] for _, columns in chunks]) for key in keys}
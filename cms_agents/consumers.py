@@ -0,0 +1,123 @@
+"""Kafka consumer helpers for the reducers."""
+import collections
+import logging
+import threading
+
+import msgpack
+from bluesky_kafka import RemoteDispatcher
+
+logger = logging.getLogger(__name__)
+
+# msgpack type bytes, see https://github.com/msgpack/msgpack/blob/master/spec.md
+_FIXARRAY_2 = 0x92
+_FIXSTR_MIN, _FIXSTR_MAX = 0xA0, 0xBF
+_STR8 = 0xD9
+
+
+def peek_document_name(message: bytes) -> str:
+    """
+    Read the document name from a msgpack encoded (name, doc) message without decoding the document.
+
+    Parameters
+    ----------
+    message : bytes
+        Kafka message value written by a bluesky_kafka Publisher.
+
+    Returns
+    -------
+    name : str
+    """
+    # fast path for the common encoding, a two element array starting with a short string
+    if len(message) > 2 and message[0] == _FIXARRAY_2:
+        marker = message[1]
+        if _FIXSTR_MIN <= marker <= _FIXSTR_MAX:
+            return message[2 : 2 + marker - _FIXSTR_MIN].decode()
+        if marker == _STR8:
+            return message[3 : 3 + message[2]].decode()
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(message)
+    unpacker.read_array_header()
+    return unpacker.unpack()
+
+
+def name_filtering_deserializer(names, deserializer=msgpack.loads):
+    """
+    Build a deserializer that only fully decodes documents with the given names.
+
+    Other documents are returned with an empty dict in place of the document, so a
+    RemoteDispatcher still sees every document name but only pays for decoding the
+    documents its callbacks use.
+
+    Parameters
+    ----------
+    names : Iterable[str]
+        Document names to decode, e.g. ("start", "stop").
+    deserializer : callable, optional
+        Deserializer used for those documents, by default msgpack.loads.
+
+    Returns
+    -------
+    deserialize : callable
+        Function taking a Kafka message value and returning (name, doc).
+    """
+    names = frozenset(names)
+
+    def deserialize(message):
+        name = peek_document_name(message)
+        if name not in names:
+            return name, {}
+        return deserializer(message)
+
+    return deserialize
+
+
+class OrderedCommitter:
+    """Commit Kafka consumer positions only once every earlier piece of work is finished.
+
+    ``track`` snapshots the consumer position when work is handed off, i.e. just
+    after the message that started it. ``done`` marks that work finished. Positions
+    are committed in the order they were tracked, so a slow reduction holds back the
+    commit of every later message, and a crash redelivers exactly the unfinished work.
+    """
+
+    def __init__(self, consumer=None):
+        self.consumer = consumer
+        self._tokens = collections.deque()
+        self._lock = threading.Lock()
+
+    def track(self):
+        """Snapshot the current positions, returns a token to pass to ``done``."""
+        token = dict(positions=self.consumer.position(self.consumer.assignment()), done=False)
+        with self._lock:
+            self._tokens.append(token)
+        return token
+
+    def done(self, token):
+        with self._lock:
+            token["done"] = True
+            positions = None
+            while self._tokens and self._tokens[0]["done"]:
+                positions = self._tokens.popleft()["positions"]
+        if positions:
+            try:
+                self.consumer.commit(offsets=positions, asynchronous=False)
+            except Exception:
+                # e.g. the partitions were revoked in a rebalance, their messages will be redelivered
+                logger.exception("failed to commit consumer positions")
+
+
+class CommittingDispatcher(RemoteDispatcher):
+    """RemoteDispatcher that leaves offset commits to an OrderedCommitter.
+
+    Use with ``"enable.auto.commit": False`` in the consumer configuration and a
+    group id shared by all replicas, so each message is handled by one replica and
+    committed only after its work is published.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.committer = OrderedCommitter()
+
+    def process_document(self, consumer, topic, name, document):
+        self.committer.consumer = consumer
+        return super().process_document(consumer, topic, name, document)
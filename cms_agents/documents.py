@@ -0,0 +1,263 @@
+"""Helpers for handling bluesky documents in the reducers."""
+import collections
+import logging
+import pprint
+import threading
+import time as ttime
+from collections.abc import MutableMapping
+
+import numpy as np
+from event_model import compose_run
+from ophyd.utils.epics_pvs import data_shape, data_type
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s"
+
+
+class DocumentSummary:
+    """One-line description of a bluesky document for log messages.
+
+    The description is only built if the log record is emitted, so passing
+    ``DocumentSummary(name, doc)`` as a logging argument costs almost nothing
+    when the level is disabled.
+    """
+
+    __slots__ = ("name", "doc")
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+
+    def __str__(self):
+        doc = self.doc
+        parts = [self.name]
+        for key in ("uid", "run_start", "descriptor"):
+            if key in doc:
+                parts.append(f"{key}={doc[key]}")
+        if "seq_num" in doc:
+            parts.append(f"seq_num={doc['seq_num']}")
+        if "data" in doc:
+            parts.append(f"data_keys={len(doc['data'])}")
+        parts.append(f"keys={len(doc)}")
+        return " ".join(parts)
+
+
+class LazyPformat:
+    """Pretty-printed form of an object, formatted only if the log record is emitted."""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pprint.pformat(self.obj)
+
+
+def flatten_dict(d: MutableMapping, parent_key: str = "", sep: str = ".") -> dict:
+    """
+    Flatten nested mappings into one dict, joining the keys with ``sep``.
+
+    Walks the mappings with an explicit stack instead of recursion, and keeps the
+    order of the keys.
+    """
+    flat = {}
+    stack = [(parent_key, iter(d.items()))]
+    while stack:
+        prefix, items = stack[-1]
+        for k, v in items:
+            key = prefix + sep + k if prefix else k
+            if isinstance(v, MutableMapping):
+                stack.append((key, iter(v.items())))
+                break
+            flat[key] = v
+        else:
+            stack.pop()
+    return flat
+
+
+def _value_signature(value):
+    if not isinstance(value, (list, tuple, np.ndarray)):
+        return type(value), getattr(value, "shape", None)
+    try:
+        array = np.asarray(value)
+    except ValueError:
+        # ragged nested sequences
+        return type(value), tuple(_value_signature(v) for v in value)
+    return type(value), array.shape, array.dtype.str
+
+
+class DescriptorSchemaCache:
+    """Reuse the descriptor ``data_keys`` built for earlier events with the same layout.
+
+    Running ``data_type`` and ``data_shape`` over every key of a reduced event is
+    repeated for every run, although the keys and value types rarely change. The
+    schema is only rebuilt when a key, a value type or an array shape differs.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Number of distinct layouts kept, by default 8.
+    """
+
+    def __init__(self, maxsize: int = 8):
+        self.maxsize = maxsize
+        self._schemas = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def data_keys(self, data: dict, source: str = "computed") -> dict:
+        signature = (source,) + tuple((k, _value_signature(v)) for k, v in data.items())
+        with self._lock:
+            schema = self._schemas.get(signature)
+            if schema is not None:
+                self._schemas.move_to_end(signature)
+                self.hits += 1
+        if schema is None:
+            schema = {
+                k: {"dtype": data_type(v), "shape": data_shape(v), "source": source} for k, v in data.items()
+            }
+            with self._lock:
+                self.misses += 1
+                self._schemas[signature] = schema
+                while len(self._schemas) > self.maxsize:
+                    self._schemas.popitem(last=False)
+        # copies, so the published descriptors do not share the cached entries
+        return {k: dict(v) for k, v in schema.items()}
+
+
+descriptor_schemas = DescriptorSchemaCache()
+
+
+def publish_reduced_documents(reduced, metadata, reduced_publisher, schema_cache=descriptor_schemas):
+    """Publish a run of one event holding ``reduced``, with ``metadata`` in its start document."""
+    cr = compose_run(metadata=metadata)
+    reduced_publisher("start", cr.start_doc)
+
+    desc_bundle = cr.compose_descriptor(name="primary", data_keys=schema_cache.data_keys(reduced))
+
+    reduced_publisher("descriptor", desc_bundle.descriptor_doc)
+    t = ttime.time()
+    reduced_publisher(
+        "event",
+        desc_bundle.compose_event(
+            data=reduced,
+            timestamps={k: t for k in reduced},
+        ),
+    )
+
+    reduced_publisher("stop", cr.compose_stop())
+
+
+class ReducedRunStream:
+    """Publish reduced results as events of one long-lived run instead of one run each.
+
+    Every ``publish`` appends a single event to the open run, which saves the start,
+    descriptor and stop documents of a run per raw run. The event carries the uid
+    of the raw run in ``raw_start_uid``. A new run is started when the data keys
+    change, when the session of the raw runs changes, or when the open run is older
+    than ``max_age`` or holds ``max_events`` events. A timer stops the open run once
+    it is ``max_age`` old, so an idle run is not left open until the next publish.
+
+    The stop document of a rollover is sent with the publisher of the ``publish``
+    starting the new run, so the caller tracks its delivery with the others. The
+    publisher's return value for the latest stop is kept in ``stop_delivery``.
+
+    Parameters
+    ----------
+    max_age : float, optional
+        Seconds after which the open run is stopped, by default one hour.
+    max_events : int, optional
+        Number of events after which the open run is stopped, by default unlimited.
+    session_keys : tuple of str, optional
+        Keys of the raw start document identifying a session, copied into the start
+        document of the reduced run, by default ("experiment_alias_directory",).
+    """
+
+    def __init__(
+        self,
+        max_age: float = 3600.0,
+        max_events: int = None,
+        session_keys=("experiment_alias_directory",),
+        schema_cache=descriptor_schemas,
+    ):
+        self.max_age = max_age
+        self.max_events = max_events
+        self.session_keys = tuple(session_keys)
+        self.schema_cache = schema_cache
+        self._lock = threading.Lock()
+        self._run = None
+        self._publisher = None
+        self.stop_delivery = None
+
+    def _session(self, metadata):
+        raw_start = metadata.get("raw_start", {})
+        return {key: raw_start.get(key) for key in self.session_keys}
+
+    def _rollover_reason(self, data_keys, session):
+        run = self._run
+        if run is None:
+            return "no open run"
+        if data_keys != run["data_keys"]:
+            return "data keys changed"
+        if session != run["session"]:
+            return "session changed"
+        if ttime.monotonic() - run["opened"] > self.max_age:
+            return "max age reached"
+        if self.max_events is not None and run["events"] >= self.max_events:
+            return "max events reached"
+        return None
+
+    def _stop(self):
+        if self._run is None:
+            return None
+        run, self._run = self._run, None
+        run["timer"].cancel()
+        self.stop_delivery = self._publisher("stop", run["bundle"].compose_stop())
+        return self.stop_delivery
+
+    def _expire(self, run):
+        with self._lock:
+            if self._run is run:
+                logger.info("stopping the reduced run: max age reached")
+                self._stop()
+
+    def publish(self, reduced, metadata, reduced_publisher):
+        """Append ``reduced`` to the open run, same arguments as publish_reduced_documents."""
+        data = dict(reduced, raw_start_uid=metadata.get("raw_start", {}).get("uid", ""))
+        data_keys = self.schema_cache.data_keys(data)
+        session = self._session(metadata)
+        with self._lock:
+            reason = self._rollover_reason(data_keys, session)
+            # the stop of a rollover is delivered along with this event
+            self._publisher = reduced_publisher
+            if reason is not None:
+                logger.info("starting a new reduced run: %s", reason)
+                self._stop()
+                bundle = compose_run(metadata=dict(reduced_stream=True, session=session))
+                reduced_publisher("start", bundle.start_doc)
+                descriptor = bundle.compose_descriptor(name="primary", data_keys=data_keys)
+                reduced_publisher("descriptor", descriptor.descriptor_doc)
+                self._run = dict(
+                    bundle=bundle,
+                    descriptor=descriptor,
+                    data_keys=data_keys,
+                    session=session,
+                    opened=ttime.monotonic(),
+                    events=0,
+                )
+                self._run["timer"] = threading.Timer(self.max_age, self._expire, args=(self._run,))
+                self._run["timer"].daemon = True
+                self._run["timer"].start()
+            t = ttime.time()
+            reduced_publisher(
+                "event", self._run["descriptor"].compose_event(data=data, timestamps={k: t for k in data})
+            )
+            self._run["events"] += 1
+
+    def close(self):
+        """Stop the open run, if any, returns what the publisher returned for the stop document."""
+        with self._lock:
+            return self._stop()
@@ -0,0 +1,187 @@
+"""Batched peak fitting of q^n I(q) curves.
+
+``fit_q2I_peaks`` fits the model of SciAnalysis' ``circular_average_q2I_fit``,
+a Gaussian peak on a linear background in q^n I(q), i.e. a peak on top of a
+power-law I(q), to a whole stack of curves at once. Levenberg-Marquardt steps
+for all curves are taken together with NumPy, using the analytic Jacobian of the
+model, so fitting a campaign of curves costs about as much as fitting one.
+
+Results use the keys and {"value", "error"} form of the protocol results, e.g.
+``fit_peaks_prefactor1``, so they can go through ``protocol_results_to_dict``
+like the output of ``Protocol.run``.
+"""
+import numpy as np
+
+PARAMETER_NAMES = ("m", "b", "prefactor1", "x_center1", "sigma1")
+
+
+def q2I_peak_model(x, params):
+    """
+    Evaluate the model and its Jacobian for a stack of parameter sets.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Abscissa of length M, shared by every curve.
+    params : np.ndarray
+        Parameters of shape (N, 5), ordered as PARAMETER_NAMES.
+
+    Returns
+    -------
+    model : np.ndarray
+        Shape (N, M).
+    jacobian : np.ndarray
+        Derivatives of the model with respect to each parameter, shape (N, M, 5).
+    """
+    m, b, prefactor, center, sigma = (params[:, i, None] for i in range(5))
+    offset = x - center
+    gaussian = np.exp(-np.square(offset) / (2 * np.square(sigma)))
+    peak = prefactor * gaussian
+    model = m * x + b + peak
+    jacobian = np.empty(model.shape + (5,))
+    jacobian[..., 0] = x
+    jacobian[..., 1] = 1.0
+    jacobian[..., 2] = gaussian
+    jacobian[..., 3] = peak * offset / np.square(sigma)
+    jacobian[..., 4] = peak * np.square(offset) / sigma**3
+    return model, jacobian
+
+
+def _levenberg_marquardt(x, y, weights, params, lower, upper, max_iter, tol):
+    """Minimize the weighted squared residuals of every curve, stepping all curves together."""
+    n = len(params)
+    damping = np.full(n, 1e-3)
+    active = np.ones(n, dtype=bool)
+
+    def cost(p, rows):
+        model, jacobian = q2I_peak_model(x, p)
+        residual = np.where(weights[rows], model - y[rows], 0.0)
+        return np.einsum("nm,nm->n", residual, residual), residual, jacobian * weights[rows, :, None]
+
+    chisqr, residual, jacobian = cost(params, slice(None))
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        idx = np.flatnonzero(active)
+        J, r = jacobian[idx], residual[idx]
+        JTJ = np.einsum("nmi,nmj->nij", J, J)
+        gradient = np.einsum("nmi,nm->ni", J, r)
+        diagonal = np.maximum(np.einsum("nii->ni", JTJ), 1e-12)
+        step_matrix = JTJ + (damping[idx, None] * diagonal)[..., None] * np.eye(5)
+        step = np.linalg.solve(step_matrix, -gradient[..., None])[..., 0]
+        trial = np.clip(params[idx] + step, lower[idx], upper[idx])
+
+        trial_chisqr, trial_residual, trial_jacobian = cost(trial, idx)
+        improved = trial_chisqr < chisqr[idx]
+        converged = improved & (chisqr[idx] - trial_chisqr <= tol * chisqr[idx])
+        accept = idx[improved]
+        params[accept] = trial[improved]
+        chisqr[accept] = trial_chisqr[improved]
+        residual[accept] = trial_residual[improved]
+        jacobian[accept] = trial_jacobian[improved]
+        damping[idx] = np.where(improved, damping[idx] / 10, damping[idx] * 10)
+        active[idx[converged | (damping[idx] > 1e10)]] = False
+    return params, chisqr, jacobian
+
+
+def fit_q2I_peaks(
+    q,
+    curves,
+    qn_power=2.0,
+    fit_range=None,
+    trim_range=None,
+    q0=None,
+    sigma=None,
+    max_iter=200,
+    tol=1e-10,
+    **kwargs,
+):
+    """
+    Fit a Gaussian peak on a linear background to q^n I(q) for a stack of curves.
+
+    The arguments match those of ``Protocols.circular_average_q2I_fit``; options
+    that only affect plotting are accepted and ignored.
+
+    Parameters
+    ----------
+    q : np.ndarray
+        Scattering vector of length M, shared by every curve.
+    curves : np.ndarray
+        I(q) of shape (N, M) or (M,). NaN marks empty bins, which are left out of the fit.
+    qn_power : float, optional
+        Power n of q^n I(q), by default 2.0.
+    fit_range, trim_range : list, optional
+        q interval [min, max] fitted. Both are applied if given.
+    q0, sigma : float, optional
+        Initial peak position and width. By default the position of the maximum
+        and a fifth of the fitted q span.
+    max_iter : int, optional
+        Maximum number of Levenberg-Marquardt steps, by default 200.
+    tol : float, optional
+        Relative decrease of chi-squared below which a curve is converged.
+
+    Returns
+    -------
+    results : list of dict
+        For each curve, ``fit_peaks_<parameter>`` entries of the form
+        {"value": ..., "error": ...}, plus ``fit_peaks_d0``, ``fit_peaks_grain_size``
+        and ``fit_peaks_chi_squared``.
+    """
+    q = np.asarray(q, dtype=float)
+    curves = np.atleast_2d(np.asarray(curves, dtype=float))
+    keep = np.ones(len(q), dtype=bool)
+    for q_range in (trim_range, fit_range):
+        if q_range is not None:
+            keep &= (q >= q_range[0]) & (q <= q_range[1])
+    q = q[keep]
+    y = curves[:, keep] * np.power(q, qn_power)
+    weights = np.isfinite(y)
+    y = np.where(weights, y, 0.0)
+    counts = weights.sum(axis=1)
+
+    # fit in scaled units, so the parameters are of order unity whatever the units of I(q)
+    q_scale = q.max() - q.min() if len(q) > 1 else 1.0
+    x = q / q_scale
+    y_low = np.where(weights, y, np.inf).min(axis=1)
+    y_high = np.where(weights, y, -np.inf).max(axis=1)
+    y_scale = np.where(np.isfinite(y_high) & (y_high > 0), y_high, 1.0)
+    ys = y / y_scale[:, None]
+    y_low, y_high = y_low / y_scale, y_high / y_scale
+
+    n = len(curves)
+    peak = np.where(weights, ys, -np.inf).argmax(axis=1) if len(q) else np.zeros(n, dtype=int)
+    params = np.empty((n, 5))
+    params[:, 0] = 0.0
+    params[:, 1] = np.where(np.isfinite(y_low), y_low, 0.0)
+    params[:, 2] = np.where(np.isfinite(y_high), y_high - params[:, 1], 1.0)
+    params[:, 3] = x[peak] if q0 is None else q0 / q_scale
+    params[:, 4] = 0.2 if sigma is None else sigma / q_scale
+    lower = np.tile([-np.inf, -np.inf, 0.0, x.min(initial=0.0), 1e-6], (n, 1))
+    upper = np.tile([np.inf, np.inf, np.inf, x.max(initial=1.0), 0.5], (n, 1))
+    params = np.clip(params, lower, upper)
+
+    params, chisqr, jacobian = _levenberg_marquardt(x, ys, weights, params, lower, upper, max_iter, tol)
+
+    nfree = np.maximum(counts - 5, 1)
+    reduced_chisqr = chisqr / nfree
+    JTJ = np.einsum("nmi,nmj->nij", jacobian, jacobian)
+    covariance = np.linalg.pinv(JTJ) * reduced_chisqr[:, None, None]
+    errors = np.sqrt(np.abs(np.einsum("nii->ni", covariance)))
+
+    unscale = np.stack([y_scale / q_scale, y_scale, y_scale, np.full(n, q_scale), np.full(n, q_scale)], axis=1)
+    values, errors = params * unscale, errors * unscale
+    reduced_chisqr = reduced_chisqr * np.square(y_scale)
+
+    results = []
+    for i in range(n):
+        result = {
+            f"fit_peaks_{name}": {"value": float(values[i, j]), "error": float(errors[i, j])}
+            for j, name in enumerate(PARAMETER_NAMES)
+        }
+        center, width = values[i, 3], values[i, 4]
+        # derived quantities as reported by circular_average_q2I_fit, lengths in nm
+        result["fit_peaks_d0"] = float(0.1 * 2 * np.pi / center)
+        result["fit_peaks_grain_size"] = float(0.1 * (2 * np.pi / np.sqrt(2 * np.pi)) / width)
+        result["fit_peaks_chi_squared"] = float(reduced_chisqr[i])
+        results.append(result)
+    return results
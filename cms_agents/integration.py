@@ -0,0 +1,191 @@
+"""Precomputed circular averaging for a fixed detector geometry.
+
+The q of every pixel, the q bin it falls in, and the mask only depend on the
+calibration, so they are computed once, stored on disk keyed by a hash of the
+geometry and mask, and reused for every frame. Integrating a frame is then a
+single ``np.bincount`` over the flattened image.
+
+The binning follows SciAnalysis' ``Data2DScattering.circular_average_q_bin``:
+``bins_relative * (q_max - q_min) / dq`` equal bins spanning the unmasked pixels,
+where ``dq`` is the q subtended by one pixel at the beam center.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cms_agents", "integration_plans")
+
+
+def q_map(
+    *,
+    wavelength_A: float,
+    width: int,
+    height: int,
+    pixel_size_um: float,
+    beam_position: tuple,
+    distance_m: float,
+) -> np.ndarray:
+    """
+    Momentum transfer of each pixel for a flat detector normal to the beam.
+
+    Returns
+    -------
+    q : np.ndarray
+        Array of shape (height, width) in inverse Angstroms.
+    """
+    x0, y0 = beam_position
+    pixel_size_m = pixel_size_um * 1e-6
+    x = (np.arange(width) - x0) * pixel_size_m
+    y = (np.arange(height) - y0) * pixel_size_m
+    r = np.hypot(x[np.newaxis, :], y[:, np.newaxis])
+    two_theta = np.arctan(r / distance_m)
+    return (4 * np.pi / wavelength_A) * np.sin(two_theta / 2)
+
+
+def q_per_pixel(*, wavelength_A: float, pixel_size_um: float, distance_m: float, **kwargs) -> float:
+    """q subtended by a single pixel at the beam center."""
+    two_theta = np.arctan((pixel_size_um * 1e-6) / distance_m)
+    return (4 * np.pi / wavelength_A) * np.sin(two_theta / 2)
+
+
+def plan_key(geometry: dict, mask: np.ndarray, bins_relative: float = 1.0) -> str:
+    """Hash identifying an integration plan from its geometry, mask and binning."""
+    h = hashlib.sha256()
+    h.update(json.dumps(dict(geometry, bins_relative=bins_relative), sort_keys=True, default=list).encode())
+    mask = np.ascontiguousarray(mask, dtype=bool)
+    h.update(str(mask.shape).encode())
+    h.update(np.packbits(mask).tobytes())
+    return h.hexdigest()[:16]
+
+
+class IntegrationPlan:
+    """Circular average of detector frames with precomputed bin assignments.
+
+    Parameters
+    ----------
+    bin_index : np.ndarray
+        Flat array with the q bin of every pixel, masked pixels point at the extra bin ``num_bins``.
+    q : np.ndarray
+        Center of every bin.
+    num_per_bin : np.ndarray
+        Number of unmasked pixels in every bin.
+    shape : tuple
+        Shape of the frames this plan applies to.
+    key : str, optional
+        Hash of the geometry and mask the plan was built from.
+    """
+
+    def __init__(self, bin_index, q, num_per_bin, shape, key=None):
+        self.bin_index = bin_index
+        self.q = q
+        self.num_per_bin = num_per_bin
+        self.shape = tuple(shape)
+        self.key = key
+        self._filled = num_per_bin > 0
+
+    @property
+    def num_bins(self):
+        return len(self.q)
+
+    @classmethod
+    def build(cls, geometry: dict, mask: np.ndarray, bins_relative: float = 1.0):
+        """
+        Compute a plan from the detector geometry.
+
+        Parameters
+        ----------
+        geometry : dict
+            Keyword arguments of ``q_map``.
+        mask : np.ndarray
+            Array of shape (height, width), nonzero for pixels to keep.
+        bins_relative : float, optional
+            Bin width relative to the q per pixel, by default 1.0.
+        """
+        q = q_map(**geometry).ravel()
+        keep = np.asarray(mask).ravel() != 0
+        q_keep = q[keep]
+        q_min, q_max = q_keep.min(), q_keep.max()
+        num_bins = int(bins_relative * abs(q_max - q_min) / q_per_pixel(**geometry))
+        edges = np.linspace(q_min, q_max, num_bins + 1)
+
+        bin_index = np.full(q.shape, num_bins, dtype=np.int32)
+        # the last bin is closed on the right, as in np.histogram
+        bin_index[keep] = np.clip(np.searchsorted(edges, q_keep, side="right") - 1, 0, num_bins - 1)
+        num_per_bin = np.bincount(bin_index, minlength=num_bins + 1)[:num_bins]
+        return cls(
+            bin_index,
+            (edges[:-1] + edges[1:]) / 2,
+            num_per_bin,
+            np.shape(mask),
+            key=plan_key(geometry, mask, bins_relative),
+        )
+
+    @classmethod
+    def load_or_build(
+        cls, geometry: dict, mask: np.ndarray, bins_relative: float = 1.0, cache_dir: str = DEFAULT_CACHE_DIR
+    ):
+        """Load the plan for this geometry and mask from ``cache_dir``, building and saving it if missing."""
+        key = plan_key(geometry, mask, bins_relative)
+        path = os.path.join(cache_dir, f"integration_plan_{key}.npz")
+        if os.path.exists(path):
+            return cls.load(path)
+        plan = cls.build(geometry, mask, bins_relative=bins_relative)
+        plan.save(path)
+        return plan
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # write to a temporary file first so concurrent reducers never read a partial plan
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            bin_index=self.bin_index,
+            q=self.q,
+            num_per_bin=self.num_per_bin,
+            shape=np.array(self.shape),
+            key=np.array(self.key or ""),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as f:
+            shape = tuple(int(n) for n in f["shape"])
+            return cls(f["bin_index"], f["q"], f["num_per_bin"], shape, key=str(f["key"]) or None)
+
+    def integrate(self, image: np.ndarray, error: bool = False):
+        """
+        Circular average of one frame.
+
+        Parameters
+        ----------
+        image : np.ndarray
+            Frame with the shape the plan was built for.
+        error : bool, optional
+            Also return the standard deviation of the pixels in every bin, as SciAnalysis'
+            ``circular_average_q_bin`` reports it, by default False.
+
+        Returns
+        -------
+        q : np.ndarray
+            Centers of the non-empty bins.
+        intensity : np.ndarray
+            Mean intensity in every non-empty bin.
+        intensity_error : np.ndarray
+            Only returned if ``error`` is True.
+        """
+        if np.shape(image) != self.shape:
+            raise ValueError(f"Frame shape {np.shape(image)} does not match integration plan shape {self.shape}")
+        values = np.ravel(image)
+        minlength = self.num_bins + 1
+        sums = np.bincount(self.bin_index, weights=values, minlength=minlength)[: self.num_bins]
+        filled = self._filled
+        counts = self.num_per_bin[filled]
+        intensity = sums[filled] / counts
+        if not error:
+            return self.q[filled], intensity
+        sums_sq = np.bincount(self.bin_index, weights=np.square(values, dtype=float), minlength=minlength)
+        variance = np.maximum(sums_sq[: self.num_bins][filled] / counts - np.square(intensity), 0)
+        return self.q[filled], intensity, np.sqrt(variance)
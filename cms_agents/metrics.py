@@ -0,0 +1,186 @@
+"""Stage latency metrics for the reducers.
+
+A ``StageTimer`` follows one run through the pipeline and records the time
+spent between consecutive stages. The durations are collected in a
+``StageMetrics`` registry of histograms, which ``serve_metrics`` exposes over
+HTTP: ``/metrics`` in the Prometheus text format and ``/summary`` as JSON with
+recent percentiles.
+"""
+import bisect
+import collections
+import json
+import logging
+import threading
+import time as ttime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class StageTimer:
+    """Record the time between consecutive stages of processing a single run.
+
+    Parameters
+    ----------
+    start : float, optional
+        ``time.monotonic()`` at which the run entered the pipeline, by default now.
+        The monotonic clock is shared between processes, so a timer can be started
+        in the Kafka consumer and continued in a worker process.
+    """
+
+    def __init__(self, start: float = None):
+        self.start = ttime.monotonic() if start is None else start
+        self._last = self.start
+        self.durations = []
+
+    def mark(self, stage: str) -> float:
+        """Record the time since the previous stage under the name ``stage``."""
+        now = ttime.monotonic()
+        duration = now - self._last
+        self.durations.append((stage, duration))
+        self._last = now
+        return duration
+
+    def total(self) -> float:
+        return self._last - self.start
+
+
+class Histogram:
+    """Cumulative histogram of durations in seconds, plus a window of recent values for percentiles."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=1000):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def summary(self) -> dict:
+        summary = dict(count=self.count, sum=self.sum)
+        if self.recent:
+            recent = np.array(self.recent)
+            summary.update(
+                mean=float(recent.mean()),
+                p50=float(np.percentile(recent, 50)),
+                p95=float(np.percentile(recent, 95)),
+                p99=float(np.percentile(recent, 99)),
+                max=float(recent.max()),
+            )
+        return summary
+
+
+class StageMetrics:
+    """Thread-safe registry of one histogram per pipeline stage.
+
+    Parameters
+    ----------
+    prefix : str, optional
+        Prefix of the exported metric names, by default "cms_reduction".
+    """
+
+    def __init__(self, prefix: str = "cms_reduction", buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self._buckets = buckets
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            if stage not in self._histograms:
+                self._histograms[stage] = Histogram(self._buckets)
+            self._histograms[stage].observe(seconds)
+
+    def observe_timer(self, timer: StageTimer):
+        for stage, seconds in timer.durations:
+            self.observe(stage, seconds)
+        self.observe("total", timer.total())
+
+    def set_gauge(self, name: str, value_function):
+        """Export the value returned by ``value_function()`` at the time of each request."""
+        self._gauges[name] = value_function
+
+    def summary(self) -> dict:
+        with self._lock:
+            stages = {stage: histogram.summary() for stage, histogram in self._histograms.items()}
+        return dict(stages=stages, gauges={name: f() for name, f in self._gauges.items()})
+
+    def prometheus_text(self) -> str:
+        name = f"{self.prefix}_stage_seconds"
+        lines = [f"# HELP {name} Time spent in each reduction stage.", f"# TYPE {name} histogram"]
+        with self._lock:
+            for stage, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self._buckets + ("+Inf",), histogram.bucket_counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+        for gauge, f in sorted(self._gauges.items()):
+            lines.append(f"# TYPE {self.prefix}_{gauge} gauge")
+            lines.append(f"{self.prefix}_{gauge} {f()}")
+        return "\n".join(lines) + "\n"
+
+
+class ObservationBuffer:
+    """Collect observations to be handed to a StageMetrics in another process, see ``drain``."""
+
+    def __init__(self):
+        self._observations = []
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            self._observations.append((stage, seconds))
+
+    def drain(self) -> list:
+        """Return and forget everything observed so far."""
+        with self._lock:
+            observations, self._observations = self._observations, []
+        return observations
+
+
+def serve_metrics(metrics: StageMetrics, port: int, host: str = "") -> ThreadingHTTPServer:
+    """
+    Serve ``/metrics`` (Prometheus text format) and ``/summary`` (JSON) from a daemon thread.
+
+    Returns
+    -------
+    server : ThreadingHTTPServer
+        Call ``server.shutdown()`` to stop serving.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = metrics.prometheus_text().encode()
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/summary":
+                body = json.dumps(metrics.summary(), indent=2).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("serving reduction metrics on port %d", server.server_address[1])
+    return server
@@ -0,0 +1,280 @@
+"""Wait for detector files to be completely written before they are reduced.
+
+The detector writes its TIFF asynchronously with respect to the bluesky documents,
+so the stop document can arrive before, during, or after the file is written.
+A file is considered ready when it exists, its size is unchanged between two
+consecutive checks, and its TIFF header can be read and points inside the file.
+
+If the optional ``inotify_simple`` package is installed, changes in the parent
+directory wake the watcher early; otherwise it polls with exponential backoff.
+
+``RunPrefetcher`` starts watching for the file of each run when its start
+document arrives, so the file is usually ready by the time the run stops.
+"""
+import collections
+import logging
+import os
+import struct
+import threading
+import time as ttime
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+try:
+    from inotify_simple import INotify
+    from inotify_simple import flags as inotify_flags
+except ImportError:
+    INotify = None
+
+logger = logging.getLogger(__name__)
+
+TIFF_BYTE_ORDERS = {b"II": "<", b"MM": ">"}
+TIFF_VERSION = 42
+
+
+def tiff_header_readable(path: str, size: int = None) -> bool:
+    """
+    Check that a file starts with a classic TIFF header whose first IFD lies inside the file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the TIFF file.
+    size : int, optional
+        File size in bytes, by default read from the filesystem.
+
+    Returns
+    -------
+    readable : bool
+    """
+    try:
+        if size is None:
+            size = os.stat(path).st_size
+        with open(path, "rb") as f:
+            header = f.read(8)
+    except OSError:
+        return False
+    if len(header) < 8 or header[:2] not in TIFF_BYTE_ORDERS:
+        return False
+    byte_order = TIFF_BYTE_ORDERS[header[:2]]
+    version, first_ifd_offset = struct.unpack(f"{byte_order}HI", header[2:])
+    return version == TIFF_VERSION and 8 <= first_ifd_offset < size
+
+
+class _PollingWait:
+    def __init__(self, directory):
+        pass
+
+    def __call__(self, seconds):
+        ttime.sleep(seconds)
+
+    def close(self):
+        pass
+
+
+class _INotifyWait:
+    def __init__(self, directory):
+        self._inotify = INotify()
+        watch_flags = (
+            inotify_flags.CREATE | inotify_flags.MODIFY | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO
+        )
+        self._inotify.add_watch(directory, watch_flags)
+
+    def __call__(self, seconds):
+        # returns early as soon as anything in the directory changes
+        self._inotify.read(timeout=int(seconds * 1000))
+
+    def close(self):
+        self._inotify.close()
+
+
+def _make_wait(directory, use_inotify):
+    if use_inotify and INotify is not None:
+        try:
+            return _INotifyWait(directory)
+        except OSError:
+            # the directory may not exist yet, or the inotify watch limit is reached
+            pass
+    return _PollingWait(directory)
+
+
+def wait_for_file(
+    path: str,
+    timeout: float = 30.0,
+    initial_delay: float = 0.01,
+    max_delay: float = 0.5,
+    is_complete=tiff_header_readable,
+    use_inotify: bool = True,
+    cancel: threading.Event = None,
+) -> float:
+    """
+    Block until a file exists, has a stable size, and passes ``is_complete``.
+
+    Parameters
+    ----------
+    path : str
+        Expected path of the file.
+    timeout : float, optional
+        Maximum time in seconds to wait, by default 30.
+    initial_delay : float, optional
+        First delay in seconds between checks, doubled after every check, by default 0.01.
+    max_delay : float, optional
+        Upper limit in seconds on the delay between checks, by default 0.5.
+    is_complete : callable, optional
+        Function with signature (path, size) returning True once the file contents are usable,
+        by default a TIFF header check.
+    use_inotify : bool, optional
+        Wake early on directory changes if inotify_simple is available, by default True.
+    cancel : threading.Event, optional
+        Stop waiting once this is set, checked between checks of the file.
+
+    Returns
+    -------
+    elapsed : float
+        Time in seconds spent waiting.
+
+    Raises
+    ------
+    TimeoutError
+        If the file is not ready within ``timeout`` seconds.
+    concurrent.futures.CancelledError
+        If ``cancel`` is set before the file is ready.
+    """
+    start = ttime.monotonic()
+    delay = initial_delay
+    last_size = None
+    wait = _make_wait(os.path.dirname(path) or ".", use_inotify)
+    try:
+        while True:
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                size = None
+            if size and size == last_size and is_complete(path, size):
+                return ttime.monotonic() - start
+            last_size = size
+
+            if cancel is not None and cancel.is_set():
+                raise CancelledError(f"stopped waiting for {path}")
+            remaining = timeout - (ttime.monotonic() - start)
+            if remaining <= 0:
+                state = "missing" if size is None else f"incomplete ({size} bytes)"
+                raise TimeoutError(f"{path} is still {state} after {timeout} s")
+            wait(min(delay, remaining))
+            delay = min(2 * delay, max_delay)
+    finally:
+        wait.close()
+
+
+def file_seen(file_ready) -> bool:
+    """Whether a prefetch saw the file complete, ``file_ready`` is True or the watcher's future."""
+    if file_ready is True:
+        return True
+    if file_ready is None or not file_ready.done() or file_ready.cancelled():
+        return False
+    return file_ready.exception() is None
+
+
+def wait_for_prefetched_file(path: str, file_ready, timeout: float = 30.0) -> float:
+    """
+    Block until the file of a stopped run is ready, unless its prefetch watcher already saw it complete.
+
+    Parameters
+    ----------
+    path : str
+        Expected path of the file.
+    file_ready : concurrent.futures.Future or bool or None
+        The watcher's future from ``RunPrefetcher.pop``, True if the file is known to be complete,
+        or None without a prefetch.
+    timeout : float, optional
+        Maximum time in seconds to wait, by default 30.
+
+    Returns
+    -------
+    elapsed : float
+        Time in seconds spent waiting.
+    """
+    if file_seen(file_ready):
+        return 0.0
+    # the watcher was stopped by the pop, was still queued behind other watchers, or gave up
+    return wait_for_file(path, timeout=timeout)
+
+
+class RunPrefetcher:
+    """
+    Prepare each run when its start document arrives, so only the analysis is left when it stops.
+
+    On start the expected file path is computed, a background thread starts watching for the file,
+    and, if a Tiled client is given, another resolves the run node. A watcher holds its thread until
+    the file is ready, its run is popped or evicted, or ``watch_timeout`` passes, so the watchers of
+    runs beyond ``max_threads`` wait in the queue; ``wait_for_prefetched_file`` then waits itself.
+
+    Parameters
+    ----------
+    file_path : callable
+        Expected path of the file of a run from its start document, raising KeyError for runs without one.
+    cms_tiled_client : RunCache, optional
+        Catalog to resolve run nodes from, by default the start document alone is kept.
+    watch_timeout : float, optional
+        Seconds the background watcher waits for a file, which should cover the longest exposure.
+    max_runs : int, optional
+        Number of runs kept while waiting for their stop documents.
+    max_threads : int, optional
+        Number of watchers and run lookups running at once.
+    """
+
+    def __init__(self, file_path, cms_tiled_client=None, watch_timeout=600.0, max_runs=100, max_threads=8):
+        self._file_path = file_path
+        self._cms_tiled_client = cms_tiled_client
+        self._watch_timeout = watch_timeout
+        self._max_runs = max_runs
+        self._executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="prefetch")
+        self._runs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def on_start(self, start_doc):
+        try:
+            infile = self._file_path(start_doc)
+        except KeyError:
+            # not a run with a detector file to reduce
+            return
+        uid = start_doc["uid"]
+        cancel = threading.Event()
+        prefetched = dict(
+            start=start_doc,
+            cancel=cancel,
+            file_ready=self._executor.submit(wait_for_file, infile, timeout=self._watch_timeout, cancel=cancel),
+        )
+        if self._cms_tiled_client is not None:
+            prefetched["run"] = self._executor.submit(self._cms_tiled_client.__getitem__, uid)
+        evicted = []
+        with self._lock:
+            self._runs[uid] = prefetched
+            while len(self._runs) > self._max_runs:
+                evicted.append(self._runs.popitem(last=False)[1])
+        for old in evicted:
+            self._stop_watching(old)
+        logger.debug("prefetching run_start id %s, watching %s", uid, infile)
+
+    @staticmethod
+    def _stop_watching(prefetched):
+        # a queued watcher never starts, a running one returns its thread to the pool
+        prefetched["file_ready"].cancel()
+        prefetched["cancel"].set()
+
+    def start_doc(self, uid):
+        """Start document of a run waiting for its stop document, or None."""
+        with self._lock:
+            prefetched = self._runs.get(uid)
+        return None if prefetched is None else prefetched["start"]
+
+    def pop(self, uid):
+        """
+        Context prepared for a run, a dict with "start", "file_ready" and possibly "run", or None.
+
+        The watcher is stopped, "file_ready" is its future, see ``file_seen`` and ``wait_for_prefetched_file``.
+        """
+        with self._lock:
+            prefetched = self._runs.pop(uid, None)
+        if prefetched is not None:
+            self._stop_watching(prefetched)
+        return prefetched
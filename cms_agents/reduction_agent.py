@@ -1,16 +1,16 @@
 import argparse
-import datetime
-import pprint
+import logging
 import uuid
-import time as ttime
 
 from bluesky_kafka import Publisher, RemoteDispatcher
 import nslsii.kafka_utils
 
-from ophyd.utils.epics_pvs import data_shape, data_type
-from event_model import compose_run
+from cms_agents.consumers import name_filtering_deserializer
+from cms_agents.documents import LOG_FORMAT, DocumentSummary, LazyPformat, publish_reduced_documents
+from cms_agents.sinks import DocumentSinks, kafka_sink, tiled_sink
+from cms_agents.tiled_access import RunCache, get_client
 
-from tiled.client import from_profile
+logger = logging.getLogger("cms_agents.reduction_agent")
 
 
 def reduce_run(bluesky_run):
@@ -30,55 +30,24 @@ def reduce_run(bluesky_run):
     metadata : dict
         Will be top-level in the reduced start document
     """
-    print(f"give reduced on run {bluesky_run}")
+    logger.debug("give reduced on run %s", bluesky_run)
     reduced = {"next big thing": "avocado toast"}
 
     return reduced, {"raw_start": bluesky_run.metadata["start"]}
 
 
-def publish_reduced_documents(reduced, metadata, reduced_publisher):
-    cr = compose_run(metadata=metadata)
-    reduced_publisher("start", cr.start_doc)
-
-    desc_bundle = cr.compose_descriptor(
-        name="primary",
-        data_keys={
-            k: {
-                "dtype": data_type(v),
-                "shape": data_shape(v),
-                "source": "computed",
-            }
-            for k, v in reduced.items()
-        },
-    )
-
-    reduced_publisher("descriptor", desc_bundle.descriptor_doc)
-    t = ttime.time()
-    reduced_publisher(
-        "event",
-        desc_bundle.compose_event(
-            data=reduced,
-            timestamps={k: t for k in reduced},
-        ),
-    )
-
-    reduced_publisher("stop", cr.compose_stop())
-
-
 def respond_to_stop_with_reduced(consumer_topic: str, testing: bool = False):
 
     kafka_config = nslsii.kafka_utils._read_bluesky_kafka_config_file(config_file_path="/etc/bluesky/kafka.yml")
 
-    cms_tiled_client = from_profile("cms")
+    cms_tiled_client = RunCache(get_client("cms"))
     
     if testing:
         def output_reduced_document(name, doc):
-            print(
-                f"{datetime.datetime.now().isoformat()} output document: {name}\n"
-                f"contents: {pprint.pformat(doc)}\n"
-            )
+            logger.info("output document: %s", DocumentSummary(name, doc))
+            logger.debug("contents: %s", LazyPformat(doc))
     else:
-        cms_sandbox_tiled_client = from_profile("cms_bluesky_sandbox")
+        cms_sandbox_tiled_client = get_client("cms_bluesky_sandbox")
         reduced_publisher = Publisher(
             key="",
             topic="cms.bluesky.reduced.documents",
@@ -86,22 +55,23 @@ def respond_to_stop_with_reduced(consumer_topic: str, testing: bool = False):
             producer_config=kafka_config["runengine_producer_config"],
         )
 
-        def output_reduced_document(name, doc):
-            cms_sandbox_tiled_client.v1.insert(name, doc)
-            reduced_publisher(name, doc)
+        # insert into Tiled and publish to Kafka concurrently, off the reduction thread
+        output_reduced_document = DocumentSinks(
+            tiled_sink(cms_sandbox_tiled_client),
+            kafka_sink(reduced_publisher),
+        )
 
     def on_stop_reduce_run(name, doc):
-        print(
-            f"{datetime.datetime.now().isoformat()} document: {name}\n"
-            f"contents: {pprint.pformat(doc)}\n"
-        )
+        logger.debug("document: %s", DocumentSummary(name, doc))
         if name == "stop":
             # look up the results of this run
             run_start_id = doc["run_start"]
-            print(f"found run_start id {run_start_id}")
+            logger.info("found run_start id %s", run_start_id)
             bluesky_run = cms_tiled_client[run_start_id]
             reduced, metadata = reduce_run(bluesky_run)
             publish_reduced_documents(reduced, metadata, output_reduced_document)
+            if not testing:
+                logger.info("reduced document sinks: %s", output_reduced_document.summary())
         else:
             pass
 
@@ -114,6 +84,8 @@ def respond_to_stop_with_reduced(consumer_topic: str, testing: bool = False):
         bootstrap_servers=",".join(kafka_config["bootstrap_servers"]),
         group_id=unique_group_id,
         consumer_config=kafka_config["runengine_producer_config"],
+        # only stop documents are used, skip decoding everything else
+        deserializer=name_filtering_deserializer(["stop"]),
     )
 
     kafka_dispatcher.subscribe(on_stop_reduce_run)
@@ -136,9 +108,16 @@ def get_args():
         help="reduction_agent will send output only to the console"
     )
 
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        help="logging level, DEBUG also logs every incoming document",
+    )
+
     return parser.parse_args()
 
 
 if __name__ == "__main__":
-    args = get_args()
-    respond_to_stop_with_reduced(**vars(args))
+    args = vars(get_args())
+    logging.basicConfig(level=args.pop("log_level").upper(), format=LOG_FORMAT)
+    respond_to_stop_with_reduced(**args)
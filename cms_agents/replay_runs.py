@@ -2,7 +2,8 @@ import argparse
 
 from bluesky_kafka import Publisher
 from nslsii.kafka_utils import _read_bluesky_kafka_config_file
-from tiled.client import from_profile
+
+from cms_agents.tiled_access import get_client
 
 
 def get_args():
@@ -26,7 +27,7 @@ def replay_runs(produce):
         producer_config=kafka_config["runengine_producer_config"],
     )
 
-    cms_client = from_profile("cms")
+    cms_client = get_client("cms")
 
     print()
     if produce:
@@ -0,0 +1,136 @@
+"""Scheduling of the runs waiting to be reduced.
+
+Stop documents are queued in a ``ReductionScheduler`` instead of being reduced
+in arrival order. Runs requested by an agent are reduced before survey runs,
+and when the backlog grows past its limit the oldest survey runs are dropped,
+since no agent is waiting for them.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time as ttime
+
+logger = logging.getLogger(__name__)
+
+AGENT_PLAN_NAMES = frozenset(["agent_feedback_plan"])
+
+
+def agent_requested(start_doc) -> bool:
+    """Whether a run was started by an agent, e.g. with agent_feedback_plan."""
+    return bool(start_doc) and start_doc.get("plan_name") in AGENT_PLAN_NAMES
+
+
+class ReductionScheduler:
+    """Priority queue of runs waiting to be reduced, served by worker threads.
+
+    Agent-requested runs go first, every other run waits behind them in arrival
+    order. Above ``max_backlog`` queued runs, the oldest survey run is shed, and
+    survey runs that waited longer than ``max_age`` are shed instead of reduced.
+    Agent-requested runs are never shed.
+
+    Parameters
+    ----------
+    handler : callable
+        Called as ``handler(run_start_id, timer, **context)`` from a worker thread.
+    concurrency : int, optional
+        Number of runs handled at once, by default 1.
+    max_backlog : int, optional
+        Maximum number of queued runs, by default unlimited.
+    max_age : float, optional
+        Seconds a survey run may wait before it is shed, by default unlimited.
+    on_shed : callable, optional
+        Called as ``on_shed(run_start_id, timer, **context)`` for every shed run.
+    """
+
+    def __init__(self, handler, concurrency=1, max_backlog=None, max_age=None, on_shed=None):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.max_backlog = max_backlog
+        self.max_age = max_age
+        self.on_shed = on_shed
+        self.shed = 0
+        self.running = 0
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._work, name=f"reduce-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, run_start_id, timer, urgent=False, **context):
+        """Queue a run, ``timer.start`` is taken as the time it entered the queue."""
+        item = (0 if urgent else 1, next(self._counter), run_start_id, timer, context)
+        shed = []
+        with self._condition:
+            heapq.heappush(self._queue, item)
+            if self.max_backlog is not None:
+                while len(self._queue) > self.max_backlog:
+                    oldest = self._oldest_survey()
+                    if oldest is None:
+                        break
+                    shed.append(oldest)
+            self._condition.notify()
+        for item in shed:
+            self._shed(item, "backlog full")
+
+    def _oldest_survey(self):
+        surveys = [item for item in self._queue if item[0] == 1]
+        if not surveys:
+            return None
+        oldest = min(surveys, key=lambda item: item[1])
+        self._queue.remove(oldest)
+        heapq.heapify(self._queue)
+        return oldest
+
+    def _shed(self, item, reason):
+        _, _, run_start_id, timer, context = item
+        with self._condition:
+            self.shed += 1
+        logger.warning("not reducing run_start id %s: %s", run_start_id, reason)
+        if self.on_shed is not None:
+            self.on_shed(run_start_id, timer, **context)
+
+    def _next(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                item = heapq.heappop(self._queue)
+                stale = (
+                    item[0] == 1
+                    and self.max_age is not None
+                    and ttime.monotonic() - item[3].start > self.max_age
+                )
+                if not stale:
+                    self.running += 1
+                    return item
+            self._shed(item, "waited longer than the maximum age")
+
+    def _work(self):
+        while True:
+            _, _, run_start_id, timer, context = self._next()
+            try:
+                self.handler(run_start_id, timer, **context)
+            except Exception:
+                logger.exception("reduction of run_start id %s failed", run_start_id)
+            finally:
+                with self._condition:
+                    self.running -= 1
+
+    def depth(self) -> int:
+        """Number of queued runs."""
+        with self._condition:
+            return len(self._queue)
+
+    def oldest_age(self) -> float:
+        """Seconds the longest waiting queued run has waited."""
+        with self._condition:
+            if not self._queue:
+                return 0.0
+            return ttime.monotonic() - min(item[3].start for item in self._queue)
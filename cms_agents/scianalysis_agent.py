@@ -1,16 +1,34 @@
 import argparse
-import datetime
-import pprint
+import atexit
+import logging
+import multiprocessing
+import multiprocessing.util
+import tempfile
 import uuid
-import time as ttime
+from concurrent.futures import ProcessPoolExecutor
 
 from bluesky_kafka import Publisher, RemoteDispatcher
 import nslsii.kafka_utils
 
-from ophyd.utils.epics_pvs import data_shape, data_type
-from event_model import compose_run
+from cms_agents.cache import DEFAULT_CACHE_DIR, ReductionCache, config_fingerprint
+from cms_agents.consumers import CommittingDispatcher, name_filtering_deserializer
+from cms_agents.documents import (
+    LOG_FORMAT,
+    DocumentSummary,
+    LazyPformat,
+    ReducedRunStream,
+    flatten_dict,
+    publish_reduced_documents,
+)
+from cms_agents.fitting import fit_q2I_peaks
+from cms_agents.integration import IntegrationPlan
+from cms_agents.metrics import ObservationBuffer, StageMetrics, StageTimer, serve_metrics
+from cms_agents.readiness import RunPrefetcher, file_seen, wait_for_prefetched_file
+from cms_agents.scheduling import ReductionScheduler, agent_requested
+from cms_agents.sinks import DeliveryError, DocumentSinks, all_delivered, kafka_sink, tiled_sink
+from cms_agents.tiled_access import RunCache, get_client
 
-from tiled.client import from_profile
+logger = logging.getLogger("cms_agents.scianalysis_agent")
 
 
 
@@ -38,6 +56,17 @@ mask_dir = SciAnalysis_PATH + '/SciAnalysis/XSAnalysis/masks/'
 mask = Mask(mask_dir+'Dectris/Pilatus2M_gaps-mask.png')
 mask.load('../../mask.png')
 
+# Circular average plan, built once for this calibration and mask and cached on disk
+detector_geometry = dict(
+    wavelength_A=calibration.wavelength_A,
+    width=calibration.width,
+    height=calibration.height,
+    pixel_size_um=calibration.pixel_size_um,
+    beam_position=(calibration.x0, calibration.y0),
+    distance_m=calibration.distance_m,
+)
+integration_plan = IntegrationPlan.load_or_build(detector_geometry, mask.data)
+
 # Analysis to perform
 ########################################
 #source_dir = '../../../raw/'
@@ -72,6 +101,8 @@ patterns = [
             ['sequence_ID', '.+_(\d+).+'] ,
             ]
 
+q2I_fit_args = dict(qn_power=3.5, trim_range=[0.005, 0.03], fit_range=[0.007, 0.019], q0=0.0120, sigma=0.0008)
+
 protocols = [
     #Protocols.HDF5(save_results=['hdf5'])
     #Protocols.calibration_check(show=False, AgBH=True, q0=0.010, num_rings=4, ztrim=[0.05, 0.05], ) ,
@@ -79,7 +110,7 @@ protocols = [
     #Protocols.thumbnails(crop=None, resize=1.0, blur=None, cmap=cmap_vge, ztrim=[0.01, 0.001]) ,
     
     #Protocols.circular_average_q2I_fit(show=False, q0=0.0140, qn_power=2.5, sigma=0.0008, plot_range=[0, 0.06, 0, None], fit_range=[0.008, 0.022]) ,
-    Protocols.circular_average_q2I_fit(qn_power=3.5, trim_range=[0.005, 0.03], fit_range=[0.007, 0.019], q0=0.0120, sigma=0.0008) ,
+    Protocols.circular_average_q2I_fit(**q2I_fit_args) ,
     #Protocols.circular_average_q2I_fit(qn_power=3.0, trim_range=[0.005, 0.035], fit_range=[0.008, 0.03], q0=0.0180, sigma=0.001) ,
     
     #Protocols.databroker_extract(constraints={'measure_type':'measure'}, timestamp=True, sectino='start'),
@@ -95,26 +126,119 @@ protocols = [
 
 # Helpers
 ########################################
-from collections.abc import MutableMapping
-
-def flatten_dict(d: MutableMapping, parent_key: str = '', sep: str ='.') -> MutableMapping:
-    # From:
-    # https://www.freecodecamp.org/news/how-to-flatten-a-dictionary-in-python-in-4-different-ways/
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, MutableMapping):
-            items.extend(flatten_dict(v, new_key, sep=sep).items())
+def protocol_results_to_dict(results):
+    """
+    Convert the results returned by Protocol.run into the form ResultsDB.extract_single reads back
+    from the saved xml, i.e. {name: value, name_error: error}.
+    """
+    results_dict = {}
+    for name, result in results.items():
+        if isinstance(result, dict) and 'value' in result:
+            results_dict[name] = result['value']
+            if 'error' in result:
+                results_dict[name + '_error'] = result['error']
         else:
-            items.append((new_key, v))
-    return dict(items)
+            results_dict[name] = result
+    return results_dict
+
 
+def use_integration_plan(data, plan=integration_plan):
+    """
+    Replace the circular average of a loaded SciAnalysis data object with the precomputed plan.
+    Calls with options the plan was not built for fall back to the SciAnalysis implementation.
+    """
+    circular_average_q_bin = data.circular_average_q_bin
+
+    def planned_circular_average_q_bin(bins_relative=1.0, error=False, **kwargs):
+        if bins_relative != 1.0 or kwargs:
+            return circular_average_q_bin(bins_relative=bins_relative, error=error, **kwargs)
+        q, I, *I_err = plan.integrate(data.data, error=error)
+        line = DataLine(
+            x=q,
+            y=I,
+            x_label='q',
+            y_label='I(q)',
+            x_rlabel=r'$q \, (\mathrm{\AA^{-1}})$',
+            y_rlabel=r'$I(q) \, (\mathrm{counts/pixel})$',
+        )
+        if error:
+            line.y_err = I_err[0]
+        return line
 
+    data.circular_average_q_bin = planned_circular_average_q_bin
+    return data
 
 
+def load_data(infile):
+    """Load a detector image with SciAnalysis, circular averages use the precomputed integration plan."""
+    return use_integration_plan(process.load(infile, **process.load_args))
 
 
-def reduce_run(bluesky_run):
+def run_protocols(infile, save_results=False, data=None, skip=()):
+    """
+    Run the SciAnalysis protocols on one file and return the results from memory.
+
+    Parameters
+    ----------
+    infile : str
+        Path to the detector image.
+    save_results : bool, optional
+        Also store the results and plots in output_dir, as process.run would, by default False.
+        Otherwise the protocols run with no save_results in a temporary directory removed
+        afterwards, so nothing is written under output_dir and nothing piles up.
+    data : Data2DScattering, optional
+        The image already loaded with load_data, by default it is loaded from infile.
+    skip : Collection[str], optional
+        Names of protocols not run, e.g. those fit in a batch.
+
+    Returns
+    -------
+    results_dict : dict
+        Results of each protocol keyed by protocol name, matching ResultsDB.extract_single.
+    """
+    data = load_data(infile) if data is None else data
+    run_args = process.run_args if save_results else dict(process.run_args, save_results=[])
+    results_dict = {}
+    # protocols need an output directory even when nothing is saved
+    with tempfile.TemporaryDirectory(prefix='cms-reduction-') as scratch_dir:
+        for protocol in protocols:
+            if protocol.name in skip:
+                continue
+            output_dir_current = process.access_dir(output_dir, protocol.name) if save_results else scratch_dir
+            results = protocol.run(data, output_dir_current, **run_args)
+            if save_results:
+                process.store_results(results, output_dir, infile, protocol, infile=data.infile)
+            results_dict[protocol.name] = protocol_results_to_dict(results)
+    return results_dict
+
+
+def batch_q2I_fit(images, fit_args=q2I_fit_args):
+    """
+    Fit the circular_average_q2I_fit model to many images at once, see cms_agents.fitting.
+
+    The images share the detector geometry and mask, so all are integrated with the same plan
+    and the curves are fit together.
+
+    Returns
+    -------
+    results : list of dict
+        For each image, the circular_average_q2I_fit results in the form of run_protocols.
+    """
+    curves = []
+    for image in images:
+        q, intensity = integration_plan.integrate(image)
+        curves.append(intensity)
+    return [protocol_results_to_dict(results) for results in fit_q2I_peaks(q, np.stack(curves), **fit_args)]
+
+
+def raw_tiff_path(start_doc):
+    """Expected path of the Pilatus2M TIFF written for a run."""
+    dir = start_doc['experiment_alias_directory']
+    filename = start_doc['filename']
+    return '{}saxs/raw/{}_saxs.tiff'.format(dir, filename)
+
+
+def reduce_run(bluesky_run, save_results=False, timer=None):
     """
     Reduce data from a single bluesky run.
 
@@ -122,6 +246,10 @@ def reduce_run(bluesky_run):
     ----------
     bluesky_run : BlueskyRun
         The run to be reduced, assumed to be a v2 run object.
+    save_results : bool, optional
+        Also write the SciAnalysis results to output_dir, by default False.
+    timer : StageTimer, optional
+        Marks the "process_run" and "results_extracted" stages.
 
     Returns
     -------
@@ -131,7 +259,7 @@ def reduce_run(bluesky_run):
     metadata : dict
         Will be top-level in the reduced start document
     """
-    print(f"give reduced on run {bluesky_run}")
+    logger.debug("give reduced on run %s", bluesky_run)
     reduced = {}
     reduced["next big thing"] = "avocado toast"
 
@@ -139,17 +267,12 @@ def reduce_run(bluesky_run):
 
     # SciAnalysis code goes here
     ########################################
-    verbosity = 3
-    if verbosity>=3:
-        print("Starting SciAnalysis analysis...")
+    logger.debug("Starting SciAnalysis analysis...")
     
     # Determine filename
-    dir = bluesky_run.metadata['start']['experiment_alias_directory']
-    filename = bluesky_run.metadata['start']['filename']
-    infile = '{}saxs/raw/{}_saxs.tiff'.format(dir, filename)
+    infile = raw_tiff_path(bluesky_run.metadata['start'])
 
-    if verbosity>=3:
-        print(f"Running SciAnalysis on: {infile}")
+    logger.debug("Running SciAnalysis on: %s", infile)
 
 
     # Access raw data
@@ -162,17 +285,30 @@ def reduce_run(bluesky_run):
 
 
     # Run SciAnalysis
-    process.run([infile], protocols, output_dir=output_dir, force=True)
-    results_dict = ResultsDB(source_dir=output_dir).extract_single(infile, verbosity=verbosity)
+    results_dict = run_protocols(infile, save_results=save_results)
+    if timer is not None:
+        timer.mark("process_run")
+    reduced.update(reduced_from_results(results_dict))
+    if timer is not None:
+        timer.mark("results_extracted")
+    
+    # End of SciAnalysis specific code
+    ########################################
+
+
+
+    return reduced, {"raw_start": bluesky_run.metadata["start"]}
+
+
+def reduced_from_results(results_dict):
+    """Reduced event data from the results of run_protocols."""
+    reduced = {}
     value = results_dict['circular_average_q2I_fit']['fit_peaks_prefactor1']
     #error = results_dict['circular_average_q2I_fit']['fit_peaks_prefactor1_error']
     error = value*0.01
     variance = np.square(error)
 
-    if verbosity>=4:
-        print("SciAnalysis generated results_dict:")
-        #print(results_dict)
-        pprint.pprint(results_dict)
+    logger.debug("SciAnalysis generated results_dict:\n%s", LazyPformat(results_dict))
 
     # Flatten results_dict to put it into reduced dict
     results_dict = flatten_dict(results_dict, sep="__")
@@ -183,98 +319,434 @@ def reduce_run(bluesky_run):
     reduced['value'] = value*n
     reduced['variance'] = variance*n
     reduced['analyzed'] = True
-    
-    # End of SciAnalysis specific code
-    ########################################
+    return reduced
 
 
+def reduce_runs(bluesky_runs, save_results=False):
+    """
+    Reduce several runs, fitting circular_average_q2I_fit to all of their curves in one batch.
 
-    return reduced, {"raw_start": bluesky_run.metadata["start"]}
+    The other protocols run on each run as in reduce_run. The runs must share the detector
+    geometry and mask of integration_plan.
 
+    Returns
+    -------
+    results : list
+        For each run, (reduced, metadata) as returned by reduce_run, or the exception raised
+        while loading or processing it.
+    """
+    fitted = 'circular_average_q2I_fit'
+    loaded, results = [], [None] * len(bluesky_runs)
+    for i, bluesky_run in enumerate(bluesky_runs):
+        infile = raw_tiff_path(bluesky_run.metadata['start'])
+        try:
+            data = load_data(infile)
+            results_dict = run_protocols(infile, save_results=save_results, data=data, skip=(fitted,))
+        except Exception as ex:
+            results[i] = ex
+            continue
+        loaded.append((i, data, results_dict))
+    if loaded:
+        fits = batch_q2I_fit([data.data for _, data, _ in loaded])
+        for (i, _, results_dict), fit in zip(loaded, fits):
+            results_dict[fitted] = fit
+            reduced = {"next big thing": "avocado toast"}
+            try:
+                reduced.update(reduced_from_results(results_dict))
+            except Exception as ex:
+                results[i] = ex
+                continue
+            results[i] = reduced, {"raw_start": bluesky_runs[i].metadata["start"]}
+    return results
+
+
+def build_output_reduced_document(kafka_config, testing=False, metrics=None):
+    """
+    Build the callable that sends each reduced document to its destinations.
 
-def publish_reduced_documents(reduced, metadata, reduced_publisher):
-    cr = compose_run(metadata=metadata)
-    reduced_publisher("start", cr.start_doc)
+    Parameters
+    ----------
+    kafka_config : dict
+        Contents of /etc/bluesky/kafka.yml
+    testing : bool
+        If True send reduced documents only to the console.
+    metrics : StageMetrics or ObservationBuffer, optional
+        Records the delivery latency of every document to each destination.
 
-    desc_bundle = cr.compose_descriptor(
-        name="primary",
-        data_keys={
-            k: {
-                "dtype": data_type(v),
-                "shape": data_shape(v),
-                "source": "computed",
-            }
-            for k, v in reduced.items()
-        },
+    Returns
+    -------
+    output_reduced_document : callable
+        Function with signature (name, doc)
+    """
+    if testing:
+        def output_reduced_document(name, doc):
+            logger.info("output document: %s", DocumentSummary(name, doc))
+            logger.debug("contents: %s", LazyPformat(doc))
+    else:
+        cms_sandbox_tiled_client = get_client("cms_bluesky_sandbox")
+        reduced_publisher = Publisher(
+            key="",
+            topic="cms.bluesky.reduced.documents",
+            bootstrap_servers=",".join(kafka_config["bootstrap_servers"]),
+            producer_config=kafka_config["runengine_producer_config"],
+        )
+
+        # insert into Tiled and publish to Kafka concurrently, off the reduction thread
+        output_reduced_document = DocumentSinks(
+            tiled_sink(cms_sandbox_tiled_client, metrics=metrics),
+            kafka_sink(reduced_publisher, metrics=metrics),
+        )
+
+    return output_reduced_document
+
+
+class StartDocumentRun:
+    """
+    Stand-in for a Tiled run built from the start document seen on Kafka.
+    reduce_run only reads the start metadata, which the start document already carries.
+    """
+
+    def __init__(self, start_doc):
+        self.metadata = {"start": start_doc}
+
+    def __repr__(self):
+        return f"<StartDocumentRun uid={self.metadata['start']['uid']!r}>"
+
+
+def _resolve_run(run_start_id, cms_tiled_client, prefetched, timer):
+    run_future = prefetched.get("run")
+    if run_future is not None and run_future.done() and run_future.exception() is None:
+        timer.mark("run_prefetched")
+        return run_future.result()
+    if "start" in prefetched:
+        timer.mark("run_prefetched")
+        return StartDocumentRun(prefetched["start"])
+    bluesky_run = cms_tiled_client[run_start_id]
+    timer.mark("tiled_fetched")
+    return bluesky_run
+
+
+def reduction_config_hash():
+    """Fingerprint of everything reduce_run depends on, used to key the reduction cache."""
+    return config_fingerprint(
+        [(protocol.name, getattr(protocol, 'run_args', {})) for protocol in protocols],
+        patterns,
+        detector_geometry,
+        integration_plan.key,
+    )
+
+
+def reduce_and_publish(
+    run_start_id,
+    cms_tiled_client,
+    output_reduced_document,
+    file_timeout=30.0,
+    save_results=False,
+    cache=None,
+    timer=None,
+    prefetched=None,
+    stream=None,
+):
+    """
+    Reduce one run and publish the reduced documents.
+
+    Parameters
+    ----------
+    prefetched : dict, optional
+        Context prepared by RunPrefetcher when the run started, see RunPrefetcher.pop.
+        "file_ready" may also be True if the file is already known to be complete.
+    stream : ReducedRunStream, optional
+        Append the reduced event to this long-lived run, by default each run gets its own reduced run.
+
+    Returns
+    -------
+    timer : StageTimer
+        Time spent in each stage, started when the stop document was received if ``timer`` was given.
+    delivery : concurrent.futures.Future
+        Resolved once every published document is delivered, failed with DeliveryError if one is not.
+    """
+    timer = StageTimer() if timer is None else timer
+    timer.mark("queued")
+    logger.info("found run_start id %s", run_start_id)
+    # DocumentSinks return a future per document, the console output of testing delivers right away
+    deliveries = []
+
+    def timed_output_reduced_document(name, doc):
+        deliveries.append(output_reduced_document(name, doc))
+        timer.mark(f"publish_{name}")
+
+    publish = publish_reduced_documents if stream is None else stream.publish
+
+    if cache is not None:
+        cached = cache.get(run_start_id)
+        timer.mark("cache_lookup")
+        if cached is not None:
+            logger.info("publishing cached reduction of run_start id %s", run_start_id)
+            publish(*cached, timed_output_reduced_document)
+            return timer, all_delivered(deliveries)
+    # look up the results of this run
+    prefetched = prefetched or {}
+    bluesky_run = _resolve_run(run_start_id, cms_tiled_client, prefetched, timer)
+    # wait until the detector has finished writing the file
+    infile = raw_tiff_path(bluesky_run.metadata["start"])
+    try:
+        wait_for_prefetched_file(infile, prefetched.get("file_ready"), timeout=file_timeout)
+    except TimeoutError as ex:
+        logger.warning("skipping run_start id %s: %s", run_start_id, ex)
+        return timer, all_delivered(deliveries)
+    timer.mark("file_ready")
+    reduced, metadata = reduce_run(bluesky_run, save_results=save_results, timer=timer)
+    publish(reduced, metadata, timed_output_reduced_document)
+    if cache is not None:
+        cache.put(run_start_id, reduced, metadata)
+    if isinstance(output_reduced_document, DocumentSinks):
+        logger.info("reduced document sinks: %s", output_reduced_document.summary())
+    logger.info("reduced run_start id %s in %.3f s", run_start_id, timer.total())
+    return timer, all_delivered(deliveries)
+
+
+# Worker pool
+########################################
+# Each worker process is forked after the SciAnalysis setup above, so the
+# processor, calibration and mask are already loaded. The Tiled client and
+# the Kafka publisher are built once per worker by the initializer.
+# Stage timings are returned to the parent process, which serves the metrics.
+_worker_state = {}
+
+
+def _init_reduction_worker(kafka_config, testing, reduce_kwargs, stream_max_age=None):
+    _worker_state["reduce_kwargs"] = reduce_kwargs
+    _worker_state["cms_tiled_client"] = RunCache(get_client("cms"))
+    _worker_state["observations"] = ObservationBuffer()
+    _worker_state["output_reduced_document"] = build_output_reduced_document(
+        kafka_config, testing=testing, metrics=_worker_state["observations"]
     )
+    _worker_state["stream"] = None
+    if stream_max_age is not None:
+        # every worker appends to its own reduced run, stopped when the worker exits
+        _worker_state["stream"] = ReducedRunStream(max_age=stream_max_age)
+        multiprocessing.util.Finalize(_worker_state["stream"], _close_worker_stream, exitpriority=10)
+
+
+def _close_worker_stream():
+    _worker_state["stream"].close()
+    output_reduced_document = _worker_state["output_reduced_document"]
+    if isinstance(output_reduced_document, DocumentSinks):
+        output_reduced_document.close()
+
+
+def _worker_ready():
+    return multiprocessing.current_process().name
 
-    reduced_publisher("descriptor", desc_bundle.descriptor_doc)
-    t = ttime.time()
-    reduced_publisher(
-        "event",
-        desc_bundle.compose_event(
-            data=reduced,
-            timestamps={k: t for k in reduced},
-        ),
+
+def _worker_reduce_and_publish(run_start_id, timer, prefetched=None):
+    timer, delivery = reduce_and_publish(
+        run_start_id,
+        _worker_state["cms_tiled_client"],
+        _worker_state["output_reduced_document"],
+        timer=timer,
+        prefetched=prefetched,
+        stream=_worker_state["stream"],
+        **_worker_state["reduce_kwargs"],
     )
+    # raises DeliveryError in the parent process, which then leaves the stop document uncommitted
+    delivery.result()
+    return run_start_id, timer, _worker_state["observations"].drain()
 
-    reduced_publisher("stop", cr.compose_stop())
 
+def start_reduction_pool(kafka_config, num_workers, testing=False, stream_max_age=None, **reduce_kwargs):
+    """
+    Start a pool of reduction worker processes and wait until every worker is ready.
 
-def respond_to_stop_with_reduced(consumer_topic: str, testing: bool = False):
+    Parameters
+    ----------
+    kafka_config : dict
+        Contents of /etc/bluesky/kafka.yml
+    num_workers : int
+        Number of worker processes
+    testing : bool
+        If True workers send reduced documents only to the console.
+    stream_max_age : float, optional
+        If given, each worker appends to a long-lived reduced run, see ReducedRunStream.
+    **reduce_kwargs
+        Passed to reduce_and_publish for every run.
 
-    kafka_config = nslsii.kafka_utils._read_bluesky_kafka_config_file(config_file_path="/etc/bluesky/kafka.yml")
+    Returns
+    -------
+    executor : ProcessPoolExecutor
+    """
+    executor = ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_reduction_worker,
+        initargs=(kafka_config, testing, reduce_kwargs, stream_max_age),
+    )
+    # submit one task per worker so all processes are started and initialized
+    #   before the first stop document arrives
+    ready = [executor.submit(_worker_ready) for _ in range(num_workers)]
+    for future in ready:
+        logger.info("reduction worker %s is ready", future.result())
+    return executor
+
+
+def respond_to_stop_with_reduced(
+    consumer_topic: str,
+    testing: bool = False,
+    num_workers: int = 0,
+    file_timeout: float = 30.0,
+    save_results: bool = False,
+    cache_dir: str = None,
+    cache_max_mb: float = 1024,
+    metrics_port: int = None,
+    group_id: str = None,
+    stream_max_age: float = None,
+    max_backlog: int = None,
+    max_survey_age: float = None,
+):
 
-    cms_tiled_client = from_profile("cms")
-    
-    if testing:
-        def output_reduced_document(name, doc):
-            print(
-                f"{datetime.datetime.now().isoformat()} output document: {name}\n"
-                f"contents: {pprint.pformat(doc)}\n"
+    kafka_config = nslsii.kafka_utils._read_bluesky_kafka_config_file(config_file_path="/etc/bluesky/kafka.yml")
+    cache = None
+    if cache_dir:
+        cache = ReductionCache(reduction_config_hash(), cache_dir=cache_dir, max_bytes=int(cache_max_mb * 2**20))
+    reduce_kwargs = dict(file_timeout=file_timeout, save_results=save_results, cache=cache)
+    metrics = StageMetrics()
+    if metrics_port is not None:
+        serve_metrics(metrics, metrics_port)
+
+    def finished(commit_token):
+        # in a shared consumer group, commit the stop document only once its reduction is delivered
+        if commit_token is not None:
+            kafka_dispatcher.committer.done(commit_token)
+
+    def delivered(run_start_id, commit_token, delivery):
+        if delivery.exception() is not None:
+            logger.error(
+                "reduced documents of run_start id %s not delivered: %s", run_start_id, delivery.exception()
             )
-    else:
-        cms_sandbox_tiled_client = from_profile("cms_bluesky_sandbox")
-        reduced_publisher = Publisher(
-            key="",
-            topic="cms.bluesky.reduced.documents",
-            bootstrap_servers=",".join(kafka_config["bootstrap_servers"]),
-            producer_config=kafka_config["runengine_producer_config"],
+            return
+        finished(commit_token)
+
+    if num_workers > 0:
+        # start the workers before the Kafka consumer exists so it is not inherited by the forks
+        executor = start_reduction_pool(
+            kafka_config, num_workers, testing=testing, stream_max_age=stream_max_age, **reduce_kwargs
         )
 
-        def output_reduced_document(name, doc):
-            cms_sandbox_tiled_client.v1.insert(name, doc)
-            reduced_publisher(name, doc)
+        # runs are prefetched in this process, the workers get the start document and whether the file is ready
+        prefetcher = RunPrefetcher(raw_tiff_path)
+
+        def handle_stop(run_start_id, timer, commit_token=None):
+            prefetched = prefetcher.pop(run_start_id)
+            if prefetched is not None:
+                file_ready = prefetched["file_ready"]
+                prefetched = dict(start=prefetched["start"])
+                if file_seen(file_ready):
+                    prefetched["file_ready"] = True
+            future = executor.submit(_worker_reduce_and_publish, run_start_id, timer, prefetched)
+            try:
+                run_start_id, timer, observations = future.result()
+            except DeliveryError:
+                # left uncommitted, so the stop document is consumed again after a restart
+                raise
+            except Exception:
+                # the reduction itself failed, it would fail again after a restart
+                finished(commit_token)
+                raise
+            finished(commit_token)
+            metrics.observe_timer(timer)
+            for stage, seconds in observations:
+                metrics.observe(stage, seconds)
+            logger.info("published reduced documents for run_start id %s", run_start_id)
+
+    else:
+        cms_tiled_client = RunCache(get_client("cms"))
+        output_reduced_document = build_output_reduced_document(kafka_config, testing=testing, metrics=metrics)
+        prefetcher = RunPrefetcher(raw_tiff_path, cms_tiled_client)
+        stream = None
+        if stream_max_age is not None:
+            stream = ReducedRunStream(max_age=stream_max_age)
+            # registered after the sinks, so the stop document is sent before they close
+            atexit.register(stream.close)
+
+        def handle_stop(run_start_id, timer, commit_token=None):
+            try:
+                timer, delivery = reduce_and_publish(
+                    run_start_id,
+                    cms_tiled_client,
+                    output_reduced_document,
+                    timer=timer,
+                    prefetched=prefetcher.pop(run_start_id),
+                    stream=stream,
+                    **reduce_kwargs,
+                )
+            except Exception:
+                # the reduction itself failed, it would fail again after a restart
+                finished(commit_token)
+                raise
+            # committed from the sink thread once the reduced run is stored and announced
+            delivery.add_done_callback(lambda future: delivered(run_start_id, commit_token, future))
+            metrics.observe_timer(timer)
+
+    def shed_stop(run_start_id, timer, commit_token=None):
+        prefetcher.pop(run_start_id)
+        finished(commit_token)
+
+    # stop documents wait here, so runs an agent is waiting for can be reduced first
+    scheduler = ReductionScheduler(
+        handle_stop,
+        concurrency=max(num_workers, 1),
+        max_backlog=max_backlog,
+        max_age=max_survey_age,
+        on_shed=shed_stop,
+    ).start()
+    metrics.set_gauge("reductions_pending", lambda: scheduler.depth() + scheduler.running)
+    metrics.set_gauge("queue_depth", scheduler.depth)
+    metrics.set_gauge("queue_oldest_age_seconds", scheduler.oldest_age)
+    metrics.set_gauge("runs_shed", lambda: scheduler.shed)
 
     def on_stop_reduce_run(name, doc):
-        print(
-            f"{datetime.datetime.now().isoformat()} document: {name}\n"
-            f"contents: {pprint.pformat(doc)}\n"
-        )
-        if name == "stop":
-            # wait briefly for the filesystem to collect itself
-            print("taking a nap!")
-            ttime.sleep(1)
-            print("I'm awake!")
-            # look up the results of this run
+        logger.debug("document: %s", DocumentSummary(name, doc))
+        if name == "start":
+            prefetcher.on_start(doc)
+        elif name == "stop":
+            timer = StageTimer()
+            commit_token = kafka_dispatcher.committer.track() if group_id else None
             run_start_id = doc["run_start"]
-            print(f"found run_start id {run_start_id}")
-            bluesky_run = cms_tiled_client[run_start_id]
-            reduced, metadata = reduce_run(bluesky_run)
-            publish_reduced_documents(reduced, metadata, output_reduced_document)
+            urgent = agent_requested(prefetcher.start_doc(run_start_id))
+            scheduler.submit(run_start_id, timer, urgent=urgent, commit_token=commit_token)
+            logger.info(
+                "queued %srun_start id %s, %d runs queued",
+                "agent-requested " if urgent else "",
+                run_start_id,
+                scheduler.depth(),
+            )
         else:
             pass
 
-    # this consumer should not be in a group with other consumers
-    #   so generate a unique consumer group id for it
-    unique_group_id = f"reduce-{str(uuid.uuid4())[:8]}"
-
-    kafka_dispatcher = RemoteDispatcher(
+    dispatcher_kwargs = dict(
         topics=[consumer_topic],
         bootstrap_servers=",".join(kafka_config["bootstrap_servers"]),
-        group_id=unique_group_id,
-        consumer_config=kafka_config["runengine_producer_config"],
+        # only start and stop documents are used, skip decoding everything else
+        deserializer=name_filtering_deserializer(["start", "stop"]),
     )
+    if group_id:
+        # replicas share the consumer group, so each stop document is reduced by one replica,
+        #   and offsets are committed only after the reduced documents are published
+        kafka_dispatcher = CommittingDispatcher(
+            group_id=group_id,
+            consumer_config={**kafka_config["runengine_producer_config"], "enable.auto.commit": False},
+            **dispatcher_kwargs,
+        )
+    else:
+        # this consumer should not be in a group with other consumers
+        #   so generate a unique consumer group id for it
+        unique_group_id = f"reduce-{str(uuid.uuid4())[:8]}"
+
+        kafka_dispatcher = RemoteDispatcher(
+            group_id=unique_group_id,
+            consumer_config=kafka_config["runengine_producer_config"],
+            **dispatcher_kwargs,
+        )
 
     kafka_dispatcher.subscribe(on_stop_reduce_run)
     kafka_dispatcher.start()
@@ -296,10 +768,85 @@ def get_args():
         help="reduction_agent will send output only to the console"
     )
 
+    parser.add_argument(
+        "--num-workers",
+        default=0,
+        type=int,
+        help="number of reduction worker processes, 0 reduces each run in a scheduler thread of this process",
+    )
+
+    parser.add_argument(
+        "--file-timeout",
+        default=30.0,
+        type=float,
+        help="seconds to wait for the detector TIFF of a run before skipping it",
+    )
+
+    parser.add_argument(
+        "--save-results",
+        default=False,
+        action="store_true",
+        help="also write SciAnalysis results to the output directory",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help="directory of cached reduction results, an empty string disables the cache",
+    )
+
+    parser.add_argument(
+        "--cache-max-mb",
+        default=1024,
+        type=float,
+        help="size limit of the reduction cache in MB",
+    )
+
+    parser.add_argument(
+        "--metrics-port",
+        default=None,
+        type=int,
+        help="serve stage latency histograms on this port at /metrics, and a JSON summary at /summary",
+    )
+
+    parser.add_argument(
+        "--group-id",
+        default=None,
+        help="Kafka consumer group shared by reducer replicas, by default each reducer sees every document",
+    )
+
+    parser.add_argument(
+        "--stream-max-age",
+        default=None,
+        type=float,
+        help="append reduced events to one long-lived reduced run, started anew after this many seconds",
+    )
+
+    parser.add_argument(
+        "--max-backlog",
+        default=None,
+        type=int,
+        help="maximum number of runs waiting to be reduced, the oldest survey runs are dropped beyond it",
+    )
+
+    parser.add_argument(
+        "--max-survey-age",
+        default=None,
+        type=float,
+        help="drop survey runs, i.e. runs not requested by an agent, that waited longer than this many seconds",
+    )
+
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        help="logging level, DEBUG also logs every incoming document",
+    )
+
     return parser.parse_args()
 
 
 if __name__ == "__main__":
-    args = get_args()
-    print('Starting respond_to_stop_with_reduced loop...')
-    respond_to_stop_with_reduced(**vars(args))
+    args = vars(get_args())
+    logging.basicConfig(level=args.pop("log_level").upper(), format=LOG_FORMAT)
+    logger.info('Starting respond_to_stop_with_reduced loop...')
+    respond_to_stop_with_reduced(**args)
@@ -0,0 +1,330 @@
+"""Deliver reduced documents to Tiled and Kafka from background threads.
+
+Each destination gets its own ``BackgroundSink``: a bounded queue drained by a
+single thread, so documents reach every destination in the order they were
+produced while the destinations are written concurrently. Whatever has queued
+up while a delivery was in progress is delivered as the next batch, which lets
+the Kafka sink flush once per batch and the Tiled sink insert several
+documents, possibly from several runs, per wakeup.
+
+A failed delivery is retried with exponential backoff. Every queued document
+gets a future, resolved once it is delivered or failed with ``DeliveryError``
+once the retries are exhausted, so callers can tell when a run is safely out,
+e.g. before committing its Kafka offset.
+"""
+import atexit
+import collections
+import logging
+import queue
+import threading
+import time as ttime
+from concurrent.futures import Future
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class DeliveryError(Exception):
+    """A document could not be delivered to a destination."""
+
+
+def all_delivered(futures) -> Future:
+    """
+    Future resolved once every future of ``futures`` is, failed with the first error if any fails.
+
+    None entries, e.g. returned by a callback that delivers synchronously, count as delivered.
+    """
+    combined = Future()
+    futures = [future for future in futures if future is not None]
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            if combined.done():
+                return
+            if future.exception() is not None:
+                combined.set_exception(future.exception())
+            elif not remaining[0]:
+                combined.set_result(None)
+
+    if not futures:
+        combined.set_result(None)
+    for future in futures:
+        future.add_done_callback(done)
+    return combined
+
+
+class BackgroundSink:
+    """Deliver (name, doc) pairs to one destination from a background thread.
+
+    Parameters
+    ----------
+    name : str
+        Name of the destination, used in the statistics.
+    deliver_batch : callable
+        Function taking a list of (name, doc) pairs and delivering them in order. It may remove
+        documents from the front of the list as they are delivered, a retry then delivers the rest only.
+    max_queue : int, optional
+        Maximum number of queued documents, callers block when the queue is full, by default 1000.
+    max_batch : int, optional
+        Maximum number of documents passed to one ``deliver_batch`` call, by default 64.
+    history : int, optional
+        Number of recent latencies kept for the statistics, by default 1000.
+    metrics : StageMetrics, optional
+        Also record each document's latency as the stage "deliver_{name}".
+    retries : int, optional
+        Number of times a failed delivery is retried before its documents are given up, by default 5.
+    retry_delay : float, optional
+        Seconds before the first retry, doubled for every further one, by default 0.5.
+    """
+
+    def __init__(
+        self,
+        name,
+        deliver_batch,
+        *,
+        max_queue=1000,
+        max_batch=64,
+        history=1000,
+        metrics=None,
+        retries=5,
+        retry_delay=0.5,
+    ):
+        self.name = name
+        self._metrics = metrics
+        self._deliver_batch = deliver_batch
+        self._max_batch = max_batch
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._latencies = collections.deque(maxlen=history)
+        self._batch_durations = collections.deque(maxlen=history)
+        self.delivered = 0
+        self.batches = 0
+        self.errors = 0
+        self.retried = 0
+        self._thread = threading.Thread(target=self._run, name=f"sink-{name}", daemon=True)
+        self._thread.start()
+
+    def __call__(self, name, doc) -> Future:
+        """Queue a document, returns a future resolved once it is delivered."""
+        future = Future()
+        self._queue.put((name, doc, ttime.monotonic(), future))
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self._max_batch and batch[-1] is not _STOP:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stopping = batch[-1] is _STOP
+            if stopping:
+                batch.pop()
+            if batch:
+                self._deliver(batch)
+            if stopping:
+                return
+
+    def _deliver(self, batch):
+        start = ttime.monotonic()
+        pending = [(name, doc) for name, doc, _, _ in batch]
+        for attempt in range(self._retries + 1):
+            try:
+                self._deliver_batch(pending)
+                break
+            except Exception as ex:
+                if attempt == self._retries:
+                    self.errors += 1
+                    logger.exception("%s sink failed to deliver %d documents", self.name, len(pending))
+                    error = DeliveryError(f"{self.name} sink failed to deliver documents: {ex!r}")
+                    delivered = len(batch) - len(pending)
+                    for _, _, _, future in batch[delivered:]:
+                        future.set_exception(error)
+                    batch = batch[:delivered]
+                    break
+                delay = self._retry_delay * 2**attempt
+                self.retried += 1
+                logger.warning(
+                    "%s sink failed to deliver %d documents, retrying in %.1f s: %r",
+                    self.name,
+                    len(pending),
+                    delay,
+                    ex,
+                )
+                ttime.sleep(delay)
+        if not batch:
+            return
+        end = ttime.monotonic()
+        self._batch_durations.append(end - start)
+        latencies = [end - queued for _, _, queued, _ in batch]
+        self._latencies.extend(latencies)
+        if self._metrics is not None:
+            for latency in latencies:
+                self._metrics.observe(f"deliver_{self.name}", latency)
+        self.delivered += len(batch)
+        self.batches += 1
+        for _, _, _, future in batch:
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        """Counts and recent latencies in seconds, measured from queueing to delivery."""
+        latencies = np.array(self._latencies)
+        durations = np.array(self._batch_durations)
+        stats = dict(
+            queued=self._queue.qsize(),
+            delivered=self.delivered,
+            batches=self.batches,
+            errors=self.errors,
+            retried=self.retried,
+        )
+        if len(latencies):
+            stats.update(
+                latency_p50=float(np.percentile(latencies, 50)),
+                latency_p95=float(np.percentile(latencies, 95)),
+                latency_max=float(latencies.max()),
+                batch_duration_mean=float(durations.mean()),
+            )
+        return stats
+
+    def close(self, timeout=None):
+        """Deliver everything already queued and stop the background thread."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+
+class DocumentSinks:
+    """Send each document to several BackgroundSinks.
+
+    Instances are called like a bluesky callback, ``sinks(name, doc)``, and return immediately
+    unless a destination has fallen ``max_queue`` documents behind.
+
+    The first sink is the store the others announce runs from, e.g. Tiled before Kafka. A stop
+    document is passed to the other sinks only once the first one has delivered it, and with it
+    every earlier document of the run, so a consumer reacting to the stop finds the whole run stored.
+    The other sinks get every document in the order the sinks were called: a forwarding thread
+    holds back the documents that follow a stop, e.g. those of the next run, until the stop is
+    stored, and waits there instead of the first sink's thread when another sink is full.
+
+    Parameters
+    ----------
+    *sinks : BackgroundSink
+        Destinations, the first one is the store.
+    max_queue : int, optional
+        Maximum number of documents held for the other sinks, by default 1000.
+    """
+
+    def __init__(self, *sinks, max_queue=1000):
+        self.sinks = sinks
+        self._forward = queue.Queue(maxsize=max_queue)
+        self._forwarder = None
+        if len(sinks) > 1:
+            self._forwarder = threading.Thread(target=self._run_forward, name="sink-forward", daemon=True)
+            self._forwarder.start()
+        atexit.register(self.close)
+
+    def __call__(self, name, doc) -> Future:
+        """Queue a document, returns a future resolved once every sink delivered it."""
+        if self._forwarder is None:
+            return all_delivered([sink(name, doc) for sink in self.sinks])
+        stored = self.sinks[0](name, doc)
+        forwarded = Future()
+        self._forward.put((name, doc, stored if name == "stop" else None, forwarded))
+        return all_delivered([stored, forwarded])
+
+    def _run_forward(self):
+        others = self.sinks[1:]
+        while True:
+            item = self._forward.get()
+            if item is _STOP:
+                return
+            name, doc, stored, forwarded = item
+            if stored is not None and stored.exception() is not None:
+                # the run is not stored, it is not announced
+                forwarded.set_exception(stored.exception())
+                continue
+            delivered = all_delivered([sink(name, doc) for sink in others])
+            delivered.add_done_callback(
+                lambda f, forwarded=forwarded: (
+                    forwarded.set_exception(f.exception()) if f.exception() else forwarded.set_result(None)
+                )
+            )
+
+    def stats(self) -> dict:
+        return {sink.name: sink.stats() for sink in self.sinks}
+
+    def summary(self) -> str:
+        parts = []
+        for name, stats in self.stats().items():
+            part = f"{name}: {stats['delivered']} delivered, {stats['queued']} queued"
+            if "latency_p50" in stats:
+                part += f", latency p50 {stats['latency_p50']:.3f} s p95 {stats['latency_p95']:.3f} s"
+            parts.append(part)
+        return "; ".join(parts)
+
+    def close(self, timeout=None):
+        # held documents are forwarded before the sinks are closed
+        if self._forwarder is not None and self._forwarder.is_alive():
+            self._forward.put(_STOP)
+            self._forwarder.join(timeout)
+        for sink in self.sinks:
+            sink.close(timeout)
+
+
+def tiled_sink(tiled_client, **kwargs) -> BackgroundSink:
+    """Sink inserting documents into a Tiled node with a v1 (databroker) interface."""
+
+    def insert_batch(batch):
+        # documents are removed once inserted, so a retry does not insert them twice
+        while batch:
+            tiled_client.v1.insert(*batch[0])
+            del batch[0]
+
+    return BackgroundSink("tiled", insert_batch, **kwargs)
+
+
+def kafka_sink(publisher, **kwargs) -> BackgroundSink:
+    """Sink producing documents with a bluesky_kafka Publisher, flushing once per batch.
+
+    The publisher's delivery reports are recorded, so only the documents the broker did not
+    acknowledge are retried.
+    """
+    reports = []
+    report_delivery = publisher.on_delivery
+
+    def on_delivery(err, msg):
+        # called from produce and flush, on the sink thread
+        reports.append(err)
+        report_delivery(err, msg)
+
+    publisher.on_delivery = on_delivery
+
+    def publish_batch(batch):
+        reports.clear()
+        try:
+            for name, doc in batch:
+                publisher(name, doc)
+        finally:
+            # every document produced so far has its delivery reported once flushed
+            publisher.flush()
+            # reports of one key come in the order the documents were produced, the delivered
+            # ones are removed, so a retry does not produce them twice
+            errors = [err for err in reports if err is not None]
+            delivered = reports.index(errors[0]) if errors else len(reports)
+            del batch[:delivered]
+        if errors:
+            raise DeliveryError(f"{len(errors)} of {len(reports)} documents not delivered: {errors[0]}")
+
+    return BackgroundSink("kafka", publish_batch, **kwargs)
@@ -0,0 +1,85 @@
+"""Snapshots of agent state on local disk, for a fast restart.
+
+A snapshot is a single ``.npz`` file: the observations and model parameters
+are stored as arrays, everything else as a JSON document under the
+``__meta__`` key, together with the format version and the time it was
+written. Snapshots are written to a temporary file in the same directory and
+moved into place, so a crash while writing leaves the previous snapshot intact.
+"""
+import json
+import logging
+import os
+import tempfile
+import time as ttime
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+META_KEY = "__meta__"
+
+
+def write_snapshot(path: str, meta: dict, arrays: dict):
+    """
+    Atomically write a snapshot.
+
+    Parameters
+    ----------
+    path : str
+        Snapshot file, usually ending in ``.npz``.
+    meta : dict
+        JSON serializable state.
+    arrays : dict
+        Arrays keyed by name.
+    """
+    meta = dict(meta, version=SNAPSHOT_VERSION, written_at=ttime.time())
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".snapshot-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **{META_KEY: np.array(json.dumps(meta))}, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_snapshot(path: str):
+    """
+    Read a snapshot written by ``write_snapshot``.
+
+    Returns
+    -------
+    meta, arrays : dict, dict
+        Both None if there is no snapshot, or it is unreadable or of another format version.
+    """
+    if not os.path.exists(path):
+        return None, None
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            meta = json.loads(str(npz[META_KEY]))
+            arrays = {key: npz[key] for key in npz.files if key != META_KEY}
+    except Exception:
+        logger.exception("Unable to read the snapshot %s, ignoring it.", path)
+        return None, None
+    if meta.get("version") != SNAPSHOT_VERSION:
+        logger.warning("Ignoring the snapshot %s of version %s.", path, meta.get("version"))
+        return None, None
+    return meta, arrays
+
+
+def pack_arrays(values):
+    """Concatenate arrays of different lengths along the first axis, returns (values, lengths)."""
+    values = [np.atleast_1d(np.asarray(value)) for value in values]
+    if not values:
+        return np.empty(0), np.empty(0, dtype=int)
+    return np.concatenate(values), np.array([len(value) for value in values])
+
+
+def unpack_arrays(values, lengths):
+    """Split arrays concatenated by ``pack_arrays``."""
+    return np.split(values, np.cumsum(lengths)[:-1]) if len(lengths) else []
@@ -1,3 +1,4 @@
+import os
 from typing import List, Tuple
 
 from bluesky_adaptive.server import register_variable, shutdown_decorator, startup_decorator
@@ -22,18 +23,24 @@ class SingleTaskAgent(CMSSingleTaskAgent):
             point = point[0]
         return "agent_feedback_plan", [point], dict()
 
-    def trigger_condition(self, uid):
-        return (
-            self.independent_key in self.exp_catalog[uid].primary.data.keys()
-            and self.target_key in self.exp_catalog[uid].primary.data.keys()
-        )
-
     @property
     def name(self) -> str:
         return "AgentAndrei"
 
 
-agent = SingleTaskAgent(bounds=[0.0, 20.0], report_on_tell=False, ask_on_tell=False)
+# opt in to restarting from the state of the previous session by naming the campaign, e.g. the proposal
+#   and cycle, in CMS_AGENTS_CAMPAIGN, see CMSBaseAgent.restore_snapshot
+CAMPAIGN = os.environ.get("CMS_AGENTS_CAMPAIGN") or None
+SNAPSHOT_PATH = None
+if CAMPAIGN is not None:
+    SNAPSHOT_PATH = os.path.expanduser(f"~/.local/share/cms_agents/{CAMPAIGN}/gp_bt2.npz")
+agent = SingleTaskAgent(
+    bounds=[0.0, 20.0],
+    report_on_tell=False,
+    ask_on_tell=False,
+    snapshot_path=SNAPSHOT_PATH,
+    snapshot_key=CAMPAIGN,
+)
 
 
 @startup_decorator
@@ -1,3 +1,4 @@
+import os
 from typing import List, Sequence, Tuple, Union
 
 from bluesky_adaptive.server import shutdown_decorator, startup_decorator
@@ -28,14 +29,14 @@ class SequentialAgent(CMSSequentialAgent):
     def measurement_plan(self, point: ArrayLike) -> Tuple[str, List, dict]:
         return "agent_feedback_plan", [point], dict()
 
-    def trigger_condition(self, uid):
-        return (
-            self.independent_key in self.exp_catalog[uid].primary.data.keys()
-            and self.target_key in self.exp_catalog[uid].primary.data.keys()
-        )
-
 
-agent = SequentialAgent(sequence=[0.0, 5.0, 10.0, 15.0, 20.0])
+# opt in to restarting from the state of the previous session by naming the campaign, e.g. the proposal
+#   and cycle, in CMS_AGENTS_CAMPAIGN, see CMSBaseAgent.restore_snapshot
+CAMPAIGN = os.environ.get("CMS_AGENTS_CAMPAIGN") or None
+SNAPSHOT_PATH = None
+if CAMPAIGN is not None:
+    SNAPSHOT_PATH = os.path.expanduser(f"~/.local/share/cms_agents/{CAMPAIGN}/sequential_bt2.npz")
+agent = SequentialAgent(sequence=[0.0, 5.0, 10.0, 15.0, 20.0], snapshot_path=SNAPSHOT_PATH, snapshot_key=CAMPAIGN)
 
 
 @startup_decorator
@@ -0,0 +1,141 @@
+"""Incremental Gaussian process posterior for the GP agents.
+
+``IncrementalGP`` keeps the Cholesky factor of the training covariance of a
+botorch ``SingleTaskGP``, with its current hyperparameters. A new observation
+extends the factor by one row, O(n^2), instead of a new O(n^3) factorization.
+The hyperparameters are refit only every ``refit_every`` observations, or
+sooner when the marginal likelihood of the data under the current
+hyperparameters drifts from its value after the last fit. ``fit_gpytorch_mll``
+starts from the current hyperparameters, so each refit is warm-started.
+
+Predictions come from ``IncrementalGP.prediction_model``, a copy of the model
+whose gpytorch prediction caches are extended with ``get_fantasy_model`` for
+each new observation, instead of being recomputed from scratch as they are
+after ``set_train_data``.
+"""
+import copy
+import math
+
+import torch
+
+
+class IncrementalGP:
+    """Cached posterior of a SingleTaskGP, updated one observation at a time.
+
+    Parameters
+    ----------
+    model : botorch.models.SingleTaskGP
+        Model providing the training data, mean, kernel, noise and outcome transform.
+    refit_every : int, optional
+        Number of new observations after which the hyperparameters are refit, by default 10.
+    mll_tolerance : float, optional
+        Drop of the marginal log likelihood per observation since the last fit
+        above which the hyperparameters are refit early, by default 0.5.
+    """
+
+    def __init__(self, model, refit_every: int = 10, mll_tolerance: float = 0.5):
+        self.model = model
+        self.refit_every = refit_every
+        self.mll_tolerance = mll_tolerance
+        self.fitted_mll = None
+        self.told_since_fit = 0
+        self._chol = None
+        self._inputs = None
+        self._residuals = None
+        self._alpha = None
+        self._predictive = None
+
+    def _kernel(self, x1, x2):
+        return self.model.covar_module(x1, x2).to_dense().double()
+
+    def _mean(self, x):
+        return self.model.mean_module(x).double()
+
+    def _noise(self):
+        return self.model.likelihood.noise.detach().double().reshape(-1)[0]
+
+    def _train_data(self):
+        return self.model.train_inputs[0], self.model.train_targets
+
+    def __len__(self):
+        return 0 if self._inputs is None else len(self._inputs)
+
+    @torch.no_grad()
+    def reset(self):
+        """Factorize the training covariance from scratch, e.g. after the hyperparameters changed."""
+        self._predictive = None
+        inputs, targets = self._train_data()
+        covariance = self._kernel(inputs, inputs) + self._noise() * torch.eye(len(inputs), dtype=torch.float64)
+        self._chol = torch.linalg.cholesky(covariance)
+        self._inputs = inputs
+        self._residuals = targets.double() - self._mean(inputs)
+        self._solve()
+
+    def _solve(self):
+        self._alpha = torch.cholesky_solve(self._residuals.unsqueeze(-1), self._chol).squeeze(-1)
+
+    @torch.no_grad()
+    def update(self):
+        """Extend the factor with the observations added to the model since the last update."""
+        inputs, targets = self._train_data()
+        n = len(self)
+        if self._chol is None or len(inputs) < n:
+            self.reset()
+            self.told_since_fit += len(inputs)
+            return
+        new_inputs = inputs[n:]
+        if not len(new_inputs):
+            return
+        # block Cholesky update, [[L, 0], [B, C]] with B = K_no^T L^-T and C C^T = K_nn + s^2 I - B B^T
+        cross = self._kernel(self._inputs, new_inputs)
+        below = torch.linalg.solve_triangular(self._chol, cross, upper=False).T
+        noise = self._noise() * torch.eye(len(new_inputs), dtype=torch.float64)
+        corner = torch.linalg.cholesky(self._kernel(new_inputs, new_inputs) + noise - below @ below.T)
+        zeros = torch.zeros(n, len(new_inputs), dtype=torch.float64)
+        self._chol = torch.cat([torch.cat([self._chol, zeros], dim=1), torch.cat([below, corner], dim=1)], dim=0)
+        self._inputs = inputs
+        self._residuals = torch.cat([self._residuals, targets[n:].double() - self._mean(new_inputs)])
+        self._solve()
+        self.told_since_fit += len(new_inputs)
+
+    @torch.no_grad()
+    def log_marginal_likelihood(self) -> float:
+        """Marginal log likelihood per observation under the current hyperparameters."""
+        n = len(self)
+        fit = -0.5 * float(self._residuals @ self._alpha)
+        complexity = -float(torch.log(torch.diagonal(self._chol)).sum())
+        return (fit + complexity - 0.5 * n * math.log(2 * math.pi)) / n
+
+    def refit_due(self) -> bool:
+        """Whether the hyperparameters should be refit before the model is used."""
+        if self.fitted_mll is None or self.told_since_fit >= self.refit_every:
+            return True
+        return self.fitted_mll - self.log_marginal_likelihood() > self.mll_tolerance
+
+    def fitted(self):
+        """Record that the hyperparameters were just fit, and refactorize with them."""
+        self.reset()
+        self.fitted_mll = self.log_marginal_likelihood()
+        self.told_since_fit = 0
+
+    @torch.no_grad()
+    def prediction_model(self):
+        """
+        The model conditioned on every observation, with its prediction caches kept between calls.
+
+        Returns
+        -------
+        model : botorch.models.SingleTaskGP
+            A copy of ``model``, in eval mode, to build acquisition functions with.
+        """
+        inputs, targets = self._train_data()
+        if self._predictive is None:
+            self._predictive = copy.deepcopy(self.model).eval()
+            # fills the prediction caches, extended below for later observations
+            self._predictive.posterior(inputs[:1])
+            return self._predictive
+        n = len(self._predictive.train_targets)
+        if len(inputs) > n:
+            # the targets are set untransformed, as by set_train_data, so condition_on_observations is not used
+            self._predictive = self._predictive.get_fantasy_model(inputs[n:], targets[n:])
+        return self._predictive
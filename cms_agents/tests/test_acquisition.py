@@ -0,0 +1,50 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+models = pytest.importorskip("botorch.models")
+acquisition = pytest.importorskip("botorch.acquisition")
+
+from cms_agents.acquisition import GridAcquisition  # noqa: E402
+
+
+def make_model(n, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.rand(n, 1, dtype=torch.float64, generator=generator) * 20
+    dummy = torch.tensor([[0.0], [1.0]], dtype=torch.float64)
+    model = models.SingleTaskGP(dummy, dummy)
+    model.set_train_data(x, torch.sin(x / 3).squeeze(-1), strict=False)
+    return model.eval()
+
+
+def test_grid_covers_bounds():
+    grid = GridAcquisition(torch.tensor([[0.0, -1.0], [2.0, 1.0]]), max_points=100)
+    assert grid.points_per_dim == 10
+    assert grid.grid.shape == (100, 2)
+    torch.testing.assert_close(grid.grid.min(0).values, torch.tensor([0.0, -1.0], dtype=torch.float64))
+    torch.testing.assert_close(grid.grid.max(0).values, torch.tensor([2.0, 1.0], dtype=torch.float64))
+    with pytest.raises(ValueError):
+        GridAcquisition(torch.zeros(2, 4))
+
+
+def test_best_is_refined_past_the_grid():
+    model = make_model(20)
+    acqf = acquisition.PosteriorMean(model)
+    grid = GridAcquisition(torch.tensor([0.0, 20.0]), max_points=11, refine_points=41)
+    candidate, value = grid.best(acqf)
+    assert value >= GridAcquisition.evaluate(acqf, grid.grid).max()
+    dense = torch.linspace(0.0, 20.0, 2001, dtype=torch.float64).unsqueeze(-1)
+    dense_values = GridAcquisition.evaluate(acqf, dense)
+    # the refined grid has a step of 0.1
+    assert abs(float(candidate) - float(dense[dense_values.argmax()])) <= 0.1
+
+
+def test_select_batch_by_fantasization():
+    model = make_model(4)
+    grid = GridAcquisition(torch.tensor([0.0, 20.0]))
+    candidates, values = grid.select(model, lambda m: acquisition.UpperConfidenceBound(m, beta=4.0), q=3)
+    assert candidates.shape == (3, 1) and values.shape == (3,)
+    assert len(set(candidates.squeeze(-1).tolist())) == 3
+    # the model itself is not conditioned on the fantasies
+    assert model.train_inputs[0].shape == (4, 1)
+    again, _ = grid.select(model, lambda m: acquisition.UpperConfidenceBound(m, beta=4.0), q=3)
+    torch.testing.assert_close(again, candidates)
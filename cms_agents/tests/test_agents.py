@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("botorch")
+agents = pytest.importorskip("cms_agents.agents")
+
+
+class Consumer:
+    """Stands in for the Kafka consumer of an agent, nothing is consumed."""
+
+    def set_agent(self, agent):
+        pass
+
+    def subscribe(self, callback):
+        pass
+
+
+class Data:
+    def __init__(self, table):
+        self.table = table
+
+    def read(self, variables):
+        return {name: self.table[name] for name in variables}
+
+
+class Run:
+    def __init__(self, uid, table, stopped=True):
+        self.primary = type("Stream", (), {})()
+        self.primary.data = Data(table)
+        self.metadata = {"start": {"uid": uid}, "stop": {} if stopped else None}
+
+
+class SingleTaskAgent(agents.CMSSingleTaskAgent):
+    def measurement_plan(self, point):
+        # as in startup_scripts/gp_bt2.py
+        if isinstance(point, list):
+            point = point[0]
+        return "agent_feedback_plan", [point], dict()
+
+    @property
+    def name(self):
+        return "test-gp"
+
+
+class SequentialAgent(agents.CMSSequentialAgent):
+    @property
+    def name(self):
+        return "test-sequential"
+
+
+def make_agent(monkeypatch, cls, catalog, **kwargs):
+    objects = dict(kafka_consumer=Consumer(), kafka_producer=None, tiled_data_node=catalog)
+    objects.update(tiled_agent_node=None, qserver=None)
+    monkeypatch.setattr(cls, "get_beamline_objects", staticmethod(lambda: dict(objects)))
+    return cls(independent_key="x", target_key="value", **kwargs)
+
+
+@pytest.mark.parametrize(
+    "cls, kwargs", [(SingleTaskAgent, dict(bounds=[0.0, 10.0])), (SequentialAgent, dict(sequence=[1.0]))]
+)
+def test_catch_up_tells_each_new_event_of_an_open_run(monkeypatch, cls, kwargs):
+    table = {"x": np.arange(4.0), "value": np.arange(4.0) * 10}
+    agent = make_agent(monkeypatch, cls, {"r": Run("r", table, stopped=False)}, **kwargs)
+    monkeypatch.setattr(agent, "tell_history", lambda **kwargs: 0)
+    # the first event was told before the snapshot
+    agent._stream_rows = {"r": 1}
+    agent.catch_up(since=0.0)
+    if cls is SingleTaskAgent:
+        assert tuple(agent.inputs.shape) == (3, 1)
+        assert agent.targets.tolist() == [10.0, 20.0, 30.0]
+    else:
+        assert [float(x) for x in agent.independent_cache] == [1.0, 2.0, 3.0]
+        assert [float(y) for y in agent.observable_cache] == [10.0, 20.0, 30.0]
+    assert agent.tell_cache == ["r"] and agent._stream_rows == {"r": 4}
+    assert [(stream, doc["observations"]) for stream, doc, _ in agent._pending_events] == [("tell_history", 3)]
+
+
+def test_asked_points_reach_the_measurement_plan(monkeypatch):
+    agent = make_agent(monkeypatch, SingleTaskAgent, {}, bounds=[0.0, 10.0], grid_points=64)
+    agent.tell_many(np.array([1.0, 5.0, 9.0]), np.array([0.0, 2.0, 1.0]))
+    agent.tell_cache.append("r")
+    docs, points = agent.ask(batch_size=2)
+    assert len(docs) == 2 and len(points) == 2
+    suggestions = agent._create_suggestion_list(points, "ask-uid")
+    for point, suggestion in zip(points, suggestions):
+        (value,) = suggestion.plan_args
+        assert isinstance(value, float) and value == point[0]
+        assert 0.0 <= value <= 10.0
@@ -0,0 +1,44 @@
+import pandas as pd
+
+from cms_agents.batch_reduce import Journal, TableOutput, batch_reduce, parse_query, parse_scan_ids
+
+
+def fake_reduce(start_docs):
+    results, failed = [], []
+    for start_doc in start_docs:
+        if start_doc["scan_id"] == 13:
+            failed.append((start_doc["uid"], ValueError("unlucky")))
+            continue
+        results.append((start_doc["uid"], {"value": start_doc["scan_id"] * 2.0}, {"raw_start": start_doc}))
+    if any(start_doc["scan_id"] == 17 for start_doc in start_docs):
+        raise RuntimeError("worker lost")
+    return results, failed
+
+
+def test_parse_arguments():
+    assert parse_scan_ids("1200-1350, 1402,") == [(1200, 1350), (1402, 1402)]
+    assert parse_query(["exposure_time=10.0", "sample_name=PS-b-PMMA"]) == {
+        "exposure_time": 10.0,
+        "sample_name": "PS-b-PMMA",
+    }
+
+
+def test_batch_reduce_writes_table_and_resumes(tmp_path):
+    starts = {f"uid{i}": {"uid": f"uid{i}", "scan_id": i} for i in range(10, 20)}
+    output = TableOutput(str(tmp_path / "reduced.parquet"))
+    journal = Journal(str(tmp_path / "reduced.done"))
+    first = dict(list(starts.items())[:5])
+    options = dict(num_workers=2, batch_size=2, group_size=2, reduce=fake_reduce)
+    assert batch_reduce(first, output, journal, **options) == (4, 1)
+
+    # started again over every run, only the rest is reduced
+    output = TableOutput(str(tmp_path / "reduced.parquet"))
+    journal = Journal(str(tmp_path / "reduced.done"))
+    assert len(journal.done) == 4
+    # the group of 16 and 17 is lost as a whole, 13 alone
+    assert batch_reduce(starts, output, journal, **options) == (3, 3)
+
+    table = pd.read_parquet(tmp_path / "reduced.parquet")
+    assert sorted(table["scan_id"]) == [10, 11, 12, 14, 15, 18, 19]
+    assert (table["value"] == table["scan_id"] * 2.0).all()
+    assert sorted(table["raw_start_uid"]) == sorted(journal.done)
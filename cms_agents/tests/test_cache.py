@@ -0,0 +1,32 @@
+import os
+
+from cms_agents.cache import ReductionCache, config_fingerprint
+
+
+def test_cache_round_trip(tmp_path):
+    cache = ReductionCache(config_fingerprint({"q0": 0.012}), cache_dir=str(tmp_path))
+    assert cache.get("abc") is None
+    cache.put("abc", {"value": 1.5}, {"raw_start": {"uid": "abc"}})
+    assert cache.get("abc") == ({"value": 1.5}, {"raw_start": {"uid": "abc"}})
+
+
+def test_cache_is_keyed_by_configuration(tmp_path):
+    ReductionCache(config_fingerprint({"q0": 0.012}), cache_dir=str(tmp_path)).put("abc", {"value": 1.0}, {})
+    other = ReductionCache(config_fingerprint({"q0": 0.014}), cache_dir=str(tmp_path))
+    assert other.get("abc") is None
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ReductionCache("config", cache_dir=str(tmp_path), max_bytes=10**9)
+    payload = {"data": "x" * 1000}
+    for i, uid in enumerate(["a", "b", "c"]):
+        cache.put(uid, payload, {})
+        os.utime(cache._path(uid), (i, i))
+    # reading "a" makes it the most recently used entry
+    assert cache.get("a") is not None
+    cache.max_bytes = 2500
+    cache.evict()
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.size() <= 2500
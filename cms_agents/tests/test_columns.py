@@ -0,0 +1,192 @@
+import numpy as np
+import pytest
+
+from cms_agents.columns import ColumnCache, DataKeyIndex, EventPayloads, iter_history, read_history
+
+
+class Column:
+    def __init__(self, data, name):
+        self.data = data
+        self.name = name
+
+    def __getitem__(self, index):
+        rows = self.data.table[self.name][index]
+        self.data.requests.append((self.name, len(rows)))
+        return rows
+
+
+class Data:
+    """Stands in for the primary stream of a Tiled run, recording every request and the rows it transferred."""
+
+    def __init__(self, table):
+        self.table = table
+        self.requests = []
+
+    def read(self, variables):
+        self.requests.append(tuple(variables))
+        return {name: self.table[name] for name in variables}
+
+    def __getitem__(self, name):
+        return Column(self, name)
+
+
+class Run:
+    def __init__(self, uid, table, stopped=True):
+        self.primary = type("Stream", (), {})()
+        self.primary.data = Data(table)
+        self.metadata = {"start": {"uid": uid}, "stop": {} if stopped else None}
+
+
+def test_stopped_run_is_read_once_in_one_request():
+    run = Run("a", {"x": np.arange(3.0), "value": np.ones(3), "variance": np.zeros(3)})
+    cache = ColumnCache()
+    columns = cache.read(run, ["x", "value", "variance"])
+    np.testing.assert_array_equal(columns["x"], [0, 1, 2])
+    assert cache.read(run, ["x", "value"])["value"].tolist() == [1, 1, 1]
+    assert run.primary.data.requests == [("x", "value", "variance")]
+    with pytest.raises(KeyError):
+        cache.read(run, ["x", "missing"])
+
+
+def test_open_run_reads_only_new_rows():
+    table = {"x": np.arange(2.0), "value": np.arange(2.0) * 10}
+    run = Run("b", table, stopped=False)
+    cache = ColumnCache()
+    cache.read(run, ["x", "value"])
+    table["x"], table["value"] = np.arange(5.0), np.arange(5.0) * 10
+    columns = cache.read(run, ["x", "value"])
+    np.testing.assert_array_equal(columns["value"], [0, 10, 20, 30, 40])
+    # only the three new rows of each column were transferred
+    assert run.primary.data.requests == [("x", "value"), ("x", 3), ("value", 3)]
+    # without new rows, one empty slice is read
+    assert len(cache.read(run, ["x", "value"])["x"]) == 5
+    assert run.primary.data.requests[3:] == [("x", 0)]
+    # the node metadata still shows the run open, the stop document seen on Kafka ends the reads
+    cache.on_document("stop", {"run_start": "b"})
+    table["x"], table["value"] = np.arange(6.0), np.arange(6.0) * 10
+    assert len(cache.read(run, ["x", "value"])["x"]) == 6
+    assert len(cache.read(run, ["x", "value"])["x"]) == 6
+    assert run.primary.data.requests[4:] == [("x", 1), ("value", 1)]
+
+
+def test_data_key_index():
+    index = DataKeyIndex(maxsize=2)
+    index.on_document("descriptor", {"name": "primary", "run_start": "a", "data_keys": {"x": {}, "value": {}}})
+    index.on_document("descriptor", {"name": "baseline", "run_start": "a", "data_keys": {"motor": {}}})
+    assert index.has_keys("a", ["x", "value"])
+    assert not index.has_keys("a", ["x", "motor"])
+    assert not index.has_keys("b", ["x"])
+
+    lookups = []
+
+    def fallback():
+        lookups.append("b")
+        return ["x"]
+
+    assert index.has_keys("b", ["x"], fallback=fallback)
+    assert index.has_keys("b", ["x"], fallback=fallback)
+    assert lookups == ["b"]
+
+    # a run without keys yet is looked up again
+    found = iter([[], ["x"]])
+    assert not index.has_keys("c", ["x"], fallback=lambda: next(found))
+    assert index.has_keys("c", ["x"], fallback=lambda: next(found))
+
+
+def test_event_payloads():
+    payloads = EventPayloads(maxsize=1)
+    payloads.on_document("start", {"uid": "r1", "reduced_stream": True})
+    payloads.on_document("descriptor", {"uid": "d1", "run_start": "r1", "name": "primary"})
+    payloads.on_document("descriptor", {"uid": "d2", "run_start": "r1", "name": "baseline"})
+    assert payloads.on_document("event", {"descriptor": "d2", "data": {"motor": 1.0}}) is None
+    assert payloads.on_document("event", {"descriptor": "d1", "data": {"x": 1.0, "value": 2.0}}) == (
+        "r1",
+        [{"x": 1.0, "value": 2.0}],
+    )
+    page = {"descriptor": "d1", "data": {"x": [3.0, 5.0], "value": [4.0, 6.0]}}
+    assert payloads.on_document("event_page", page)[1] == [{"x": 3.0, "value": 4.0}, {"x": 5.0, "value": 6.0}]
+
+    columns = payloads.columns("r1", ["x", "value"])
+    np.testing.assert_array_equal(columns["x"], [1.0, 3.0, 5.0])
+    assert payloads.columns("r1", ["x", "variance"]) is None
+    assert payloads.start("r1")["reduced_stream"]
+
+    # told rows are dropped, later events are not kept either
+    payloads.discard("r1")
+    assert payloads.columns("r1", ["x"]) is None
+    assert payloads.on_document("event", {"descriptor": "d1", "data": {"x": 7.0}}) == ("r1", [{"x": 7.0}])
+    assert payloads.columns("r1", ["x"]) is None
+
+    # the oldest run is forgotten
+    payloads.on_document("start", {"uid": "r2"})
+    assert payloads.columns("r1", ["x"]) is None
+    assert payloads.on_document("event", {"descriptor": "d1", "data": {"x": 1.0}}) is None
+
+
+class Catalog(dict):
+    """Stands in for a Tiled node of runs, supporting the equality and comparison queries on start keys."""
+
+    def search(self, query):
+        operators = {"ge": lambda a, b: a >= b, "le": lambda a, b: a <= b}
+        compare = operators[query.operator.value] if hasattr(query, "operator") else lambda a, b: a == b
+        field = query.key.split(".")[1]
+        return Catalog(
+            {uid: run for uid, run in self.items() if compare(run.metadata["start"].get(field), query.value)}
+        )
+
+
+def history_run(uid, time, x, sample="a", **start):
+    run = Run(uid, {"x": np.atleast_1d(x), "value": np.atleast_1d(x) * 2})
+    run.metadata["start"].update(time=time, sample=sample, **start)
+    return run
+
+
+def test_read_history_concatenates_matching_runs():
+    catalog = Catalog(
+        {
+            "a": history_run("a", 1.0, 0.0),
+            "b": history_run("b", 2.0, [1.0, 2.0]),
+            "c": history_run("c", 3.0, 3.0, sample="other"),
+            "d": history_run("d", 4.0, 4.0),
+            "agent": history_run("agent", 2.5, 9.0, agent_name="gp"),
+            "broken": Run("broken", {"value": np.ones(1)}),
+        }
+    )
+    catalog["broken"].metadata["start"].update(time=2.0, sample="a")
+    cache = ColumnCache()
+    uids, columns = read_history(
+        catalog,
+        lambda run: cache.read(run, ["x", "value"]),
+        ["x", "value"],
+        since=1.5,
+        until=4.0,
+        query={"sample": "a"},
+        exclude=["d"],
+    )
+    assert uids == ["b"]
+    np.testing.assert_array_equal(columns["x"], [1.0, 2.0])
+    np.testing.assert_array_equal(columns["value"], [2.0, 4.0])
+
+    uids, columns = read_history(catalog, lambda run: cache.read(run, ["x", "value"]), ["x", "value"])
+    assert uids == ["a", "b", "c", "d"]
+    np.testing.assert_array_equal(columns["x"], [0.0, 1.0, 2.0, 3.0, 4.0])
+    assert read_history(catalog, lambda run: cache.read(run, ["x"]), ["x"], since=10.0) == ([], {})
+
+
+def test_event_payloads_rows_are_capped():
+    payloads = EventPayloads(max_rows=2)
+    payloads.on_document("start", {"uid": "r1"})
+    payloads.on_document("descriptor", {"uid": "d1", "run_start": "r1", "name": "primary"})
+    payloads.on_document("event_page", {"descriptor": "d1", "data": {"x": [1.0, 2.0]}})
+    assert payloads.columns("r1", ["x"])["x"].tolist() == [1.0, 2.0]
+    assert payloads.on_document("event", {"descriptor": "d1", "data": {"x": 3.0}}) == ("r1", [{"x": 3.0}])
+    # read from Tiled instead
+    assert payloads.columns("r1", ["x"]) is None
+
+
+def test_iter_history_reads_chunks():
+    catalog = Catalog({uid: history_run(uid, float(i), float(i)) for i, uid in enumerate("abcde")})
+    cache = ColumnCache()
+    chunks = list(iter_history(catalog, lambda run: cache.read(run, ["x"]), ["x"], exclude=["b"], chunk_size=2))
+    assert [uids for uids, _ in chunks] == [["a", "c"], ["d", "e"]]
+    np.testing.assert_array_equal(chunks[1][1]["x"], [3.0, 4.0])
@@ -0,0 +1,50 @@
+import msgpack
+import pytest
+
+from cms_agents.consumers import OrderedCommitter, name_filtering_deserializer, peek_document_name
+
+
+@pytest.mark.parametrize("name", ["start", "descriptor", "event_page", "stop", "a" * 40, "a" * 300])
+def test_peek_document_name(name):
+    message = msgpack.dumps((name, {"uid": "abc", "data": {"x": [1, 2, 3]}}))
+    assert peek_document_name(message) == name
+
+
+def test_name_filtering_deserializer():
+    deserialize = name_filtering_deserializer(["stop"])
+    stop = {"uid": "s1", "run_start": "r1"}
+    assert deserialize(msgpack.dumps(("stop", stop))) == ["stop", stop]
+    assert deserialize(msgpack.dumps(("event", {"data": {"x": 1}}))) == ("event", {})
+
+
+class RecordingConsumer:
+    """Stands in for confluent_kafka.Consumer, positions are a counter of polled messages."""
+
+    def __init__(self):
+        self.polled = 0
+        self.commits = []
+
+    def assignment(self):
+        return ["partition-0"]
+
+    def position(self, partitions):
+        return [(partition, self.polled) for partition in partitions]
+
+    def commit(self, offsets, asynchronous):
+        self.commits.append(offsets)
+
+
+def test_ordered_committer_waits_for_earlier_work():
+    consumer = RecordingConsumer()
+    committer = OrderedCommitter(consumer)
+    tokens = []
+    for _ in range(3):
+        consumer.polled += 1
+        tokens.append(committer.track())
+
+    committer.done(tokens[1])
+    assert consumer.commits == []
+    committer.done(tokens[0])
+    assert consumer.commits == [[("partition-0", 2)]]
+    committer.done(tokens[2])
+    assert consumer.commits[-1] == [("partition-0", 3)]
@@ -0,0 +1,134 @@
+import logging
+import time
+
+import numpy as np
+
+from cms_agents.documents import (
+    DescriptorSchemaCache,
+    DocumentSummary,
+    LazyPformat,
+    ReducedRunStream,
+    flatten_dict,
+    publish_reduced_documents,
+)
+
+
+class Unformattable:
+    def __repr__(self):
+        raise AssertionError("formatted although the log level is disabled")
+
+
+def test_document_summary():
+    event = {"uid": "e1", "descriptor": "d1", "seq_num": 3, "data": {"a": 1, "b": 2}, "time": 0.0}
+    assert str(DocumentSummary("event", event)) == "event uid=e1 descriptor=d1 seq_num=3 data_keys=2 keys=5"
+
+
+def test_disabled_levels_are_not_formatted(caplog):
+    logger = logging.getLogger("cms_agents.tests")
+    with caplog.at_level(logging.INFO, logger="cms_agents.tests"):
+        logger.debug("contents: %s", LazyPformat({"x": Unformattable()}))
+        logger.info("document: %s", DocumentSummary("stop", {"uid": "s1", "run_start": "r1"}))
+    assert caplog.messages == ["document: stop uid=s1 run_start=r1 keys=2"]
+
+
+def test_flatten_dict():
+    nested = {"a": {"b": 1, "c": {"d": 2}}, "e": 3, "f": {}}
+    assert flatten_dict(nested, sep="__") == {"a__b": 1, "a__c__d": 2, "e": 3}
+    assert list(flatten_dict(nested)) == ["a.b", "a.c.d", "e"]
+    deep = value = {}
+    for _ in range(5000):
+        value["x"] = value = {}
+    value["y"] = 1
+    assert flatten_dict(deep, sep="") == {"x" * 5000 + "y": 1}
+
+
+def test_schema_is_reused_until_layout_changes():
+    schemas = DescriptorSchemaCache()
+    data = {"value": 1.5, "name": "a", "curve": np.zeros(3)}
+    first = schemas.data_keys(data)
+    assert first == {
+        "value": {"dtype": "number", "shape": (), "source": "computed"},
+        "name": {"dtype": "string", "shape": (), "source": "computed"},
+        "curve": {"dtype": "array", "shape": (3,), "source": "computed"},
+    }
+    assert schemas.data_keys({"value": 2.5, "name": "b", "curve": np.ones(3)}) == first
+    assert (schemas.hits, schemas.misses) == (1, 1)
+    assert schemas.data_keys({"value": 2.5, "name": "b", "curve": np.ones(4)})["curve"]["shape"] == (4,)
+    assert schemas.data_keys({"value": 2, "name": "b", "curve": np.ones(3)})["value"]["dtype"] == "integer"
+    assert schemas.misses == 3
+    # lists of the same length are told apart by their shape and dtype
+    layouts = [[[1.0, 2.0], [3.0, 4.0]], [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]], [[1, 2], [3, 4]], [[1.0], [2.0, 3.0]]]
+    for peaks in layouts:
+        schemas.data_keys({"peaks": peaks})
+    assert schemas.misses == 7
+    schemas.data_keys({"peaks": [[5.0, 6.0], [7.0, 8.0]]})
+    assert schemas.misses == 7
+
+
+def test_publish_reduced_documents():
+    documents = []
+    publish_reduced_documents({"value": 1.0}, {"raw_start": {}}, lambda name, doc: documents.append((name, doc)))
+    assert [name for name, _ in documents] == ["start", "descriptor", "event", "stop"]
+    assert documents[1][1]["data_keys"]["value"]["dtype"] == "number"
+    assert documents[2][1]["data"] == {"value": 1.0}
+
+
+def test_stream_appends_events_until_rollover():
+    documents = []
+
+    def publisher(name, doc):
+        documents.append((name, doc))
+
+    def metadata(uid, directory="/data/a/"):
+        return {"raw_start": {"uid": uid, "experiment_alias_directory": directory}}
+
+    stream = ReducedRunStream(max_events=3)
+    for i in range(4):
+        stream.publish({"value": float(i)}, metadata(f"raw{i}"), publisher)
+    stream.publish({"value": 1.0, "extra": 2.0}, metadata("raw4"), publisher)
+    stream.publish({"value": 1.0, "extra": 2.0}, metadata("raw5", "/data/b/"), publisher)
+    stream.close()
+    stream.close()
+
+    names = [name for name, _ in documents]
+    assert names == ["start", "descriptor", "event", "event", "event", "stop"] + [
+        "start", "descriptor", "event", "stop"
+    ] * 3
+    events = [doc for name, doc in documents if name == "event"]
+    assert [event["data"]["raw_start_uid"] for event in events] == [f"raw{i}" for i in range(6)]
+    assert [event["seq_num"] for event in events[:3]] == [1, 2, 3]
+    starts = [doc for name, doc in documents if name == "start"]
+    assert starts[-1]["session"] == {"experiment_alias_directory": "/data/b/"}
+    assert documents[5][1]["num_events"] == {"primary": 3}
+
+
+def test_stream_rollover_stop_goes_to_the_current_publisher():
+    first, second = [], []
+    stream = ReducedRunStream(max_events=1)
+    stream.publish({"value": 1.0}, {"raw_start": {"uid": "raw0"}}, lambda name, doc: first.append(name))
+    stream.publish({"value": 2.0}, {"raw_start": {"uid": "raw1"}}, lambda name, doc: second.append(name))
+    assert first == ["start", "descriptor", "event"]
+    assert second == ["stop", "start", "descriptor", "event"]
+    stream.close()
+    assert second[-1] == "stop"
+
+
+def test_idle_stream_is_stopped_after_max_age():
+    documents = []
+
+    def publisher(name, doc):
+        documents.append(name)
+        return f"delivery of {name}"
+
+    stream = ReducedRunStream(max_age=0.05)
+    stream.publish({"value": 1.0}, {"raw_start": {"uid": "raw0"}}, publisher)
+    deadline = time.monotonic() + 5
+    while "stop" not in documents and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert documents == ["start", "descriptor", "event", "stop"]
+    assert stream.stop_delivery == "delivery of stop"
+    # nothing is left to stop, the next event opens a new run
+    assert stream.close() is None
+    stream.publish({"value": 2.0}, {"raw_start": {"uid": "raw1"}}, publisher)
+    assert stream.close() == "delivery of stop"
+    assert documents[4:] == ["start", "descriptor", "event", "stop"]
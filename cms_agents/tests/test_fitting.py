@@ -0,0 +1,62 @@
+import numpy as np
+
+from cms_agents.fitting import PARAMETER_NAMES, fit_q2I_peaks, q2I_peak_model
+
+FIT_ARGS = dict(qn_power=3.5, trim_range=[0.005, 0.03], fit_range=[0.007, 0.019], q0=0.0120, sigma=0.0008)
+
+
+def synthetic_curves(q, n, rng):
+    params = np.stack(
+        [
+            rng.uniform(-0.02, 0.02, n),
+            rng.uniform(0.5e-4, 1e-4, n),
+            rng.uniform(1e-3, 3e-3, n),
+            rng.uniform(0.011, 0.014, n),
+            rng.uniform(0.0006, 0.001, n),
+        ],
+        axis=1,
+    )
+    q2I, _ = q2I_peak_model(q, params)
+    return params, q2I / np.power(q, FIT_ARGS["qn_power"])
+
+
+def test_jacobian_matches_finite_differences():
+    x = np.linspace(0, 1, 50)
+    params = np.array([[0.3, 0.1, 1.2, 0.45, 0.1]])
+    _, jacobian = q2I_peak_model(x, params)
+    for i in range(len(PARAMETER_NAMES)):
+        step = np.zeros_like(params)
+        step[0, i] = 1e-6
+        numerical = (q2I_peak_model(x, params + step)[0] - q2I_peak_model(x, params - step)[0]) / 2e-6
+        np.testing.assert_allclose(jacobian[0, :, i], numerical[0], atol=1e-6)
+
+
+def test_batch_recovers_parameters():
+    rng = np.random.default_rng(0)
+    q = np.linspace(0.003, 0.04, 400)
+    params, curves = synthetic_curves(q, 100, rng)
+    curves[:, 60] = np.nan  # empty bin
+    results = fit_q2I_peaks(q, curves, **FIT_ARGS)
+
+    assert len(results) == 100
+    for result, truth in zip(results, params):
+        assert set(result) >= {f"fit_peaks_{name}" for name in PARAMETER_NAMES}
+        assert isinstance(result["fit_peaks_prefactor1"]["value"], float)
+        np.testing.assert_allclose(result["fit_peaks_x_center1"]["value"], truth[3], rtol=1e-4)
+        np.testing.assert_allclose(result["fit_peaks_sigma1"]["value"], truth[4], rtol=1e-3)
+        np.testing.assert_allclose(result["fit_peaks_prefactor1"]["value"], truth[2], rtol=1e-3)
+        np.testing.assert_allclose(result["fit_peaks_d0"], 0.1 * 2 * np.pi / truth[3], rtol=1e-4)
+
+
+def test_batch_matches_single_fits():
+    rng = np.random.default_rng(1)
+    q = np.linspace(0.003, 0.04, 400)
+    _, curves = synthetic_curves(q, 5, rng)
+    curves *= 1 + 0.02 * rng.standard_normal(curves.shape)
+    batch = fit_q2I_peaks(q, curves, **FIT_ARGS)
+    for curve, result in zip(curves, batch):
+        (single,) = fit_q2I_peaks(q, curve, **FIT_ARGS)
+        for name in PARAMETER_NAMES:
+            key = f"fit_peaks_{name}"
+            np.testing.assert_allclose(result[key]["value"], single[key]["value"], rtol=1e-6, atol=1e-12)
+        assert result["fit_peaks_prefactor1"]["error"] > 0
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from cms_agents.integration import IntegrationPlan, plan_key, q_map
+
+GEOMETRY = dict(
+    wavelength_A=0.9184,
+    width=64,
+    height=48,
+    pixel_size_um=172.0,
+    beam_position=(30, 20),
+    distance_m=5.03,
+)
+
+
+@pytest.fixture
+def mask():
+    mask = np.ones((GEOMETRY["height"], GEOMETRY["width"]), dtype=np.uint8)
+    mask[:, 40:44] = 0
+    return mask
+
+
+def test_plan_matches_histogram(mask):
+    rng = np.random.default_rng(0)
+    image = rng.poisson(100, size=mask.shape).astype(float)
+    plan = IntegrationPlan.build(GEOMETRY, mask)
+    q, intensity, intensity_error = plan.integrate(image, error=True)
+
+    keep = mask.ravel() == 1
+    q_keep = q_map(**GEOMETRY).ravel()[keep]
+    counts, edges = np.histogram(q_keep, bins=plan.num_bins, range=(q_keep.min(), q_keep.max()))
+    sums, _ = np.histogram(q_keep, bins=edges, weights=image.ravel()[keep])
+    filled = counts > 0
+    np.testing.assert_allclose(q, ((edges[:-1] + edges[1:]) / 2)[filled])
+    np.testing.assert_allclose(intensity, sums[filled] / counts[filled])
+    assert np.all(intensity_error >= 0)
+
+
+def test_plan_error_matches_binned_standard_deviation(mask):
+    stats = pytest.importorskip("scipy.stats")
+    rng = np.random.default_rng(1)
+    image = rng.poisson(100, size=mask.shape).astype(float)
+    plan = IntegrationPlan.build(GEOMETRY, mask)
+    _, _, intensity_error = plan.integrate(image, error=True)
+
+    # as SciAnalysis' circular_average_q_bin computes y_err
+    keep = mask.ravel() == 1
+    q_keep = q_map(**GEOMETRY).ravel()[keep]
+    std, _, _ = stats.binned_statistic(
+        q_keep, image.ravel()[keep], statistic="std", bins=plan.num_bins, range=(q_keep.min(), q_keep.max())
+    )
+    np.testing.assert_allclose(intensity_error, std[~np.isnan(std)])
+
+
+def test_plan_is_cached(tmp_path, mask):
+    plan = IntegrationPlan.load_or_build(GEOMETRY, mask, cache_dir=str(tmp_path))
+    assert (tmp_path / f"integration_plan_{plan.key}.npz").exists()
+    loaded = IntegrationPlan.load_or_build(GEOMETRY, mask, cache_dir=str(tmp_path))
+    assert loaded.key == plan.key
+    assert loaded.shape == plan.shape
+    np.testing.assert_array_equal(loaded.bin_index, plan.bin_index)
+
+
+def test_plan_key_depends_on_mask(mask):
+    other = mask.copy()
+    other[0, 0] = 0
+    assert plan_key(GEOMETRY, mask) != plan_key(GEOMETRY, other)
+    assert plan_key(GEOMETRY, mask) != plan_key(dict(GEOMETRY, distance_m=3.0), mask)
+
+
+def test_plan_rejects_wrong_shape(mask):
+    plan = IntegrationPlan.build(GEOMETRY, mask)
+    with pytest.raises(ValueError):
+        plan.integrate(np.zeros((3, 3)))
@@ -0,0 +1,51 @@
+import json
+import time as ttime
+import urllib.request
+
+from cms_agents.metrics import ObservationBuffer, StageMetrics, StageTimer, serve_metrics
+
+
+def test_stage_timer_records_consecutive_stages():
+    timer = StageTimer()
+    ttime.sleep(0.01)
+    timer.mark("tiled_fetched")
+    timer.mark("file_ready")
+    stages = [stage for stage, _ in timer.durations]
+    assert stages == ["tiled_fetched", "file_ready"]
+    assert timer.durations[0][1] >= 0.01
+    assert abs(timer.total() - sum(seconds for _, seconds in timer.durations)) < 1e-9
+
+
+def test_stage_metrics_summary_and_prometheus_text():
+    metrics = StageMetrics()
+    for seconds in (0.002, 0.02, 0.2):
+        metrics.observe("process_run", seconds)
+    metrics.set_gauge("reductions_pending", lambda: 3)
+    summary = metrics.summary()
+    assert summary["stages"]["process_run"]["count"] == 3
+    assert summary["gauges"] == {"reductions_pending": 3}
+    text = metrics.prometheus_text()
+    assert 'cms_reduction_stage_seconds_bucket{stage="process_run",le="0.005"} 1' in text
+    assert 'cms_reduction_stage_seconds_bucket{stage="process_run",le="+Inf"} 3' in text
+    assert "cms_reduction_reductions_pending 3" in text
+
+
+def test_observation_buffer_drain():
+    buffer = ObservationBuffer()
+    buffer.observe("deliver_kafka", 0.1)
+    assert buffer.drain() == [("deliver_kafka", 0.1)]
+    assert buffer.drain() == []
+
+
+def test_serve_metrics():
+    metrics = StageMetrics()
+    metrics.observe("tiled_fetched", 0.05)
+    server = serve_metrics(metrics, 0, host="127.0.0.1")
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        with urllib.request.urlopen(f"{url}/summary") as response:
+            assert json.load(response)["stages"]["tiled_fetched"]["count"] == 1
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            assert b"cms_reduction_stage_seconds_count" in response.read()
+    finally:
+        server.shutdown()
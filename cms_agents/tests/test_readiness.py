@@ -0,0 +1,89 @@
+import struct
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+from cms_agents.readiness import (
+    RunPrefetcher,
+    file_seen,
+    tiff_header_readable,
+    wait_for_file,
+    wait_for_prefetched_file,
+)
+
+
+def write_tiff(path, n_bytes=64, byte_order=b"II"):
+    fmt = "<HI" if byte_order == b"II" else ">HI"
+    path.write_bytes(byte_order + struct.pack(fmt, 42, 8) + bytes(n_bytes - 8))
+
+
+def test_tiff_header_readable(tmp_path):
+    little = tmp_path / "little.tiff"
+    write_tiff(little)
+    assert tiff_header_readable(str(little))
+
+    big = tmp_path / "big.tiff"
+    write_tiff(big, byte_order=b"MM")
+    assert tiff_header_readable(str(big))
+
+    truncated = tmp_path / "truncated.tiff"
+    truncated.write_bytes(b"II*\x00")
+    assert not tiff_header_readable(str(truncated))
+
+    assert not tiff_header_readable(str(tmp_path / "missing.tiff"))
+
+
+def test_wait_for_existing_file_returns_quickly(tmp_path):
+    path = tmp_path / "frame_saxs.tiff"
+    write_tiff(path)
+    assert wait_for_file(str(path), timeout=1.0) < 0.5
+
+
+def test_wait_for_file_written_later(tmp_path):
+    path = tmp_path / "frame_saxs.tiff"
+    timer = threading.Timer(0.1, write_tiff, args=(path,))
+    timer.start()
+    try:
+        waited = wait_for_file(str(path), timeout=5.0)
+    finally:
+        timer.cancel()
+    assert waited >= 0.1
+
+
+def test_wait_for_file_timeout(tmp_path):
+    with pytest.raises(TimeoutError):
+        wait_for_file(str(tmp_path / "never_saxs.tiff"), timeout=0.05)
+
+
+def test_wait_for_file_cancelled(tmp_path):
+    cancel = threading.Event()
+    timer = threading.Timer(0.05, cancel.set)
+    timer.start()
+    with pytest.raises(CancelledError):
+        wait_for_file(str(tmp_path / "never_saxs.tiff"), timeout=30.0, cancel=cancel)
+
+
+def test_prefetcher_with_more_runs_than_threads(tmp_path):
+    prefetcher = RunPrefetcher(
+        lambda start_doc: str(tmp_path / f"{start_doc['uid']}_saxs.tiff"),
+        watch_timeout=30.0,
+        max_runs=3,
+        max_threads=2,
+    )
+    for uid in ["r0", "r1", "r2", "r3", "r4"]:
+        prefetcher.on_start({"uid": uid})
+    # r0 and r1 were evicted, the watchers of r2 and r3 hold both threads, that of r4 is queued
+    assert prefetcher.pop("r0") is None
+    write_tiff(tmp_path / "r4_saxs.tiff")
+    prefetched = prefetcher.pop("r4")
+    assert not file_seen(prefetched["file_ready"])
+    assert wait_for_prefetched_file(str(tmp_path / "r4_saxs.tiff"), prefetched["file_ready"], timeout=1.0) < 0.5
+    # popping r2 and r3 stops their watchers, so the next run is watched right away
+    prefetcher.pop("r2")
+    prefetcher.pop("r3")
+    write_tiff(tmp_path / "r5_saxs.tiff")
+    prefetcher.on_start({"uid": "r5"})
+    time.sleep(1.0)
+    assert file_seen(prefetcher.pop("r5")["file_ready"])
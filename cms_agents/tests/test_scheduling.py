@@ -0,0 +1,64 @@
+import threading
+
+from cms_agents.metrics import StageTimer
+from cms_agents.scheduling import ReductionScheduler, agent_requested
+
+
+def test_agent_requested():
+    assert agent_requested({"plan_name": "agent_feedback_plan"})
+    assert not agent_requested({"plan_name": "count"})
+    assert not agent_requested(None)
+
+
+def test_agent_runs_first_and_oldest_surveys_shed():
+    handled, shed = [], []
+    started, release = threading.Event(), threading.Event()
+    done = threading.Semaphore(0)
+
+    def handler(run_start_id, timer, token=None):
+        if run_start_id == "blocker":
+            started.set()
+            release.wait(5)
+        handled.append((run_start_id, token))
+        done.release()
+
+    scheduler = ReductionScheduler(
+        handler, max_backlog=3, on_shed=lambda run_start_id, timer, token=None: shed.append(token)
+    ).start()
+    scheduler.submit("blocker", StageTimer())
+    assert started.wait(5)
+    for i in range(4):
+        scheduler.submit(f"survey{i}", StageTimer(), token=i)
+    scheduler.submit("agent", StageTimer(), urgent=True, token="a")
+
+    assert scheduler.depth() == 3
+    assert scheduler.shed == 2
+    assert shed == [0, 1]
+    assert scheduler.oldest_age() >= 0
+    release.set()
+    for _ in range(4):
+        assert done.acquire(timeout=5)
+    assert handled == [("blocker", None), ("agent", "a"), ("survey2", 2), ("survey3", 3)]
+
+
+def test_stale_surveys_are_shed():
+    handled, shed = [], []
+    done = threading.Semaphore(0)
+
+    def record(results):
+        def callback(run_start_id, timer):
+            results.append(run_start_id)
+            done.release()
+
+        return callback
+
+    scheduler = ReductionScheduler(record(handled), max_age=10.0, on_shed=record(shed))
+    old = StageTimer(start=StageTimer().start - 60)
+    scheduler.submit("stale", old)
+    scheduler.submit("agent", StageTimer(start=old.start), urgent=True)
+    scheduler.submit("fresh", StageTimer())
+    scheduler.start()
+    for _ in range(3):
+        assert done.acquire(timeout=5)
+    assert handled == ["agent", "fresh"]
+    assert shed == ["stale"]
@@ -0,0 +1,209 @@
+import threading
+
+import pytest
+
+from cms_agents.sinks import BackgroundSink, DeliveryError, DocumentSinks, all_delivered, kafka_sink
+
+
+def test_sinks_deliver_in_order_and_flush_on_close():
+    delivered = {"a": [], "b": []}
+    sinks = DocumentSinks(
+        BackgroundSink("a", delivered["a"].extend),
+        BackgroundSink("b", delivered["b"].extend),
+    )
+    docs = [(name, {"seq": i}) for i, name in enumerate(["start", "descriptor", "event", "stop"] * 5)]
+    for name, doc in docs:
+        sinks(name, doc)
+    sinks.close()
+    assert delivered["a"] == docs
+    # stop documents reach the second sink only after the first delivered them, in order all the same
+    assert delivered["b"] == docs
+    stats = sinks.stats()
+    assert stats["a"]["delivered"] == len(docs)
+    assert stats["a"]["queued"] == 0
+    assert "latency_p95" in stats["b"]
+
+
+def test_sink_batches_documents_queued_during_delivery():
+    release = threading.Event()
+    batches = []
+
+    def deliver(batch):
+        release.wait(5)
+        batches.append(batch)
+
+    sink = BackgroundSink("slow", deliver, max_batch=10)
+    for i in range(6):
+        sink("event", {"seq": i})
+    release.set()
+    sink.close()
+    assert [doc["seq"] for batch in batches for _, doc in batch] == list(range(6))
+    assert len(batches) < 6
+
+
+def test_sink_retries_failed_deliveries():
+    failures = []
+    delivered = []
+
+    def deliver(batch):
+        if len(failures) < 2:
+            failures.append(len(batch))
+            raise RuntimeError("server unavailable")
+        delivered.extend(batch)
+
+    sink = BackgroundSink("flaky", deliver, retry_delay=0.01)
+    future = sink("start", {})
+    future.result(5)
+    sink("stop", {})
+    sink.close()
+    assert delivered == [("start", {}), ("stop", {})]
+    assert sink.stats()["retried"] == 2
+    assert sink.stats()["errors"] == 0
+    assert sink.stats()["delivered"] == 2
+
+
+def test_sink_retries_only_undelivered_documents():
+    inserted = []
+    failed = threading.Event()
+
+    def insert_batch(batch):
+        while batch:
+            if len(inserted) == 1 and not failed.is_set():
+                failed.set()
+                raise RuntimeError("timeout")
+            inserted.append(batch.pop(0))
+
+    release = threading.Event()
+    sink = BackgroundSink("tiled", lambda batch: release.wait(5) and insert_batch(batch), retry_delay=0.01)
+    futures = [sink(name, {}) for name in ("start", "descriptor", "event")]
+    release.set()
+    all_delivered(futures).result(5)
+    sink.close()
+    assert [name for name, _ in inserted] == ["start", "descriptor", "event"]
+
+
+def test_sink_reports_documents_it_gave_up():
+    def deliver(batch):
+        raise RuntimeError("server unavailable")
+
+    sink = BackgroundSink("down", deliver, retries=1, retry_delay=0.01)
+    future = sink("start", {})
+    with pytest.raises(DeliveryError):
+        future.result(5)
+    sink.close()
+    assert sink.stats()["errors"] == 1
+    assert sink.stats()["delivered"] == 0
+
+
+def test_stop_announced_after_it_is_stored():
+    store = threading.Event()
+    stored, announced = [], []
+
+    def insert(batch):
+        store.wait(5)
+        stored.extend(batch)
+
+    sinks = DocumentSinks(BackgroundSink("tiled", insert), BackgroundSink("kafka", announced.extend))
+    sinks("start", {})
+    delivery = sinks("stop", {})
+    sinks("start", {"next": True})
+    assert not delivery.done()
+    store.set()
+    delivery.result(5)
+    sinks.close()
+    assert stored == [("start", {}), ("stop", {}), ("start", {"next": True})]
+    assert announced.index(("stop", {})) > announced.index(("start", {}))
+
+
+def test_next_run_announced_after_the_stop_without_blocking_the_store():
+    store, all_stored = threading.Event(), threading.Event()
+    announce = threading.Event()
+    stored, announced = [], []
+
+    def insert(batch):
+        if ("stop", {"run": "a"}) in batch:
+            store.wait(5)
+        stored.extend(batch)
+        if ("stop", {"run": "b"}) in batch:
+            all_stored.set()
+
+    def produce(batch):
+        announce.wait(5)
+        announced.extend(batch)
+
+    sinks = DocumentSinks(
+        BackgroundSink("tiled", insert), BackgroundSink("kafka", produce, max_queue=1, max_batch=1)
+    )
+    run_a = [("start", {"run": "a"}), ("stop", {"run": "a"})]
+    run_b = [("start", {"run": "b"}), ("event", {"run": "b"}), ("stop", {"run": "b"})]
+    deliveries = [sinks(name, doc) for name, doc in run_a + run_b]
+    store.set()
+    # the kafka sink is stuck and full, the store carries on
+    assert all_stored.wait(5)
+    assert stored == run_a + run_b and not deliveries[-1].done()
+    announce.set()
+    for delivery in deliveries:
+        delivery.result(5)
+    sinks.close()
+    # run b is announced after the stop of run a, although it was stored while that stop was held
+    assert announced == run_a + run_b
+
+
+def test_failed_store_is_not_announced():
+    def insert(batch):
+        raise RuntimeError("tiled unavailable")
+
+    announced = []
+    sinks = DocumentSinks(
+        BackgroundSink("tiled", insert, retries=0),
+        BackgroundSink("kafka", announced.extend),
+    )
+    delivery = sinks("stop", {})
+    with pytest.raises(DeliveryError):
+        delivery.result(5)
+    sinks.close()
+    assert announced == []
+
+
+class Publisher:
+    """Stands in for a bluesky_kafka Publisher, failing the delivery of the documents in ``fail``."""
+
+    def __init__(self, fail):
+        self.fail = fail
+        self.produced = []
+        self._pending = []
+        self.on_delivery = lambda err, msg: None
+
+    def __call__(self, name, doc):
+        self.produced.append(doc["seq"])
+        self._pending.append(doc["seq"])
+
+    def flush(self):
+        for seq in self._pending:
+            failing = self.fail.get(seq, 0)
+            self.fail[seq] = failing - 1
+            self.on_delivery("broker unavailable" if failing > 0 else None, seq)
+        self._pending = []
+
+
+def test_kafka_sink_retries_only_undelivered_documents():
+    publisher = Publisher(fail={2: 1})
+    sink = kafka_sink(publisher)
+    sink.close()
+    batch = [("event", {"seq": i}) for i in range(4)]
+    with pytest.raises(DeliveryError):
+        sink._deliver_batch(batch)
+    # the documents before the failed one were delivered and are not produced again
+    assert [doc["seq"] for _, doc in batch] == [2, 3]
+    sink._deliver_batch(batch)
+    assert batch == [] and publisher.produced == [0, 1, 2, 3, 2, 3]
+
+
+def test_kafka_sink_reports_only_undelivered_documents():
+    publisher = Publisher(fail={1: 10})
+    sink = kafka_sink(publisher, max_batch=3, retries=1, retry_delay=0.01)
+    futures = [sink("event", {"seq": i}) for i in range(3)]
+    futures[0].result(5)
+    with pytest.raises(DeliveryError):
+        futures[1].result(5)
+    sink.close()
@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+
+from cms_agents import snapshots
+from cms_agents.snapshots import pack_arrays, read_snapshot, unpack_arrays, write_snapshot
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "agent" / "state.npz")
+    inputs = np.arange(6.0).reshape(3, 2)
+    write_snapshot(path, dict(target_key="value", tell_cache=["a", "b"]), dict(inputs=inputs))
+    meta, arrays = read_snapshot(path)
+    assert meta["target_key"] == "value" and meta["tell_cache"] == ["a", "b"]
+    assert meta["version"] == snapshots.SNAPSHOT_VERSION and meta["written_at"] > 0
+    np.testing.assert_array_equal(arrays["inputs"], inputs)
+    # no temporary files are left behind
+    assert os.listdir(tmp_path / "agent") == ["state.npz"]
+
+
+def test_snapshot_replaced_atomically(tmp_path, monkeypatch):
+    path = str(tmp_path / "state.npz")
+    write_snapshot(path, dict(step=1), {})
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(snapshots.np, "savez", fail)
+    try:
+        write_snapshot(path, dict(step=2), {})
+    except OSError:
+        pass
+    monkeypatch.undo()
+    assert read_snapshot(path)[0]["step"] == 1
+    assert os.listdir(tmp_path) == ["state.npz"]
+
+
+def test_unusable_snapshots_ignored(tmp_path, monkeypatch):
+    assert read_snapshot(str(tmp_path / "missing.npz")) == (None, None)
+    corrupt = tmp_path / "corrupt.npz"
+    corrupt.write_bytes(b"not a snapshot")
+    assert read_snapshot(str(corrupt)) == (None, None)
+    path = str(tmp_path / "old.npz")
+    monkeypatch.setattr(snapshots, "SNAPSHOT_VERSION", 0)
+    write_snapshot(path, {}, {})
+    monkeypatch.undo()
+    assert read_snapshot(path) == (None, None)
+
+
+def test_pack_arrays():
+    values = [np.array([1.0, 2.0]), 3.0, np.array([4.0, 5.0, 6.0])]
+    packed, lengths = pack_arrays(values)
+    np.testing.assert_array_equal(lengths, [2, 1, 3])
+    unpacked = unpack_arrays(packed, lengths)
+    assert [list(value) for value in unpacked] == [[1.0, 2.0], [3.0], [4.0, 5.0, 6.0]]
+    assert unpack_arrays(*pack_arrays([])) == []
@@ -0,0 +1,94 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+models = pytest.importorskip("botorch.models")
+
+from cms_agents.surrogate import IncrementalGP  # noqa: E402
+
+
+def observations(n, generator):
+    x = torch.rand(n, 1, dtype=torch.float64, generator=generator) * 20
+    return x, torch.sin(x / 3).squeeze(-1)
+
+
+def make_model(x, y):
+    dummy = torch.tensor([[0.0], [1.0]], dtype=torch.float64)
+    model = models.SingleTaskGP(dummy, dummy)
+    model.set_train_data(x, y, strict=False)
+    return model.eval()
+
+
+def test_update_matches_full_factorization():
+    generator = torch.Generator().manual_seed(0)
+    x, y = observations(5, generator)
+    model = make_model(x, y)
+    gp = IncrementalGP(model)
+    gp.update()
+    for _ in range(4):
+        new_x, new_y = observations(1, generator)
+        x, y = torch.cat([x, new_x]), torch.cat([y, new_y])
+        model.set_train_data(x, y, strict=False)
+        gp.update()
+    assert len(gp) == 9 and gp.told_since_fit == 9
+
+    full = IncrementalGP(model)
+    full.reset()
+    torch.testing.assert_close(gp._chol, full._chol)
+    assert gp.log_marginal_likelihood() == pytest.approx(full.log_marginal_likelihood())
+
+
+def test_prediction_model_is_conditioned_on_new_observations():
+    generator = torch.Generator().manual_seed(3)
+    x, y = observations(5, generator)
+    model = make_model(x, y)
+    gp = IncrementalGP(model)
+    gp.fitted()
+    first = gp.prediction_model()
+    assert gp.prediction_model() is first
+    for _ in range(3):
+        new_x, new_y = observations(2, generator)
+        x, y = torch.cat([x, new_x]), torch.cat([y, new_y])
+        model.set_train_data(x, y, strict=False)
+        gp.update()
+        predictive = gp.prediction_model()
+    assert predictive is not first and len(predictive.train_targets) == 11
+    # same predictions as the model computing its caches from scratch
+    test_x = torch.linspace(0, 20, 11, dtype=torch.float64).unsqueeze(-1)
+    with torch.no_grad():
+        expected, posterior = model.eval().posterior(test_x), predictive.posterior(test_x)
+    torch.testing.assert_close(posterior.mean, expected.mean)
+    torch.testing.assert_close(posterior.variance, expected.variance)
+    gp.fitted()
+    assert gp.prediction_model() is not predictive
+
+
+def test_refit_schedule():
+    generator = torch.Generator().manual_seed(1)
+    x, y = observations(4, generator)
+    model = make_model(x, y)
+    gp = IncrementalGP(model, refit_every=3, mll_tolerance=10.0)
+    gp.update()
+    assert gp.refit_due()
+    gp.fitted()
+    assert not gp.refit_due()
+    for told in range(1, 4):
+        new_x, new_y = observations(1, generator)
+        x, y = torch.cat([x, new_x]), torch.cat([y, new_y])
+        model.set_train_data(x, y, strict=False)
+        gp.update()
+        assert gp.refit_due() == (told == 3)
+
+
+def test_refit_on_likelihood_drift():
+    generator = torch.Generator().manual_seed(2)
+    x, y = observations(6, generator)
+    model = make_model(x, y)
+    gp = IncrementalGP(model, refit_every=100, mll_tolerance=0.5)
+    gp.update()
+    gp.fitted()
+    # observations far off the current model lower the likelihood of the data
+    x = torch.cat([x, x[:2] + 1e-3])
+    y = torch.cat([y, y[:2] + 50.0])
+    model.set_train_data(x, y, strict=False)
+    gp.update()
+    assert gp.refit_due()
@@ -0,0 +1,47 @@
+from cms_agents.tiled_access import RunCache
+
+
+class Catalog(dict):
+    """Stands in for a Tiled catalog, counting lookups and searches."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lookups = 0
+        self.searches = 0
+
+    def __getitem__(self, key):
+        self.lookups += 1
+        return super().__getitem__(key)
+
+    def search(self, query):
+        self.searches += 1
+        return Catalog({uid: dict.__getitem__(self, uid) for uid in query.value if uid in self})
+
+
+def test_run_cache_hits_and_eviction():
+    catalog = Catalog(a="run-a", b="run-b", c="run-c")
+    runs = RunCache(catalog, maxsize=2)
+    assert runs["a"] == "run-a"
+    assert runs["a"] == "run-a"
+    assert catalog.lookups == 1
+    runs["b"]
+    runs["c"]
+    assert "a" not in runs
+    assert (runs.hits, runs.misses) == (1, 3)
+
+
+def test_run_cache_prefetch_uses_one_search():
+    catalog = Catalog(a="run-a", b="run-b", c="run-c")
+    runs = RunCache(catalog)
+    runs["a"]
+    assert runs.prefetch(["a", "b", "c", "missing"]) == {"a": "run-a", "b": "run-b", "c": "run-c"}
+    assert catalog.searches == 1
+    assert runs["c"] == "run-c"
+    assert catalog.lookups == 1
+
+
+def test_run_cache_delegates_to_catalog():
+    catalog = Catalog(a="run-a")
+    runs = RunCache(catalog)
+    assert runs.searches == 0
+    assert runs.keys() == catalog.keys()
@@ -0,0 +1,118 @@
+"""Shared access to the CMS Tiled catalogs.
+
+Every Tiled client holds an HTTP connection pool with keep-alive, so building
+one client per profile or URI and sharing it, instead of calling
+``from_profile``/``from_uri`` at every use, reuses open connections to
+tiled.nsls2.bnl.gov. Clients are cached per process, so forked workers build
+their own instead of sharing sockets with the parent.
+
+``RunCache`` adds an LRU cache of run nodes, and with them their metadata, keyed by uid.
+"""
+import collections
+import os
+import threading
+
+from tiled.client import from_profile, from_uri
+from tiled.queries import In
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _cached_client(key, factory):
+    key = (os.getpid(), key)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def get_client(profile: str):
+    """Shared client for a Tiled profile, e.g. "cms" or "cms_bluesky_sandbox"."""
+    return _cached_client(("profile", profile), lambda: from_profile(profile))
+
+
+def get_client_from_uri(uri: str):
+    """Shared client for a Tiled URI."""
+    return _cached_client(("uri", uri), lambda: from_uri(uri))
+
+
+class RunCache:
+    """LRU cache of the runs of a Tiled catalog, keyed by uid.
+
+    Looking up a run in a Tiled catalog fetches its node and metadata in one request, so caching
+    the node also caches the metadata. Several uids can be fetched with one search, see ``prefetch``.
+    Any other attribute, e.g. ``search``, is that of the catalog.
+
+    Parameters
+    ----------
+    catalog : tiled.client.node.Node
+        Catalog of Bluesky runs.
+    maxsize : int, optional
+        Maximum number of runs kept, by default 256.
+    """
+
+    def __init__(self, catalog, maxsize: int = 256):
+        self.catalog = catalog
+        self.maxsize = maxsize
+        self._runs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, key, run):
+        with self._lock:
+            self._runs[key] = run
+            self._runs.move_to_end(key)
+            while len(self._runs) > self.maxsize:
+                self._runs.popitem(last=False)
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._runs:
+                self._runs.move_to_end(key)
+                self.hits += 1
+                return self._runs[key]
+            self.misses += 1
+        run = self.catalog[key]
+        self._store(key, run)
+        return run
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the cache itself
+        if name == "catalog":
+            raise AttributeError(name)
+        return getattr(self.catalog, name)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._runs
+
+    def metadata(self, key) -> dict:
+        return self[key].metadata
+
+    def prefetch(self, uids) -> dict:
+        """
+        Fetch every uid not yet cached with a single search of the catalog.
+
+        Returns
+        -------
+        runs : dict
+            The runs found for ``uids``, keyed by uid.
+        """
+        uids = list(uids)
+        with self._lock:
+            missing = [uid for uid in uids if uid not in self._runs]
+        if missing:
+            for uid, run in self.catalog.search(In("start.uid", missing)).items():
+                self._store(uid, run)
+        with self._lock:
+            return {uid: self._runs[uid] for uid in uids if uid in self._runs}
+
+    def invalidate(self, key=None):
+        """Forget one run, or every run if ``key`` is None."""
+        with self._lock:
+            if key is None:
+                self._runs.clear()
+            else:
+                self._runs.pop(key, None)
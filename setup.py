@@ -49,6 +49,7 @@ setup(
     entry_points={
         "console_scripts": [
             # 'command = some.module:some_function',
+            "cms-batch-reduce = cms_agents.batch_reduce:main",
         ],
     },
     include_package_data=True,